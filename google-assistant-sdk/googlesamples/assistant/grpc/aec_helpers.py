@@ -0,0 +1,287 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper functions for acoustic echo cancellation."""
+
+import logging
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from . import audio_helpers
+except (SystemError, ImportError):
+    import audio_helpers
+
+
+DEFAULT_BLOCK_MS = 16
+DEFAULT_FILTER_MS = 128
+DEFAULT_STEP = 0.5
+DEFAULT_MAX_REFERENCE_MS = 1000
+DEFAULT_DELAY_MS = 0
+# Adaptation is frozen while the microphone is louder than this fraction
+# of the recent reference (Geigel double-talk detector).
+DEFAULT_DOUBLE_TALK_THRESHOLD = 0.5
+
+_FULL_SCALE = 32768.0
+
+
+class EchoCanceller(object):
+    """Partitioned block frequency domain NLMS echo canceller.
+
+    The echo of the reference signal, the audio played by the sink, is
+    estimated with an adaptive filter of filter_ms and subtracted from
+    the microphone signal. The filter is split in partitions of one
+    block, processed with vectorized FFTs, so that the added latency is
+    a single block whatever the filter length.
+
+    Reference and microphone samples are consumed in lockstep: the echo
+    of audio written to a sound device reaches the microphone audio
+    after the output and input latencies of the device, longer than the
+    filter with large blocks. The reference is delayed by delay_ms, this
+    bulk delay, so that the filter only covers the rest of the echo
+    path.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes, only 2 is supported.
+      block_ms: duration of a processing block in milliseconds.
+      filter_ms: length of the echo path covered by the filter.
+      step: adaptation step size, in (0, 1].
+      max_reference_ms: reference audio kept ahead of the microphone,
+        older audio is dropped.
+      delay_ms: delay of the echo from the reference to the microphone
+        audio, the sum of the device output and input latencies.
+      double_talk_threshold: microphone to reference level ratio above
+        which the near end is talking and adaptation is frozen.
+    """
+    def __init__(self, sample_rate, sample_width,
+                 block_ms=DEFAULT_BLOCK_MS,
+                 filter_ms=DEFAULT_FILTER_MS,
+                 step=DEFAULT_STEP,
+                 max_reference_ms=DEFAULT_MAX_REFERENCE_MS,
+                 double_talk_threshold=DEFAULT_DOUBLE_TALK_THRESHOLD,
+                 delay_ms=DEFAULT_DELAY_MS):
+        if np is None:
+            raise Exception('NumPy is required for echo cancellation')
+        if sample_width != 2:
+            raise Exception('unsupported sample width:', sample_width)
+        self.block_size = int(sample_rate * block_ms / 1000)
+        self.partitions = max(1, -(-int(sample_rate * filter_ms / 1000) //
+                                   self.block_size))
+        self.step = step
+        self.double_talk_threshold = double_talk_threshold
+        self._delay = int(sample_rate * delay_ms / 1000)
+        self._max_reference = (int(sample_rate * max_reference_ms / 1000) +
+                               self._delay)
+        self._lock = threading.Lock()
+        self._reference = np.zeros(0, dtype=np.float32)
+        self.stats = {
+            'blocks': 0,
+            'adapted_blocks': 0,
+            'dropped_reference': 0,
+        }
+        self.reset()
+
+    def reset(self):
+        """Forget the echo path and all buffered audio."""
+        bins = self.block_size + 1
+        self._weights = np.zeros((self.partitions, bins), dtype=np.complex128)
+        self._spectra = np.zeros((self.partitions, bins),
+                                 dtype=np.complex128)
+        self._power = np.zeros(bins)
+        self._levels = np.zeros(self.partitions + 1)
+        self._last_reference = np.zeros(self.block_size)
+        self._constrained = 0
+        # Output is delayed by one block, so that each call returns as
+        # many samples as it gets.
+        self._input = np.zeros(0, dtype=np.float32)
+        self._output = np.zeros(self.block_size, dtype=np.float32)
+        self.clear_reference()
+
+    def add_reference(self, buf):
+        """Append audio played by the sink to the reference signal."""
+        samples = audio_helpers._samples(buf).astype(np.float32)
+        with self._lock:
+            self._reference = np.concatenate((self._reference, samples))
+            dropped = len(self._reference) - self._max_reference
+            if dropped > 0:
+                self._reference = self._reference[dropped:]
+                self.stats['dropped_reference'] += dropped
+
+    def clear_reference(self):
+        """Drop the reference not yet matched with microphone audio.
+
+        The next reference is matched with the microphone audio after
+        the delay.
+        """
+        with self._lock:
+            self._reference = np.zeros(self._delay, dtype=np.float32)
+
+    def _take_reference(self, size):
+        with self._lock:
+            reference = self._reference[:size]
+            self._reference = self._reference[size:]
+        if len(reference) < size:
+            # Nothing is playing.
+            reference = np.concatenate(
+                (reference, np.zeros(size - len(reference),
+                                     dtype=np.float32)))
+        return reference
+
+    def process(self, buf):
+        """Remove the echo from microphone audio.
+
+        Args:
+          buf: int16 microphone samples, any object supporting the buffer
+            protocol.
+
+        Returns: bytes of as many cleaned samples, one block late.
+        """
+        samples = audio_helpers._samples(buf).astype(np.float32)
+        self._input = np.concatenate((self._input, samples))
+        count = len(self._input) // self.block_size
+        if count:
+            size = count * self.block_size
+            mic = self._input[:size] / _FULL_SCALE
+            reference = self._take_reference(size) / _FULL_SCALE
+            self._input = self._input[size:]
+            cleaned = [self._process_block(
+                mic[i:i + self.block_size],
+                reference[i:i + self.block_size])
+                for i in range(0, size, self.block_size)]
+            self._output = np.concatenate([self._output] + cleaned)
+        out = self._output[:len(samples)]
+        self._output = self._output[len(samples):]
+        return np.clip(np.round(out * _FULL_SCALE), -32768,
+                       32767).astype('<i2').tobytes()
+
+    def _process_block(self, mic, reference):
+        block_size = self.block_size
+        spectrum = np.fft.rfft(np.concatenate((self._last_reference,
+                                               reference)))
+        self._last_reference = reference
+        self._spectra[1:] = self._spectra[:-1]
+        self._spectra[0] = spectrum
+        self._levels[1:] = self._levels[:-1]
+        self._levels[0] = np.abs(reference).max()
+        echo = np.fft.irfft((self._weights * self._spectra).sum(axis=0))
+        error = mic - echo[block_size:]
+        self.stats['blocks'] += 1
+        level = self._levels.max()
+        if not level or (np.abs(mic).max() >
+                         self.double_talk_threshold * level):
+            return error
+        self.stats['adapted_blocks'] += 1
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        if self._power.any():
+            self._power = 0.9 * self._power + 0.1 * power
+        else:
+            self._power = power
+        gradient = np.fft.rfft(np.concatenate((np.zeros(block_size), error)))
+        norm = self.step / (self.partitions * self._power + 1e-6)
+        self._weights += norm * np.conj(self._spectra) * gradient
+        # Constrain one partition per block to a linear convolution.
+        p = self._constrained
+        taps = np.fft.irfft(self._weights[p])
+        taps[block_size:] = 0
+        self._weights[p] = np.fft.rfft(taps)
+        self._constrained = (p + 1) % self.partitions
+        return error
+
+
+class EchoCancellingSource(object):
+    """Audio source removing the echo of the sink from its audio.
+
+    Args:
+      source: audio source capturing the microphone.
+      canceller: EchoCanceller receiving the reference from an
+        EchoReferenceSink.
+    """
+    def __init__(self, source, canceller):
+        self._source = source
+        self._canceller = canceller
+        self._sample_rate = source.sample_rate
+
+    def read(self, size):
+        data = self._source.read(size)
+        if not len(data):
+            return data
+        return self._canceller.process(data)
+
+    def start(self):
+        self._source.start()
+
+    def stop(self):
+        self._source.stop()
+
+    def close(self):
+        self._source.close()
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+
+class EchoReferenceSink(object):
+    """Audio sink recording the audio it plays as the echo reference.
+
+    Args:
+      sink: audio sink playing the audio.
+      canceller: EchoCanceller of the microphone source.
+    """
+    def __init__(self, sink, canceller):
+        self._sink = sink
+        self._canceller = canceller
+
+    def write(self, buf):
+        self._canceller.add_reference(buf)
+        return self._sink.write(buf)
+
+    def flush(self):
+        self._sink.flush()
+
+    def start(self):
+        # Align the reference with the microphone again.
+        self._canceller.clear_reference()
+        self._sink.start()
+
+    def stop(self):
+        self._sink.stop()
+
+    def abort(self):
+        self._canceller.clear_reference()
+        getattr(self._sink, 'abort', self._sink.stop)()
+
+    def close(self):
+        self._sink.close()
+
+
+def create_echo_canceller(sample_rate, sample_width,
+                          filter_ms=DEFAULT_FILTER_MS,
+                          delay_ms=DEFAULT_DELAY_MS):
+    """Create an echo canceller.
+
+    Returns: an EchoCanceller, None when echo cancellation is not
+      available.
+    """
+    try:
+        return EchoCanceller(sample_rate, sample_width, filter_ms=filter_ms,
+                             delay_ms=delay_ms)
+    except Exception as e:
+        logging.warning('Echo cancellation not available (%s)', e)
+        return None
@@ -0,0 +1,653 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sample that implements an asyncio client for the Google Assistant API.
+
+A single event loop drives many concurrent Assist calls over grpc.aio.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import sys
+
+import click
+import grpc
+import google.auth.transport.grpc
+import google.auth.transport.requests
+import google.oauth2.credentials
+
+from google.assistant.embedded.v1alpha2 import (
+    embedded_assistant_pb2,
+    embedded_assistant_pb2_grpc
+)
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt
+
+try:
+    from . import (
+        assistant_helpers,
+        audio_helpers,
+        browser_helpers,
+        device_helpers
+    )
+except (SystemError, ImportError):
+    import assistant_helpers
+    import audio_helpers
+    import browser_helpers
+    import device_helpers
+
+
+ASSISTANT_API_ENDPOINT = 'embeddedassistant.googleapis.com'
+END_OF_UTTERANCE = embedded_assistant_pb2.AssistResponse.END_OF_UTTERANCE
+DIALOG_FOLLOW_ON = embedded_assistant_pb2.DialogStateOut.DIALOG_FOLLOW_ON
+CLOSE_MICROPHONE = embedded_assistant_pb2.DialogStateOut.CLOSE_MICROPHONE
+PLAYING = embedded_assistant_pb2.ScreenOutConfig.PLAYING
+DEFAULT_GRPC_DEADLINE = 60 * 3 + 5
+ASSIST_ATTEMPTS = 3
+
+
+def secure_authorized_channel(credentials, request, target):
+    """Create an authorized grpc.aio channel.
+
+    Args:
+      credentials: google.auth credentials.
+      request: google.auth transport request used to refresh credentials.
+      target: address of the Google Assistant API service.
+    """
+    metadata_plugin = google.auth.transport.grpc.AuthMetadataPlugin(
+        credentials, request
+    )
+    channel_credentials = grpc.composite_channel_credentials(
+        grpc.ssl_channel_credentials(),
+        grpc.metadata_call_credentials(metadata_plugin),
+    )
+    return grpc.aio.secure_channel(target, channel_credentials)
+
+
+class AsyncWaveSource(audio_helpers.WaveSource):
+    """WaveSource whose reads are throttled by the event loop.
+
+    Args:
+      fp: file-like stream object to read from.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      pacing: speed factor relative to real time.
+      trailing_silence_ms: milliseconds of silence after the end of the
+        file, None for unlimited.
+    """
+    async def read(self, size):
+        """Read bytes from the stream and wait until sample rate is achieved.
+
+        Args:
+          size: number of bytes to read from the stream.
+        """
+        wait = self._pacer.schedule(self._sleep_time(size))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return self._read(size)
+
+
+class AsyncMappedWaveSource(audio_helpers.MappedWaveSource):
+    """MappedWaveSource whose reads are throttled by the event loop.
+
+    Args:
+      path: path of the WAV or RAW file.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      pacing: speed factor relative to real time.
+      trailing_silence_ms: milliseconds of silence after the end of the
+        file, None for unlimited.
+    """
+    async def read(self, size):
+        """Read bytes from the file and wait until sample rate is achieved.
+
+        Args:
+          size: number of bytes to read from the file.
+        """
+        wait = self._pacer.schedule(self._sleep_time(size))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return self._read(size)
+
+
+class AsyncConversationStream(audio_helpers.ConversationStream):
+    """Audio stream that supports half-duplex conversation on asyncio.
+
+    Follows the same usage as ConversationStream with coroutine methods,
+    and shares its playback buffering, decoding and volume scaling.
+    Source and sink methods may be coroutines, other methods are run in
+    an executor so blocking device I/O does not stall the event loop.
+
+    Args:
+      source: file-like stream object to read input audio bytes from.
+      sink: file-like stream object to write output audio bytes to.
+      iter_size: read size in bytes for each iteration.
+      sample_width: size of a single sample in bytes.
+      executor: concurrent.futures executor for blocking calls,
+        defaults to the event loop default executor.
+    """
+    def __init__(self, source, sink, iter_size, sample_width, executor=None):
+        super().__init__(source, sink, iter_size, sample_width)
+        self._executor = executor
+
+    async def _call(self, fn, *args):
+        if asyncio.iscoroutinefunction(fn):
+            return await fn(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(fn, *args))
+
+    def _locked(self, fn):
+        if asyncio.iscoroutinefunction(fn):
+            return fn
+
+        def locked(*args):
+            with self._source_lock:
+                return fn(*args)
+        return locked
+
+    async def start_recording(self):
+        """Start recording from the audio source."""
+        self._recording = True
+        self._stop_recording.clear()
+        await self._call(self._source.start)
+
+    async def stop_recording(self):
+        """Stop recording from the audio source."""
+        self._stop_recording.set()
+        await self._call(self._locked(self._source.stop))
+        self._recording = False
+
+    async def start_playback(self):
+        """Start playback to the audio sink."""
+        self._prepare_playback()
+        await self._call(self._sink.start)
+
+    async def stop_playback(self):
+        """Stop playback from the audio sink."""
+        for data in self._playback_tail():
+            if len(data):
+                await self._call(self._sink.write, data)
+        await self._call(self._sink.flush)
+        await self._call(self._sink.stop)
+        self._playing = False
+
+    async def interrupt_playback(self):
+        """Stop playback immediately, discarding pending output."""
+        self._decoder = None
+        self._playback_buffer.reset()
+        await self._call(getattr(self._sink, 'abort', self._sink.stop))
+        self._playing = False
+
+    async def read(self, size):
+        """Read bytes from the source (if currently recording)."""
+        return await self._call(self._locked(self._source.read), size)
+
+    async def write(self, buf):
+        """Write bytes to the sink (if currently playing)."""
+        data = self._playback_data(buf)
+        written = await self._call(self._sink.write, data) if len(data) else 0
+        return len(buf) if self._decoder else written
+
+    async def close(self):
+        """Close source and sink."""
+        await self._call(self._source.close)
+        await self._call(self._sink.close)
+
+    async def __aiter__(self):
+        """Returns an asynchronous generator reading data from the stream."""
+        while not self._stop_recording.is_set():
+            data = await self.read(self._iter_size)
+            # Recording may have stopped while waiting for the source.
+            if self._stop_recording.is_set() or not len(data):
+                return
+            yield data
+
+
+class AsyncDeviceRequestHandler(device_helpers.DeviceRequestHandler):
+    """Asyncio dispatcher for Device actions commands.
+
+    Handlers may be coroutine functions, which run on the event loop,
+    or plain functions, which run in the handler executor.
+
+    Args:
+      device_id: device id to match command against
+    """
+
+    def schedule_command(self, command):
+        """Schedule a single command execution.
+
+        Returns: an asyncio task for the scheduled execution.
+        """
+        return asyncio.ensure_future(self.dispatch_command_async(**command))
+
+    async def dispatch_command_async(self, command, params=None):
+        """Dispatch device commands to the appropriate handler."""
+        handler = self.handlers.get(command)
+        if not asyncio.iscoroutinefunction(handler):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                self.executor,
+                functools.partial(self.dispatch_command, command, params)
+            )
+            return
+        try:
+            await handler(**params)
+        except Exception as e:
+            logging.warning('Error during command execution',
+                            exc_info=sys.exc_info())
+            raise e
+
+
+def is_grpc_error_unavailable(e):
+    is_grpc_error = isinstance(e, grpc.RpcError)
+    if is_grpc_error and (e.code() == grpc.StatusCode.UNAVAILABLE):
+        logging.error('grpc unavailable error: %s', e)
+        return True
+    return False
+
+
+class AsyncSampleAssistant(object):
+    """Asyncio Assistant that supports conversations and device actions.
+
+    Args:
+      language_code: language for the conversation.
+      device_model_id: identifier of the device model.
+      device_id: identifier of the registered device instance.
+      conversation_stream(AsyncConversationStream): audio stream
+        for recording query and playing back assistant answer.
+      display: enable visual display of assistant response.
+      channel: authorized grpc.aio channel for connection to the
+        Google Assistant API.
+      deadline_sec: gRPC deadline in seconds for Google Assistant API call.
+      device_handler: callback for device actions.
+    """
+
+    def __init__(self, language_code, device_model_id, device_id,
+                 conversation_stream, display,
+                 channel, deadline_sec, device_handler):
+        self.language_code = language_code
+        self.device_model_id = device_model_id
+        self.device_id = device_id
+        self.conversation_stream = conversation_stream
+        self.display = display
+        self.conversation_state = None
+        # Force reset of first conversation.
+        self.is_new_conversation = True
+        self.assistant = embedded_assistant_pb2_grpc.EmbeddedAssistantStub(
+            channel
+        )
+        self.deadline = deadline_sec
+        self.device_handler = device_handler
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, etype, e, traceback):
+        if e:
+            return False
+        await self.conversation_stream.close()
+
+    async def assist(self):
+        """Send a voice request to the Assistant and playback the response.
+
+        Requests failing with UNAVAILABLE are retried, up to
+        ASSIST_ATTEMPTS attempts.
+
+        Returns: True if conversation should continue.
+        """
+        async for attempt in AsyncRetrying(
+                reraise=True, stop=stop_after_attempt(ASSIST_ATTEMPTS),
+                retry=retry_if_exception(is_grpc_error_unavailable)):
+            with attempt:
+                return await self._assist()
+
+    async def _assist(self):
+        continue_conversation = False
+        device_actions_futures = []
+
+        await self.conversation_stream.start_recording()
+        logging.info('Recording audio request.')
+
+        async def iter_log_assist_requests():
+            async for c in self.gen_assist_requests():
+                assistant_helpers.log_assist_request_without_audio(c)
+                yield c
+            logging.debug('Reached end of AssistRequest iteration.')
+
+        call = self.assistant.Assist(iter_log_assist_requests(),
+                                     timeout=self.deadline)
+        async for resp in call:
+            assistant_helpers.log_assist_response_without_audio(resp)
+            if resp.event_type == END_OF_UTTERANCE:
+                logging.info('End of audio request detected.')
+                logging.info('Stopping recording.')
+                await self.conversation_stream.stop_recording()
+            if resp.speech_results:
+                logging.info('Transcript of user request: "%s".',
+                             ' '.join(r.transcript
+                                      for r in resp.speech_results))
+            if len(resp.audio_out.audio_data) > 0:
+                if not self.conversation_stream.playing:
+                    await self.conversation_stream.stop_recording()
+                    await self.conversation_stream.start_playback()
+                    logging.info('Playing assistant response.')
+                await self.conversation_stream.write(
+                    resp.audio_out.audio_data
+                )
+            if resp.dialog_state_out.conversation_state:
+                conversation_state = resp.dialog_state_out.conversation_state
+                logging.debug('Updating conversation state.')
+                self.conversation_state = conversation_state
+            if resp.dialog_state_out.volume_percentage != 0:
+                volume_percentage = resp.dialog_state_out.volume_percentage
+                logging.info('Setting volume to %s%%', volume_percentage)
+                self.conversation_stream.volume_percentage = volume_percentage
+            if resp.dialog_state_out.microphone_mode == DIALOG_FOLLOW_ON:
+                continue_conversation = True
+                logging.info('Expecting follow-on query from user.')
+            elif resp.dialog_state_out.microphone_mode == CLOSE_MICROPHONE:
+                continue_conversation = False
+            if resp.device_action.device_request_json:
+                device_request = json.loads(
+                    resp.device_action.device_request_json
+                )
+                fs = self.device_handler(device_request)
+                if fs:
+                    device_actions_futures.extend(fs)
+            if self.display and resp.screen_out.data:
+                system_browser = browser_helpers.system_browser
+                system_browser.display(resp.screen_out.data)
+
+        if self.conversation_stream.recording:
+            await self.conversation_stream.stop_recording()
+        if len(device_actions_futures):
+            logging.info('Waiting for device executions to complete.')
+            await asyncio.wait(device_actions_futures)
+
+        logging.info('Finished playing assistant response.')
+        await self.conversation_stream.stop_playback()
+        return continue_conversation
+
+    async def gen_assist_requests(self):
+        """Yields: AssistRequest messages to send to the API."""
+
+        config = embedded_assistant_pb2.AssistConfig(
+            audio_in_config=embedded_assistant_pb2.AudioInConfig(
+                encoding='LINEAR16',
+                sample_rate_hertz=self.conversation_stream.sample_rate,
+            ),
+            audio_out_config=embedded_assistant_pb2.AudioOutConfig(
+                encoding='LINEAR16',
+                sample_rate_hertz=self.conversation_stream.sample_rate,
+                volume_percentage=self.conversation_stream.volume_percentage,
+            ),
+            dialog_state_in=embedded_assistant_pb2.DialogStateIn(
+                language_code=self.language_code,
+                conversation_state=self.conversation_state,
+                is_new_conversation=self.is_new_conversation,
+            ),
+            device_config=embedded_assistant_pb2.DeviceConfig(
+                device_id=self.device_id,
+                device_model_id=self.device_model_id,
+            )
+        )
+        if self.display:
+            config.screen_out_config.screen_mode = PLAYING
+        # Continue current conversation with later requests.
+        self.is_new_conversation = False
+        # The first AssistRequest must contain the AssistConfig
+        # and no audio data.
+        yield embedded_assistant_pb2.AssistRequest(config=config)
+        async for data in self.conversation_stream:
+            # Subsequent requests need audio data, but not config.
+            # Sources may return memoryviews, copied once here.
+            yield embedded_assistant_pb2.AssistRequest(audio_in=bytes(data))
+
+
+class AsyncSampleTextAssistant(object):
+    """Asyncio Assistant that supports text based conversations.
+
+    Args:
+      language_code: language for the conversation.
+      device_model_id: identifier of the device model.
+      device_id: identifier of the registered device instance.
+      display: enable visual display of assistant response.
+      channel: authorized grpc.aio channel for connection to the
+        Google Assistant API.
+      deadline_sec: gRPC deadline in seconds for Google Assistant API call.
+    """
+
+    def __init__(self, language_code, device_model_id, device_id,
+                 display, channel, deadline_sec):
+        self.language_code = language_code
+        self.device_model_id = device_model_id
+        self.device_id = device_id
+        self.conversation_state = None
+        # Force reset of first conversation.
+        self.is_new_conversation = True
+        self.display = display
+        self.assistant = embedded_assistant_pb2_grpc.EmbeddedAssistantStub(
+            channel
+        )
+        self.deadline = deadline_sec
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, etype, e, traceback):
+        if e:
+            return False
+
+    async def assist(self, text_query):
+        """Send a text request to the Assistant.
+
+        Returns: (text_response, html_response) tuple.
+        """
+        async def iter_assist_requests():
+            config = embedded_assistant_pb2.AssistConfig(
+                audio_out_config=embedded_assistant_pb2.AudioOutConfig(
+                    encoding='LINEAR16',
+                    sample_rate_hertz=16000,
+                    volume_percentage=0,
+                ),
+                dialog_state_in=embedded_assistant_pb2.DialogStateIn(
+                    language_code=self.language_code,
+                    conversation_state=self.conversation_state,
+                    is_new_conversation=self.is_new_conversation,
+                ),
+                device_config=embedded_assistant_pb2.DeviceConfig(
+                    device_id=self.device_id,
+                    device_model_id=self.device_model_id,
+                ),
+                text_query=text_query,
+            )
+            # Continue current conversation with later requests.
+            self.is_new_conversation = False
+            if self.display:
+                config.screen_out_config.screen_mode = PLAYING
+            req = embedded_assistant_pb2.AssistRequest(config=config)
+            assistant_helpers.log_assist_request_without_audio(req)
+            yield req
+
+        text_response = None
+        html_response = None
+        call = self.assistant.Assist(iter_assist_requests(),
+                                     timeout=self.deadline)
+        async for resp in call:
+            assistant_helpers.log_assist_response_without_audio(resp)
+            if resp.screen_out.data:
+                html_response = resp.screen_out.data
+            if resp.dialog_state_out.conversation_state:
+                conversation_state = resp.dialog_state_out.conversation_state
+                self.conversation_state = conversation_state
+            if resp.dialog_state_out.supplemental_display_text:
+                text_response = resp.dialog_state_out.supplemental_display_text
+        return text_response, html_response
+
+
+class NullSink(object):
+    """Audio sink discarding all data."""
+    async def write(self, buf):
+        return len(buf)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@click.command()
+@click.option('--api-endpoint', default=ASSISTANT_API_ENDPOINT,
+              metavar='<api endpoint>', show_default=True,
+              help='Address of Google Assistant API service.')
+@click.option('--credentials',
+              metavar='<credentials>', show_default=True,
+              default=os.path.join(click.get_app_dir('google-oauthlib-tool'),
+                                   'credentials.json'),
+              help='Path to read OAuth2 credentials.')
+@click.option('--device-model-id', required=True,
+              metavar='<device model id>',
+              help='Unique device model identifier.')
+@click.option('--device-id', required=True,
+              metavar='<device id>',
+              help='Unique registered device instance identifier.')
+@click.option('--lang', show_default=True,
+              metavar='<language code>',
+              default='en-US',
+              help='Language code of the Assistant.')
+@click.option('--verbose', '-v', is_flag=True, default=False,
+              help='Verbose logging.')
+@click.option('--input-audio-file', '-i', multiple=True,
+              metavar='<input file>',
+              help='Path to input audio file, can be repeated.')
+@click.option('--input-audio-mmap', is_flag=True, default=False,
+              help=('Memory-map the input audio files instead of reading '
+                    'them through file objects.'))
+@click.option('--input-pacing', default='realtime',
+              type=audio_helpers.PACING, metavar='<pacing>',
+              show_default=True,
+              help=('Pacing of input audio file reads: realtime, a speed '
+                    'factor such as 4x, or burst.'))
+@click.option('--trailing-silence-ms', type=int, metavar='<milliseconds>',
+              help=('Silence sent after the end of the input audio file '
+                    'before ending the request, 0 ends it at the end of '
+                    'file. If missing, silence is sent until the end of '
+                    'the utterance is detected.'))
+@click.option('--text-query', '-q', multiple=True,
+              metavar='<text query>',
+              help='Text query, can be repeated.')
+@click.option('--audio-sample-rate',
+              default=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+              metavar='<audio sample rate>', show_default=True,
+              help='Audio sample rate in hertz.')
+@click.option('--audio-sample-width',
+              default=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+              metavar='<audio sample width>', show_default=True,
+              help='Audio sample width in bytes.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+@click.option('--grpc-deadline', default=DEFAULT_GRPC_DEADLINE,
+              metavar='<grpc deadline>', show_default=True,
+              help='gRPC deadline in seconds')
+def main(api_endpoint, credentials, device_model_id, device_id, lang,
+         verbose, input_audio_file, input_audio_mmap, input_pacing,
+         trailing_silence_ms, text_query,
+         audio_sample_rate, audio_sample_width, audio_iter_size,
+         grpc_deadline, *args, **kwargs):
+    """Send concurrent requests to the Google Assistant API.
+
+    All the audio files and text queries are sent concurrently from a
+    single event loop, the audio responses are discarded.
+
+    Examples:
+      $ python -m aioassistant -i in1.wav -i in2.wav -q 'what time is it'
+    """
+    # Setup logging.
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+
+    # Load OAuth 2.0 credentials.
+    try:
+        with open(credentials, 'r') as f:
+            credentials = google.oauth2.credentials.Credentials(token=None,
+                                                                **json.load(f))
+            http_request = google.auth.transport.requests.Request()
+            credentials.refresh(http_request)
+    except Exception as e:
+        logging.error('Error loading credentials: %s', e)
+        logging.error('Run google-oauthlib-tool to initialize '
+                      'new OAuth 2.0 credentials.')
+        sys.exit(-1)
+
+    device_handler = AsyncDeviceRequestHandler(device_id)
+
+    async def run():
+        grpc_channel = secure_authorized_channel(credentials, http_request,
+                                                 api_endpoint)
+        logging.info('Connecting to %s', api_endpoint)
+
+        async def assist_audio(path):
+            if input_audio_mmap:
+                source = AsyncMappedWaveSource(
+                    path, sample_rate=audio_sample_rate,
+                    sample_width=audio_sample_width, pacing=input_pacing,
+                    trailing_silence_ms=trailing_silence_ms)
+            else:
+                source = AsyncWaveSource(
+                    open(path, 'rb'), sample_rate=audio_sample_rate,
+                    sample_width=audio_sample_width, pacing=input_pacing,
+                    trailing_silence_ms=trailing_silence_ms)
+            conversation_stream = AsyncConversationStream(
+                source=source,
+                sink=NullSink(),
+                iter_size=audio_iter_size,
+                sample_width=audio_sample_width,
+            )
+            async with AsyncSampleAssistant(lang, device_model_id, device_id,
+                                            conversation_stream, False,
+                                            grpc_channel, grpc_deadline,
+                                            device_handler) as assistant:
+                await assistant.assist()
+
+        async def assist_text(query):
+            async with AsyncSampleTextAssistant(lang, device_model_id,
+                                                device_id, False,
+                                                grpc_channel,
+                                                grpc_deadline) as assistant:
+                response_text, _ = await assistant.assist(text_query=query)
+                click.echo('<you> %s' % query)
+                if response_text:
+                    click.echo('<@assistant> %s' % response_text)
+
+        async with grpc_channel:
+            await asyncio.gather(*([assist_audio(p)
+                                    for p in input_audio_file] +
+                                   [assist_text(q) for q in text_query]))
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the threaded and asyncio clients (Python >= 3.7)."""
+
+import asyncio
+import io
+import threading
+import timeit
+
+import click
+import grpc
+
+try:
+    from . import (
+        aioassistant,
+        audio_helpers,
+        benchmark,
+        device_helpers,
+        fakeassistant,
+        pushtotalk
+    )
+except (SystemError, ImportError):
+    import aioassistant
+    import audio_helpers
+    import benchmark
+    import device_helpers
+    import fakeassistant
+    import pushtotalk
+
+
+@click.command()
+@click.option('--streams', default=100,
+              metavar='<streams>', show_default=True,
+              help='Number of concurrent Assist streams.')
+@click.option('--audio-seconds', default=1.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of each audio request.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+def main(streams, audio_seconds, audio_iter_size):
+    """Compare threaded and asyncio clients against a fake server.
+
+    Streams per core is the number of concurrent streams a single fully
+    busy core sustains: streams * wall time / CPU time.
+    """
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    data = benchmark.wav_bytes(audio_seconds, sample_rate, sample_width)
+    servicer_kwargs = {
+        'end_of_utterance_size': int(audio_seconds * sample_rate *
+                                     sample_width),
+    }
+
+    def run_threads(address):
+        channel = grpc.insecure_channel(address)
+        device_handler = device_helpers.DeviceRequestHandler('device-id')
+
+        def assist():
+            stream = audio_helpers.ConversationStream(
+                source=audio_helpers.WaveSource(io.BytesIO(data),
+                                                sample_rate, sample_width),
+                sink=benchmark.NullSink(), iter_size=audio_iter_size,
+                sample_width=sample_width)
+            assistant = pushtotalk.SampleAssistant(
+                'en-US', 'device-model-id', 'device-id', stream, False,
+                channel, pushtotalk.DEFAULT_GRPC_DEADLINE, device_handler)
+            assistant.assist()
+        threads = [threading.Thread(target=assist) for _ in range(streams)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        channel.close()
+
+    async def run_aio(address):
+        device_handler = aioassistant.AsyncDeviceRequestHandler('device-id')
+        async with grpc.aio.insecure_channel(address) as channel:
+            async def assist():
+                stream = aioassistant.AsyncConversationStream(
+                    source=aioassistant.AsyncWaveSource(
+                        io.BytesIO(data), sample_rate, sample_width),
+                    sink=aioassistant.NullSink(),
+                    iter_size=audio_iter_size, sample_width=sample_width)
+                assistant = aioassistant.AsyncSampleAssistant(
+                    'en-US', 'device-model-id', 'device-id', stream, False,
+                    channel, aioassistant.DEFAULT_GRPC_DEADLINE,
+                    device_handler)
+                await assistant.assist()
+            await asyncio.gather(*[assist() for _ in range(streams)])
+
+    click.echo('Running %d concurrent streams of %.1fs audio.' % (
+        streams, audio_seconds))
+    with fakeassistant.serve_in_subprocess(**servicer_kwargs) as address:
+        for name, fn in (('threads', lambda: run_threads(address)),
+                         ('asyncio', lambda: asyncio.run(run_aio(address)))):
+            start_wall = timeit.default_timer()
+            start_cpu = benchmark.cpu_time()
+            fn()
+            wall = timeit.default_timer() - start_wall
+            cpu = benchmark.cpu_time() - start_cpu
+            click.echo('%-24s %8.2fs wall %8.2fs cpu %10.1f streams per core'
+                       % (name, wall, cpu, streams * wall / cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,9 +14,13 @@
 
 """Helper functions for audio streams."""
 
-import array
+import fractions
+import json
 import logging
 import math
+import mmap
+import os
+import struct
 import time
 import threading
 import wave
@@ -24,71 +28,587 @@ import wave
 import click
 import sounddevice as sd
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from . import (
+        codec_helpers,
+        trace_helpers
+    )
+except (SystemError, ImportError):
+    import codec_helpers
+    import trace_helpers
+
 
 DEFAULT_AUDIO_SAMPLE_RATE = 16000
 DEFAULT_AUDIO_SAMPLE_WIDTH = 2
 DEFAULT_AUDIO_ITER_SIZE = 3200
 DEFAULT_AUDIO_DEVICE_BLOCK_SIZE = 6400
-DEFAULT_AUDIO_DEVICE_FLUSH_SIZE = 25600
+DEFAULT_AUDIO_DEVICE_FLUSH_SIZE = 0
+DEFAULT_JITTER_BUFFER_MS = 100
+DEFAULT_AUDIO_IN_MIN_CHUNK_SIZE = 640
+
+# Chunking policies of the recorded audio.
+FIXED_CHUNKS = 'fixed'
+GROWING_CHUNKS = 'growing'
+VAD_CHUNKS = 'vad'
+CHUNKING_POLICIES = (FIXED_CHUNKS, GROWING_CHUNKS, VAD_CHUNKS)
+
+# Input pacing policies, as speed factors relative to real time.
+REALTIME = 1.0
+BURST = 0
+
+# Little-endian signed integer formats for the supported sample widths.
+SAMPLE_WIDTH_DTYPES = {
+    2: '<i2',
+    4: '<i4',
+}
+
 
+def volume_scale(volume_percentage):
+    """Returns the amplitude scale factor for a volume percentage."""
+    return math.pow(2, 1.0*volume_percentage/100)-1
 
-def normalize_audio_buffer(buf, volume_percentage, sample_width=2):
+
+def normalize_audio_buffer(buf, volume_percentage, sample_width=2,
+                           in_place=False):
     """Adjusts the loudness of the audio data in the given buffer.
 
     Volume normalization is done by scaling the amplitude of the audio
     in the buffer by a scale factor of 2^(volume_percentage/100)-1.
     For example, 50% volume scales the amplitude by a factor of 0.414,
     and 75% volume scales the amplitude by a factor of 0.681.
-    For now we only sample_width 2.
+    Scaled samples saturate at the limits of the sample width.
+
+    The scaling is vectorized with NumPy when it is available and falls
+    back on a pure Python loop otherwise.
 
     Args:
-      buf: byte string containing audio data to normalize.
+      buf: bytes-like object containing audio data to normalize.
       volume_percentage: volume setting as an integer percentage (1-100).
-      sample_width: size of a single sample in bytes.
+      sample_width: size of a single sample in bytes (2 or 4).
+      in_place: scale the samples of buf (a writable buffer such as a
+        bytearray or memoryview) in place instead of returning a copy.
+
+    Returns: the normalized audio data, buf itself when in_place is set.
     """
-    if sample_width != 2:
+    if sample_width not in SAMPLE_WIDTH_DTYPES:
         raise Exception('unsupported sample width:', sample_width)
-    scale = math.pow(2, 1.0*volume_percentage/100)-1
-    # Construct array from bytes based on sample_width, multiply by scale
-    # and convert it back to bytes
-    arr = array.array('h', buf)
-    for idx in range(0, len(arr)):
-        arr[idx] = int(arr[idx]*scale)
-    buf = arr.tostring()
-    return buf
+    scale = volume_scale(volume_percentage)
+    if scale == 1.0:
+        return buf if in_place else memoryview(buf).tobytes()
+    if np is not None:
+        return _scale_samples_numpy(buf, scale, sample_width, in_place)
+    return _scale_samples_python(buf, scale, sample_width, in_place)
+
+
+def _scale_samples_numpy(buf, scale, sample_width, in_place):
+    dtype = np.dtype(SAMPLE_WIDTH_DTYPES[sample_width])
+    info = np.iinfo(dtype)
+    samples = _samples(buf, dtype)
+    if in_place and abs(scale) <= 1.0:
+        # Attenuation cannot overflow: scale without a temporary array,
+        # the unsafe cast truncates toward zero.
+        np.multiply(samples, scale, out=samples, casting='unsafe')
+        return buf
+    scaled = samples * scale
+    np.clip(scaled, info.min, info.max, out=scaled)
+    if in_place:
+        # Float to integer assignment truncates toward zero.
+        samples[:] = scaled
+        return buf
+    return scaled.astype(dtype).tobytes()
+
+
+# struct formats of the supported sample widths, little-endian like
+# SAMPLE_WIDTH_DTYPES.
+SAMPLE_WIDTH_STRUCT_CODES = {
+    2: 'h',
+    4: 'i',
+}
+
+
+def _scale_samples_python(buf, scale, sample_width, in_place):
+    fmt = '<%d%s' % (len(buf) // sample_width,
+                     SAMPLE_WIDTH_STRUCT_CODES[sample_width])
+    high = (1 << (8 * sample_width - 1)) - 1
+    low = -high - 1
+    samples = [max(low, min(high, int(sample * scale)))
+               for sample in struct.unpack_from(fmt, buf)]
+    if in_place:
+        struct.pack_into(fmt, buf, 0, *samples)
+        return buf
+    return struct.pack(fmt, *samples)
 
 
 def align_buf(buf, sample_width):
-    """In case of buffer size not aligned to sample_width pad it with 0s"""
+    """In case of buffer size not aligned to sample_width pad it with 0s.
+
+    Padding every misaligned chunk shifts the phase of the following
+    samples, ConversationStream carries partial samples over instead.
+    """
     remainder = len(buf) % sample_width
     if remainder != 0:
         buf += b'\0' * (sample_width - remainder)
     return buf
 
 
+def _byte_view(buf):
+    """Returns: a flat memoryview of buf in bytes."""
+    view = memoryview(buf)
+    if view.format != 'B' or view.ndim != 1:
+        # Python 2 views of bytes-like objects are already flat bytes.
+        view = view.cast('B')
+    return view
+
+
+def _release(view):
+    """Release a memoryview, Python 2 views cannot be released."""
+    if hasattr(view, 'release'):
+        view.release()
+
+
+def _samples(buf, dtype='<i2'):
+    """Returns: a NumPy array of the samples of buf sharing its memory.
+
+    Args:
+      buf: audio data, any object supporting the buffer protocol.
+      dtype: NumPy type of the samples.
+    """
+    try:
+        return np.frombuffer(buf, dtype=dtype)
+    except AttributeError:
+        # NumPy on Python 2 cannot wrap a memoryview with frombuffer.
+        return np.asarray(_byte_view(buf)).view(dtype)
+
+
+class PlaybackBuffer(object):
+    """Reusable buffer staging audio data on its way to a sink.
+
+    Each chunk is copied once into a preallocated bytearray, where it
+    can be processed in place, and handed to the sink as a memoryview.
+    Trailing bytes of a sample split across chunks are carried over to
+    the next chunk instead of being padded.
+
+    Allocation and copy counters are kept to measure the pipeline.
+
+    Args:
+      sample_width: size of a single sample in bytes.
+      size: initial capacity in bytes, grown on demand.
+    """
+    def __init__(self, sample_width, size=DEFAULT_AUDIO_DEVICE_BLOCK_SIZE):
+        self._sample_width = sample_width
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._carry_start = 0
+        self._carry_size = 0
+        self.allocations = 1
+        self.copies = 0
+        self.bytes_copied = 0
+
+    def push(self, data):
+        """Stage data and return a memoryview of the whole samples.
+
+        The returned view is only valid until the next call to push.
+
+        Args:
+          data: bytes-like object containing audio data.
+        """
+        carry = self._carry_size
+        size = carry + len(data)
+        if size > len(self._buf):
+            self._grow(size)
+        elif carry:
+            start = self._carry_start
+            self._view[:carry] = self._view[start:start+carry]
+        self._view[carry:size] = data
+        self.copies += 1
+        self.bytes_copied += len(data)
+        aligned = size - size % self._sample_width
+        self._carry_start = aligned
+        self._carry_size = size - aligned
+        return self._view[:aligned]
+
+    def reset(self):
+        """Drop any carried over partial sample."""
+        self._carry_size = 0
+
+    def flush(self):
+        """Return the carried over partial sample padded with 0s.
+
+        Returns: a memoryview of a single sample, empty if there is no
+        pending partial sample.
+        """
+        carry = self._carry_size
+        if not carry:
+            return self._view[:0]
+        start = self._carry_start
+        self._view[:carry] = self._view[start:start+carry]
+        self._view[carry:self._sample_width] = (
+            b'\0' * (self._sample_width - carry))
+        self._carry_size = 0
+        return self._view[:self._sample_width]
+
+    @property
+    def pending(self):
+        """Number of bytes carried over to the next chunk."""
+        return self._carry_size
+
+    def _grow(self, size):
+        # Views handed out earlier may still reference the old buffer,
+        # so allocate a new one rather than resizing in place.
+        buf = bytearray(max(size, 2 * len(self._buf)))
+        view = memoryview(buf)
+        carry = self._carry_size
+        start = self._carry_start
+        view[:carry] = self._view[start:start+carry]
+        self._buf = buf
+        self._view = view
+        self.allocations += 1
+
+    @property
+    def stats(self):
+        """Dictionary of allocation and copy counters."""
+        return {
+            'allocations': self.allocations,
+            'copies': self.copies,
+            'bytes_copied': self.bytes_copied,
+        }
+
+
+class AudioRingBuffer(object):
+    """Fixed capacity buffer keeping the most recent audio data.
+
+    Args:
+      size: capacity in bytes.
+    """
+    def __init__(self, size):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._end = 0
+        self._filled = 0
+
+    def __len__(self):
+        return self._filled
+
+    @property
+    def capacity(self):
+        return len(self._buf)
+
+    def write(self, data):
+        """Append data, overwriting the oldest data when full.
+
+        Returns: the number of bytes written.
+        """
+        size = len(data)
+        capacity = len(self._buf)
+        if not capacity:
+            return size
+        data = _byte_view(data)
+        if size > capacity:
+            data = data[size - capacity:]
+        n = len(data)
+        first = min(n, capacity - self._end)
+        self._view[self._end:self._end + first] = data[:first]
+        self._view[:n - first] = data[first:]
+        self._end = (self._end + n) % capacity
+        self._filled = min(self._filled + n, capacity)
+        return size
+
+    def latest(self, size=None):
+        """Returns: the most recent size bytes, all of them if None."""
+        size = self._filled if size is None else min(size, self._filled)
+        start = (self._end - size) % len(self._buf) if size else self._end
+        if start + size <= len(self._buf):
+            return self._view[start:start + size].tobytes()
+        return (self._view[start:].tobytes() +
+                self._view[:self._end].tobytes())
+
+    def clear(self):
+        """Drop all the buffered data."""
+        self._end = 0
+        self._filled = 0
+
+
+class Resampler(object):
+    """Streaming polyphase resampler for 16-bit audio.
+
+    The rate conversion is the rational up/down ratio of the two rates,
+    filtered by a Kaiser windowed sinc split into up phases. Output
+    samples are computed in vectorized batches: each one is the dot
+    product of a phase with the most recent input samples. The last
+    input samples are kept across calls, so that chunks can be
+    converted independently without discontinuities.
+
+    Args:
+      in_rate: input sample rate in hertz.
+      out_rate: output sample rate in hertz.
+      zero_crossings: half length of the filter in zero crossings of
+        the lower rate, higher is sharper and slower.
+      cutoff: filter cutoff as a fraction of the lower Nyquist rate.
+    """
+    def __init__(self, in_rate, out_rate, zero_crossings=16, cutoff=0.9):
+        if np is None:
+            raise Exception('NumPy is required for resampling')
+        rates = fractions.Fraction(out_rate, in_rate)
+        self.up = rates.numerator
+        self.down = rates.denominator
+        ratio = max(self.up, self.down)
+        # Taps per phase, input samples used for each output sample.
+        self.taps = int(math.ceil(2.0 * zero_crossings * ratio / self.up))
+        t = np.arange(self.taps * self.up) - (self.taps * self.up - 1) / 2.0
+        fc = cutoff / (2.0 * ratio)
+        h = (2 * fc * np.sinc(2 * fc * t) *
+             np.kaiser(len(t), 8.0) * self.up)
+        # Phase p holds h[p], h[p + up], ... applied to the latest input
+        # sample first.
+        self._phases = h.reshape(self.taps, self.up).T.copy()
+        self.reset()
+
+    def reset(self):
+        """Forget the previous input."""
+        self._history = np.zeros(self.taps - 1)
+        self._received = 0
+        self._produced = 0
+
+    @property
+    def delay(self):
+        """Delay of the output in seconds of input samples."""
+        return (self.taps * self.up - 1) / 2.0 / self.up
+
+    def output_size(self, size):
+        """Returns: number of output samples for size more input samples."""
+        return (-(-(self._received + size) * self.up // self.down) -
+                self._produced)
+
+    def process(self, buf):
+        """Resample int16 samples.
+
+        Args:
+          buf: int16 audio samples, any object supporting the buffer
+            protocol.
+
+        Returns: bytes of the resampled audio available so far.
+        """
+        samples = _samples(buf)
+        start = self._received - len(self._history)
+        x = np.concatenate((self._history, samples))
+        count = self.output_size(len(samples))
+        self._received += len(samples)
+        self._history = x[len(x) - len(self._history):]
+        if count <= 0:
+            return b''
+        n = self._produced + np.arange(count)
+        position = n * self.down
+        phase = position % self.up
+        latest = position // self.up - start
+        self._produced += count
+        window = x[latest[:, None] - np.arange(self.taps)]
+        out = np.einsum('ij,ij->i', window, self._phases[phase])
+        # Keep the counters small.
+        whole = min(self._received // self.down, self._produced // self.up)
+        self._received -= whole * self.down
+        self._produced -= whole * self.up
+        return np.clip(np.round(out), -32768, 32767).astype('<i2').tobytes()
+
+
+def parse_pacing(value):
+    """Parse an input pacing policy.
+
+    Args:
+      value: 'realtime', 'burst' or a speed factor such as '4x'.
+
+    Returns: the speed factor, REALTIME or BURST.
+    """
+    if value == 'realtime':
+        return REALTIME
+    if value == 'burst':
+        return BURST
+    try:
+        speed = float(value[:-1] if value.endswith('x') else value)
+    except ValueError:
+        raise ValueError('invalid pacing: %s' % value)
+    if speed < 0:
+        raise ValueError('invalid pacing: %s' % value)
+    return speed
+
+
+class PacingParamType(click.ParamType):
+    """Click parameter type of input pacing policies."""
+    name = 'pacing'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, float):
+            return value
+        try:
+            return parse_pacing(value)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+
+PACING = PacingParamType()
+
+
+class Pacer(object):
+    """Schedules reads of audio chunks at a multiple of real time.
+
+    Each chunk is due when the previous one would have finished playing
+    at the given speed. Deadlines are computed from a monotonic clock and
+    from the previous deadline rather than from the time of the read, so
+    that scheduling delays do not accumulate.
+
+    Args:
+      speed: speed factor relative to real time, BURST disables pacing.
+      clock: function returning the current time in seconds, defaults to
+        time.monotonic (time.time on Python 2).
+    """
+    def __init__(self, speed=REALTIME, clock=None):
+        self.speed = speed
+        self._clock = clock or getattr(time, 'monotonic', time.time)
+        self._deadline = None
+
+    def schedule(self, duration):
+        """Schedule a chunk of audio.
+
+        Args:
+          duration: seconds of audio in the chunk.
+
+        Returns: seconds to wait before the chunk is due.
+        """
+        if not self.speed:
+            return 0
+        now = self._clock()
+        if self._deadline is None or self._deadline < now:
+            # First chunk, or the reader fell behind: do not burst to
+            # catch up.
+            self._deadline = now
+        wait = self._deadline - now
+        self._deadline += duration / self.speed
+        return wait
+
+
+class AudioChunker(object):
+    """Byte accurate chunking of audio reads.
+
+    Sound devices and WAV files are read in frames, while audio sources
+    are read in bytes: the chunker converts between the two, carrying
+    any partial frame over to the next read, and accounts for the audio
+    returned by the source.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      read_frames: optional function reading up to a number of frames,
+        returning bytes, used by read.
+      trailing_silence_ms: milliseconds of silence returned by
+        trailing_silence after the end of the stream, None for unlimited.
+    """
+    def __init__(self, sample_rate, sample_width, read_frames=None,
+                 trailing_silence_ms=None):
+        self.sample_rate = sample_rate
+        self.frame_size = sample_width
+        self._read_frames = read_frames
+        self._carry = b''
+        self._silence = b''
+        self._silence_left = None
+        if trailing_silence_ms is not None:
+            self._silence_left = (int(sample_rate * trailing_silence_ms /
+                                      1000.0) * sample_width)
+        self.chunks = 0
+        self.bytes = 0
+
+    def duration(self, size):
+        """Returns: the duration in seconds of size bytes of audio."""
+        return size / float(self.frame_size * self.sample_rate)
+
+    def read(self, size):
+        """Read size bytes of audio, fewer at the end of the stream."""
+        frames = -(-(size - len(self._carry)) // self.frame_size)
+        data = self._carry
+        if frames > 0:
+            data += self._read_frames(frames)
+        data, self._carry = data[:size], data[size:]
+        return data
+
+    def silence(self, size):
+        """Returns: size bytes of silence, reused while size is unchanged."""
+        if size != len(self._silence):
+            self._silence = b'\0' * size
+        return self._silence
+
+    def trailing_silence(self, size):
+        """Read past the end of the stream.
+
+        Returns: up to size bytes of silence, empty once the trailing
+        silence budget is spent.
+        """
+        if self._silence_left is None:
+            return self.silence(size)
+        size = min(size, self._silence_left)
+        self._silence_left -= size
+        return self.silence(size) if size else b''
+
+    def count(self, data):
+        """Account for a chunk returned by the source.
+
+        Returns: data.
+        """
+        self.chunks += 1
+        self.bytes += len(data)
+        return data
+
+    @property
+    def frames(self):
+        """Number of whole frames returned by the source."""
+        return self.bytes // self.frame_size
+
+    @property
+    def stats(self):
+        """Chunks, bytes, frames and seconds of audio returned."""
+        return {
+            'chunks': self.chunks,
+            'bytes': self.bytes,
+            'frames': self.frames,
+            'seconds': self.duration(self.bytes),
+        }
+
+
 class WaveSource(object):
     """Audio source that reads audio data from a WAV file.
 
-    Reads are throttled to emulate the given sample rate and silence
-    is returned when the end of the file is reached.
+    Reads are paced to emulate the given sample rate, or a multiple of it,
+    and silence is returned when the end of the file is reached.
 
     Args:
       fp: file-like stream object to read from.
       sample_rate: sample rate in hertz.
       sample_width: size of a single sample in bytes.
+      pacing: speed factor relative to real time, REALTIME emulates a
+        capture device and BURST reads as fast as possible.
+      trailing_silence_ms: milliseconds of silence returned after the end
+        of the file before reads return no data, None to return silence
+        until the source is closed and 0 to stop at the end of the file.
     """
-    def __init__(self, fp, sample_rate, sample_width):
+    def __init__(self, fp, sample_rate, sample_width, pacing=REALTIME,
+                 trailing_silence_ms=None):
         self._fp = fp
         try:
             self._wavep = wave.open(self._fp, 'r')
+            read_frames = self._wavep.readframes
         except wave.Error as e:
             logging.warning('error opening WAV file: %s, '
                             'falling back to RAW format', e)
             self._fp.seek(0)
             self._wavep = None
+            read_frames = self._read_raw_frames
         self._sample_rate = sample_rate
         self._sample_width = sample_width
-        self._sleep_until = 0
+        self._chunker = AudioChunker(sample_rate, sample_width, read_frames,
+                                     trailing_silence_ms)
+        self._pacer = Pacer(pacing)
 
     def read(self, size):
         """Read bytes from the stream and block until sample rate is achieved.
@@ -96,18 +616,20 @@ class WaveSource(object):
         Args:
           size: number of bytes to read from the stream.
         """
-        now = time.time()
-        missing_dt = self._sleep_until - now
-        if missing_dt > 0:
-            time.sleep(missing_dt)
-        self._sleep_until = time.time() + self._sleep_time(size)
-        data = (self._wavep.readframes(size)
-                if self._wavep
-                else self._fp.read(size))
+        wait = self._pacer.schedule(self._sleep_time(size))
+        if wait > 0:
+            time.sleep(wait)
+        return self._read(size)
+
+    def _read(self, size):
+        data = self._chunker.read(size)
         #  When reach end of audio stream, pad remainder with silence (zeros).
         if not data:
-            return b'\x00' * size
-        return data
+            data = self._chunker.trailing_silence(size)
+        return self._chunker.count(data)
+
+    def _read_raw_frames(self, frames):
+        return self._fp.read(frames * self._sample_width)
 
     def close(self):
         """Close the underlying stream."""
@@ -116,9 +638,166 @@ class WaveSource(object):
         self._fp.close()
 
     def _sleep_time(self, size):
-        sample_count = size / float(self._sample_width)
-        sample_rate_dt = sample_count / float(self._sample_rate)
-        return sample_rate_dt
+        return self._chunker.duration(size)
+
+    @property
+    def stats(self):
+        """Chunks, bytes, frames and seconds of audio read."""
+        return self._chunker.stats
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+
+def parse_wave_header(buf):
+    """Locate the audio data of a WAV file.
+
+    Args:
+      buf: contents of the file, any object supporting the buffer protocol.
+
+    Returns: (offset, size, params) tuple of the audio data offset and size
+    in bytes and of the (channels, sample_rate, sample_width) format of
+    the file.
+
+    Raises:
+      ValueError: buf is not a valid PCM WAV file.
+    """
+    buf = memoryview(buf)
+    if buf[:4].tobytes() != b'RIFF' or buf[8:12].tobytes() != b'WAVE':
+        raise ValueError('missing RIFF/WAVE header')
+    params = None
+    offset = 12
+    while offset + 8 <= len(buf):
+        chunk_id = buf[offset:offset + 4].tobytes()
+        chunk_size, = struct.unpack('<I', buf[offset + 4:offset + 8])
+        offset += 8
+        if chunk_id == b'fmt ':
+            if chunk_size < 16:
+                raise ValueError('invalid fmt chunk')
+            (audio_format, channels, sample_rate,
+             _, _, bits) = struct.unpack('<HHIIHH', buf[offset:offset + 16])
+            if audio_format != 1:
+                raise ValueError('unsupported WAV format: %d' % audio_format)
+            params = (channels, sample_rate, bits // 8)
+        elif chunk_id == b'data':
+            if params is None:
+                raise ValueError('data chunk before fmt chunk')
+            # Streamed WAV files may not have a valid data chunk size.
+            return offset, min(chunk_size, len(buf) - offset), params
+        offset += chunk_size + (chunk_size & 1)
+    raise ValueError('missing data chunk')
+
+
+class MappedWaveSource(object):
+    """Audio source that serves audio data from a memory-mapped file.
+
+    The WAV header is parsed once and reads return zero-copy memoryview
+    slices of the mapped audio data, so that sessions replaying the same
+    file share the page cache instead of holding copies on the heap.
+    Files without a WAV header are read as RAW audio data. Reads are
+    paced like WaveSource reads and silence is returned when the end of
+    the file is reached.
+
+    Args:
+      path: path of the WAV or RAW file.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      pacing: speed factor relative to real time, REALTIME emulates a
+        capture device and BURST reads as fast as possible.
+      trailing_silence_ms: milliseconds of silence returned after the end
+        of the file before reads return no data, None to return silence
+        until the source is closed and 0 to stop at the end of the file.
+    """
+    def __init__(self, path, sample_rate, sample_width, pacing=REALTIME,
+                 trailing_silence_ms=None):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self._mmap = mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                # Empty files cannot be mapped.
+                self._mmap = b''
+        try:
+            data = memoryview(self._mmap)
+        except TypeError:
+            # Python 2 maps do not support memoryviews: serve a copy.
+            data = memoryview(self._mmap[:])
+            self._mmap.close()
+        try:
+            offset, size, params = parse_wave_header(data)
+            if params != (1, sample_rate, sample_width):
+                logging.warning('WAV file format %s does not match the '
+                                'audio configuration %s',
+                                params, (1, sample_rate, sample_width))
+            self._data = data[offset:offset + size]
+            _release(data)
+        except ValueError as e:
+            logging.warning('error opening WAV file: %s, '
+                            'falling back to RAW format', e)
+            self._data = data
+        self._offset = 0
+        self._sample_rate = sample_rate
+        self._sample_width = sample_width
+        self._chunker = AudioChunker(sample_rate, sample_width,
+                                     trailing_silence_ms=trailing_silence_ms)
+        self._pacer = Pacer(pacing)
+
+    def read(self, size):
+        """Read bytes from the file and block until sample rate is achieved.
+
+        Args:
+          size: number of bytes to read from the file.
+
+        Returns: a memoryview of the file valid until close, or silence
+        past the end of the file.
+        """
+        wait = self._pacer.schedule(self._sleep_time(size))
+        if wait > 0:
+            time.sleep(wait)
+        return self._read(size)
+
+    def _read(self, size):
+        data = self._data[self._offset:self._offset + size]
+        self._offset += len(data)
+        #  When reach end of audio stream, pad remainder with silence (zeros).
+        if not data:
+            data = self._chunker.trailing_silence(size)
+        return self._chunker.count(data)
+
+    def tell(self):
+        """Returns: the number of audio data bytes read."""
+        return self._offset
+
+    def __len__(self):
+        return len(self._data)
+
+    def close(self):
+        """Unmap the file.
+
+        The mapping is only released once all the returned slices are.
+        """
+        _release(self._data)
+        if isinstance(self._mmap, mmap.mmap):
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Slices are still referenced and keep the mapping alive.
+                pass
+
+    def _sleep_time(self, size):
+        return self._chunker.duration(size)
+
+    @property
+    def stats(self):
+        """Chunks, bytes, frames and seconds of audio read."""
+        return self._chunker.stats
 
     def start(self):
         pass
@@ -178,40 +857,158 @@ class SoundDeviceStream(object):
       sample_rate: sample rate in hertz.
       sample_width: size of a single sample in bytes.
       block_size: size in bytes of each read and write operation.
-      flush_size: size in bytes of silence data written during flush operation.
+      flush_size: deprecated and ignored, flush waits for the written
+        audio to play instead of writing silence.
+      always_open: keep the device running when stopped, until closed.
+      device_sample_rate: sample rate of the device in hertz, when it
+        differs from sample_rate the audio is resampled (requires NumPy).
+      tracer: optional trace_helpers.TurnTracer counting the device
+        overflows and underflows.
     """
-    def __init__(self, sample_rate, sample_width, block_size, flush_size):
+    def __init__(self, sample_rate, sample_width, block_size, flush_size,
+                 always_open=False, device_sample_rate=None, tracer=None):
         if sample_width == 2:
             audio_format = 'int16'
         else:
             raise Exception('unsupported sample width:', sample_width)
-        self._audio_stream = sd.RawStream(
-            samplerate=sample_rate, dtype=audio_format, channels=1,
-            blocksize=int(block_size/2),  # blocksize is in number of frames.
-        )
+        device_sample_rate = device_sample_rate or sample_rate
+        self._capture_resampler = self._playback_resampler = None
+        if device_sample_rate != sample_rate:
+            self._capture_resampler = Resampler(device_sample_rate,
+                                                sample_rate)
+            self._playback_resampler = Resampler(sample_rate,
+                                                 device_sample_rate)
+            # Block size keeps its duration.
+            block_size = (block_size // sample_width * device_sample_rate //
+                          sample_rate * sample_width)
+        self._device_sample_rate = device_sample_rate
+        self._device_bytes_per_second = device_sample_rate * sample_width
+        self._playout_end = 0
+        self._clock = getattr(time, 'monotonic', time.time)
+        self._tracer = tracer or trace_helpers.NullTracer()
+        self._xruns = {'overflows': 0, 'underflows': 0}
+        self._reported_xruns = dict(self._xruns)
+        self._audio_stream = self._open_stream(
+            device_sample_rate, audio_format,
+            int(block_size/2))  # blocksize is in number of frames.
         self._block_size = block_size
-        self._flush_size = flush_size
+        if flush_size:
+            logging.warning('Audio flush size is deprecated and ignored: '
+                            'flush waits for the written audio to play.')
         self._sample_rate = sample_rate
+        self._always_open = always_open
+        self._chunker = AudioChunker(sample_rate, sample_width,
+                                     self._read_frames)
+
+    def _open_stream(self, sample_rate, dtype, blocksize):
+        return sd.RawStream(samplerate=sample_rate, dtype=dtype, channels=1,
+                            blocksize=blocksize)
 
     def read(self, size):
         """Read bytes from the stream."""
-        buf, overflow = self._audio_stream.read(size)
+        data = self._chunker.count(self._chunker.read(size))
+        self._report_xruns()
+        return data
+
+    def _report_xruns(self):
+        # Counters may be updated by the audio callback: only the thread
+        # reporting them reads them.
+        for name, metric in (
+                ('overflows', trace_helpers.AUDIO_OVERFLOWS_METRIC),
+                ('underflows', trace_helpers.AUDIO_UNDERFLOWS_METRIC)):
+            count = self._xruns[name]
+            if count != self._reported_xruns[name]:
+                self._tracer.increment(metric,
+                                       count - self._reported_xruns[name])
+                self._reported_xruns[name] = count
+
+    def _read_frames(self, frames):
+        if not self._capture_resampler:
+            return self._read_device_frames(frames)
+        data = b''
+        while len(data) < frames * 2:
+            needed = frames - len(data) // 2
+            device_frames = -(-needed * self._device_sample_rate //
+                              self._sample_rate)
+            data += self._capture_resampler.process(
+                self._read_device_frames(device_frames))
+            if not self._audio_stream.active:
+                # A stopped callback stream returns what was captured.
+                break
+        return data
+
+    def _read_device_frames(self, frames):
+        buf, overflow = self._audio_stream.read(frames)
         if overflow:
+            self._xruns['overflows'] += 1
             logging.warning('SoundDeviceStream read overflow (%d, %d)',
-                            size, len(buf))
+                            frames, len(buf))
         return bytes(buf)
 
+    @property
+    def stats(self):
+        """Chunks, bytes, frames and seconds of audio read, device
+        overflows and underflows."""
+        return dict(self._chunker.stats, **self._xruns)
+
     def write(self, buf):
         """Write bytes to the stream."""
+        size = len(buf)
+        if self._playback_resampler:
+            buf = self._playback_resampler.process(buf)
+        self._write_device(buf)
+        self._report_xruns()
+        return size
+
+    def _write_device(self, buf):
         underflow = self._audio_stream.write(buf)
+        self._queue()
         if underflow:
+            self._xruns['underflows'] += 1
             logging.warning('SoundDeviceStream write underflow (size: %d)',
                             len(buf))
-        return len(buf)
+
+    def _queued_seconds(self):
+        # A blocking write returns once the audio is in the device buffer,
+        # which holds about the output latency: the audio not played yet
+        # is the part of it not available for writes.
+        available = (self._audio_stream.write_available /
+                     float(self._device_sample_rate))
+        return max(0.0, self.output_latency - available)
+
+    def _queue(self):
+        # Time at which the audio written so far is played.
+        self._playout_end = self._clock() + self._queued_seconds()
+
+    @property
+    def input_latency(self):
+        """Input latency reported by the device in seconds."""
+        latency = self._audio_stream.latency
+        if isinstance(latency, (tuple, list)):
+            latency = latency[0]
+        return latency
+
+    @property
+    def output_latency(self):
+        """Output latency reported by the device in seconds."""
+        latency = self._audio_stream.latency
+        if isinstance(latency, (tuple, list)):
+            latency = latency[1]
+        return latency
+
+    def _drain(self):
+        remaining = self._playout_end - self._clock()
+        if remaining > 0:
+            time.sleep(remaining)
 
     def flush(self):
-        if self._audio_stream.active and self._flush_size > 0:
-            self._audio_stream.write(b'\x00' * self._flush_size)
+        """Wait for the written audio to be played.
+
+        Stopping the device plays the rest of its buffer: only a stream
+        kept open by always_open waits here.
+        """
+        if self._audio_stream.active and self._always_open:
+            self._drain()
 
     def start(self):
         """Start the underlying stream."""
@@ -220,13 +1017,22 @@ class SoundDeviceStream(object):
 
     def stop(self):
         """Stop the underlying stream."""
-        if self._audio_stream.active:
+        if self._audio_stream.active and not self._always_open:
             self._audio_stream.stop()
 
+    def abort(self):
+        """Stop waiting for the written audio, the capture keeps running.
+
+        The audio already written to the device still plays: a blocking
+        stream cannot drop it without aborting the capture too.
+        """
+        self._playout_end = 0
+
     def close(self):
         """Close the underlying stream and audio interface."""
         if self._audio_stream:
-            self.stop()
+            if self._audio_stream.active:
+                self._audio_stream.stop()
             self._audio_stream.close()
             self._audio_stream = None
 
@@ -235,6 +1041,560 @@ class SoundDeviceStream(object):
         return self._sample_rate
 
 
+class SpscRingBuffer(object):
+    """Preallocated single producer, single consumer byte ring.
+
+    The producer only advances the write position and the consumer the
+    read position, each after copying the data, so that one thread can
+    write while another one reads without locks.
+
+    Args:
+      size: capacity in bytes.
+    """
+    def __init__(self, size):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._read = 0
+        self._write = 0
+
+    @property
+    def capacity(self):
+        return len(self._buf)
+
+    @property
+    def available(self):
+        """Bytes that can be read."""
+        return self._write - self._read
+
+    @property
+    def free(self):
+        """Bytes that can be written."""
+        return len(self._buf) - self.available
+
+    def write(self, data):
+        """Write as much of data as fits, called by the producer.
+
+        Returns: the number of bytes written.
+        """
+        data = _byte_view(data)
+        size = min(len(data), self.free)
+        start = self._write % len(self._buf)
+        first = min(size, len(self._buf) - start)
+        self._view[start:start + first] = data[:first]
+        self._view[:size - first] = data[first:size]
+        self._write += size
+        return size
+
+    def read_into(self, out):
+        """Read up to len(out) bytes into out, called by the consumer.
+
+        Returns: the number of bytes read.
+        """
+        out = _byte_view(out)
+        size = min(len(out), self.available)
+        start = self._read % len(self._buf)
+        first = min(size, len(self._buf) - start)
+        out[:first] = self._view[start:start + first]
+        out[first:size] = self._view[:size - first]
+        self._read += size
+        return size
+
+    def read(self, size):
+        """Returns: up to size bytes, called by the consumer."""
+        out = bytearray(min(size, self.available))
+        self.read_into(out)
+        return bytes(out)
+
+    def clear(self):
+        """Drop the readable data, called by the consumer."""
+        self._read = self._write
+
+
+class CallbackSoundDeviceStream(SoundDeviceStream):
+    """Sound device stream exchanging audio with the device callback.
+
+    The device callback runs on the audio thread: it only copies the
+    captured audio to a capture ring and the played audio from a
+    playback ring, both preallocated SpscRingBuffer. Reads and writes
+    wait on the rings instead of blocking in the audio interface while
+    holding the interpreter, so that other threads, such as gRPC
+    serialization, do not delay the device.
+
+    The callback signals the waiting reads, writes and flushes through
+    events, and fills the output missing from the playback ring from a
+    preallocated silence buffer.
+
+    The callback counts a capture overflow when the capture ring is
+    full, and a playback underflow when the playback ring runs empty
+    before flush. It also keeps the stream times of the first captured
+    and played frames, see stream_times.
+
+    Args:
+      ring_ms: capacity of each ring in milliseconds of device audio.
+      See SoundDeviceStream for the other arguments.
+    """
+    def __init__(self, sample_rate, sample_width, block_size, flush_size,
+                 ring_ms=500, **kwargs):
+        device_sample_rate = kwargs.get('device_sample_rate') or sample_rate
+        ring_size = int(device_sample_rate * ring_ms / 1000) * sample_width
+        self._capture = SpscRingBuffer(ring_size)
+        self._playback = SpscRingBuffer(ring_size)
+        self._expect_output = False
+        self._drop_playback = False
+        self._capture_times = self._playback_times = None
+        self._silence = memoryview(bytearray(ring_size))
+        self._captured = threading.Event()
+        self._played = threading.Event()
+        # A stopped stream no longer calls back: waits time out to check.
+        self._wait_timeout = 0.05
+        super(CallbackSoundDeviceStream, self).__init__(
+            sample_rate, sample_width, block_size, flush_size, **kwargs)
+
+    def _open_stream(self, sample_rate, dtype, blocksize):
+        return sd.RawStream(samplerate=sample_rate, dtype=dtype, channels=1,
+                            blocksize=blocksize, callback=self._callback)
+
+    def _callback(self, indata, outdata, frames, time_info, status):
+        if (self._capture.write(indata) < len(indata) or
+                status.input_overflow):
+            self._xruns['overflows'] += 1
+        self._captured.set()
+        if self._drop_playback:
+            self._playback.clear()
+            self._drop_playback = False
+        out = _byte_view(outdata)
+        size = self._playback.read_into(out)
+        self._played.set()
+        if time_info is not None:
+            if self._capture_times is None:
+                self._capture_times = (time_info.currentTime,
+                                       time_info.inputBufferAdcTime)
+            if size and self._playback_times is None:
+                # The ring was empty: the written audio starts this block.
+                self._playback_times = (time_info.currentTime,
+                                        time_info.outputBufferDacTime)
+        gap = len(out) - size
+        if gap:
+            if gap > len(self._silence):
+                # Only blocks larger than the rings allocate, once.
+                self._silence = memoryview(bytearray(gap))
+            out[size:] = self._silence[:gap]
+            if self._expect_output:
+                self._xruns['underflows'] += 1
+
+    def _wait(self, event, done):
+        # Wait for done() or a stopped stream, woken up by the callback.
+        while not done() and self._audio_stream.active:
+            event.clear()
+            if not done():
+                event.wait(self._wait_timeout)
+
+    def _read_device_frames(self, frames):
+        size = frames * 2
+        self._wait(self._captured, lambda: self._capture.available >= size)
+        return self._capture.read(size)
+
+    def _write_device(self, buf):
+        if not self._expect_output:
+            self._playback_times = None
+        self._expect_output = True
+        buf = _byte_view(buf)
+        while len(buf):
+            written = self._playback.write(buf)
+            buf = buf[written:]
+            if len(buf):
+                if not self._audio_stream.active:
+                    # The callback stopped: drop the remaining audio.
+                    break
+                self._wait(self._played, lambda: self._playback.free)
+        self._queue()
+
+    @property
+    def stream_times(self):
+        """Stream times of the first frames through the callback.
+
+        Returns: (capture, playback) tuple of the (callback time, ADC time)
+          of the first frame captured since start and the (callback time,
+          DAC time) of the first frame played since the last flush, each
+          None until the callback reports it.
+        """
+        return self._capture_times, self._playback_times
+
+    def _queued_seconds(self):
+        # The playback ring, then the device buffer.
+        return (self._playback.available /
+                float(self._device_bytes_per_second) + self.output_latency)
+
+    def flush(self):
+        """Wait for the callback to take all the written audio.
+
+        Like SoundDeviceStream.flush, only a stream kept open by
+        always_open also waits for the device to play it.
+        """
+        self._expect_output = False
+        self._wait(self._played, lambda: not self._playback.available)
+        if self._audio_stream.active and self._always_open:
+            self._drain()
+        self._report_xruns()
+
+    def start(self):
+        """Start the underlying stream, dropping stale captured audio."""
+        if not self._audio_stream.active:
+            self._capture.clear()
+            self._capture_times = None
+            self._audio_stream.start()
+
+    def stop(self):
+        self._expect_output = False
+        super(CallbackSoundDeviceStream, self).stop()
+        self._report_xruns()
+
+    def abort(self):
+        """Discard the pending output, the capture keeps running."""
+        self._expect_output = False
+        self._playout_end = 0
+        # Only the callback consumes the playback ring: it drops it.
+        self._drop_playback = True
+        self._wait(self._played, lambda: not self._drop_playback)
+        if self._drop_playback:
+            self._playback.clear()
+            self._drop_playback = False
+
+
+class AlwaysOpenSource(object):
+    """Audio source capturing continuously from an open device.
+
+    Opening a sound device takes long enough to clip the beginning of a
+    request. This source starts the device once and keeps reading it
+    from a background thread: between recordings the audio goes into a
+    ring buffer of pre_roll_ms, and start() begins the recording with
+    that audio, so it starts in the past instead of after the device
+    startup latency.
+
+    Args:
+      source: audio source to capture from, usually a SoundDeviceStream
+        created with always_open.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      pre_roll_ms: audio preceding start() included in the recording.
+      chunk_size: size in bytes of each read from the source.
+      max_pending_ms: recorded audio kept when reads fall behind, older
+        audio is dropped.
+    """
+    def __init__(self, source, sample_rate, sample_width, pre_roll_ms,
+                 chunk_size=DEFAULT_AUDIO_ITER_SIZE, max_pending_ms=10000):
+        self._source = source
+        self._sample_rate = sample_rate
+        self._chunk_size = chunk_size
+        bytes_per_ms = sample_rate * sample_width / 1000.0
+        self._ring = AudioRingBuffer(
+            int(pre_roll_ms * bytes_per_ms) // sample_width * sample_width)
+        self._max_pending = int(max_pending_ms * bytes_per_ms)
+        self._pending = bytearray()
+        self._recording = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self.stats = {
+            'recordings': 0,
+            'pre_roll_bytes': 0,
+            'dropped_bytes': 0,
+        }
+        self._source.start()
+        self._thread = threading.Thread(target=self._capture)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _capture(self):
+        try:
+            while not self._closed:
+                data = self._source.read(self._chunk_size)
+                with self._cond:
+                    if not self._recording:
+                        self._ring.write(data)
+                        continue
+                    self._pending.extend(data)
+                    overflow = len(self._pending) - self._max_pending
+                    if overflow > 0:
+                        del self._pending[:overflow]
+                        self.stats['dropped_bytes'] += overflow
+                    self._cond.notify()
+        except Exception as e:
+            if not self._closed:
+                logging.error('Audio capture failed: %s', e)
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+    def start(self):
+        """Start recording, from pre_roll_ms in the past."""
+        with self._cond:
+            if self._recording:
+                return
+            self._pending = bytearray(self._ring.latest())
+            self._ring.clear()
+            self._recording = True
+            self.stats['recordings'] += 1
+            self.stats['pre_roll_bytes'] += len(self._pending)
+
+    def read(self, size):
+        """Read recorded bytes, blocking until size bytes are available.
+
+        Returns: less than size bytes only once the source is closed.
+        """
+        with self._cond:
+            while len(self._pending) < size and not self._closed:
+                self._cond.wait()
+            data = bytes(self._pending[:size])
+            del self._pending[:size]
+            return data
+
+    def stop(self):
+        """Stop recording, the device keeps filling the pre-roll."""
+        with self._cond:
+            self._recording = False
+            self._pending = bytearray()
+
+    def close(self):
+        """Stop capturing and close the source."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._source.close()
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+
+class JitterBuffer(object):
+    """Audio sink buffering bursty writes for a playback thread.
+
+    Writes return immediately. A playback thread waits for the buffer to
+    hold the target depth, then writes it to the sink in periods of
+    period_ms. When the buffer runs empty before the end of the audio
+    and the sink has played all the audio written to it (underflow),
+    playback waits for the target depth again.
+
+    The target depth adapts to the jitter of the writes: it covers the
+    largest lateness of recent writes relative to the audio already
+    written, grows by half after each underflow and otherwise shrinks
+    slowly back to the observed jitter.
+
+    Args:
+      sink: audio sink to play the audio, usually a SoundDeviceStream.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      target_ms: initial target depth in milliseconds.
+      min_ms: smallest target depth in milliseconds.
+      max_ms: largest target depth in milliseconds.
+      period_ms: duration of each write to the sink in milliseconds.
+      tracer: optional trace_helpers.TurnTracer receiving the underflow
+        count and buffer depth metrics.
+      clock: function returning the current time in seconds, defaults to
+        time.monotonic (time.time on Python 2).
+    """
+    # Writes whose lateness sets the target depth.
+    _LATENESS_WINDOW = 50
+
+    def __init__(self, sink, sample_rate, sample_width,
+                 target_ms=DEFAULT_JITTER_BUFFER_MS, min_ms=20, max_ms=1000,
+                 period_ms=20, tracer=None, clock=None):
+        self._sink = sink
+        self._bytes_per_second = sample_rate * sample_width
+        self._period = (int(sample_rate * period_ms / 1000) * sample_width)
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.target_ms = target_ms
+        self._tracer = tracer or trace_helpers.NullTracer()
+        self._clock = clock or getattr(time, 'monotonic', time.time)
+        self._cond = threading.Condition()
+        self._buf = bytearray()
+        self._thread = None
+        self.stats = {
+            'underflows': 0,
+            'max_depth_ms': 0,
+        }
+        self._reset()
+
+    def _reset(self):
+        self._buf = bytearray()
+        self._draining = False
+        self._aborted = False
+        self._prefilling = True
+        self._anchor = None
+        self._received = 0
+        self._lateness = []
+        # Time at which the sink has played the periods written to it.
+        self._playout_end = 0
+
+    @property
+    def depth_ms(self):
+        """Milliseconds of audio waiting to be played."""
+        return 1000.0 * len(self._buf) / self._bytes_per_second
+
+    def _observe_arrival(self, size):
+        # Lateness of the write relative to the earliest write, when the
+        # audio is sent at the playback rate. Writes ahead of the playback
+        # rate move the reference earlier.
+        arrival = (self._clock() -
+                   float(self._received) / self._bytes_per_second)
+        if self._anchor is None or arrival < self._anchor:
+            self._anchor = arrival
+        self._lateness.append(arrival - self._anchor)
+        self._received += size
+        del self._lateness[:-self._LATENESS_WINDOW]
+        jitter_ms = 1000 * max(self._lateness)
+        target_ms = max(self.min_ms, min(self.max_ms, jitter_ms))
+        if target_ms > self.target_ms:
+            self.target_ms = target_ms
+        else:
+            self.target_ms += 0.01 * (target_ms - self.target_ms)
+
+    def write(self, buf):
+        """Queue bytes for the playback thread."""
+        with self._cond:
+            self._buf.extend(buf)
+            self._observe_arrival(len(buf))
+            depth_ms = self.depth_ms
+            if depth_ms > self.stats['max_depth_ms']:
+                self.stats['max_depth_ms'] = depth_ms
+            self._cond.notify()
+        return len(buf)
+
+    def _next_period(self):
+        with self._cond:
+            while True:
+                if self._aborted:
+                    return None
+                if self._prefilling:
+                    if (self.depth_ms >= self.target_ms or
+                            (self._draining and self._buf)):
+                        self._prefilling = False
+                        continue
+                elif len(self._buf) >= self._period or (self._draining and
+                                                        self._buf):
+                    self._tracer.observe(
+                        trace_helpers.PLAYBACK_BUFFER_DEPTH_METRIC,
+                        self.depth_ms / 1000.0)
+                    data = bytes(self._buf[:self._period])
+                    del self._buf[:self._period]
+                    return data
+                elif not self._draining:
+                    remaining = self._playout_end - self._clock()
+                    if remaining > 0:
+                        # The sink is still playing: wait for more audio.
+                        self._cond.wait(remaining)
+                        continue
+                    self.stats['underflows'] += 1
+                    self._tracer.increment(
+                        trace_helpers.PLAYBACK_UNDERFLOWS_METRIC)
+                    self.target_ms = min(self.max_ms, self.target_ms * 1.5)
+                    logging.debug('Playback underflow, target depth %.0fms',
+                                  self.target_ms)
+                    self._prefilling = True
+                    continue
+                if self._draining and not self._buf:
+                    return None
+                self._cond.wait()
+
+    def _play(self):
+        while True:
+            data = self._next_period()
+            if data is None:
+                return
+            self._sink.write(data)
+            self._playout_end = (max(self._playout_end, self._clock()) +
+                                 float(len(data)) / self._bytes_per_second)
+
+    def start(self):
+        """Start the sink and the playback thread."""
+        with self._cond:
+            self._reset()
+        self._sink.start()
+        self._thread = threading.Thread(target=self._play)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _join(self):
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._tracer.set_gauge(trace_helpers.PLAYBACK_TARGET_DEPTH_METRIC,
+                               self.target_ms / 1000.0)
+
+    def _drain(self):
+        with self._cond:
+            self._draining = True
+            self._cond.notify()
+        self._join()
+
+    def flush(self):
+        """Play the buffered audio, then flush the sink."""
+        self._drain()
+        self._sink.flush()
+
+    def stop(self):
+        """Play the buffered audio, then stop the sink."""
+        self._drain()
+        self._sink.stop()
+
+    def abort(self):
+        """Stop playback immediately, discarding the buffered audio."""
+        with self._cond:
+            self._aborted = True
+            self._buf = bytearray()
+            self._cond.notify()
+        self._join()
+        getattr(self._sink, 'abort', self._sink.stop)()
+
+    def close(self):
+        self.abort()
+        self._sink.close()
+
+
+class GrowingChunkPolicy(object):
+    """Read sizes growing over each recording.
+
+    Small chunks at the start of an utterance reach the server sooner,
+    larger ones later reduce the number of messages and their framing
+    overhead. Each recorded chunk passed to update() grows the next one.
+
+    Args:
+      min_size: size in bytes of the first chunk.
+      max_size: size in bytes chunks grow to.
+      growth: size factor between consecutive chunks.
+      sample_width: size of a single sample in bytes, sizes are multiples
+        of it.
+    """
+    def __init__(self, min_size, max_size, growth=2, sample_width=2):
+        self.min_size = max(sample_width, min_size // sample_width *
+                            sample_width)
+        self.max_size = max(self.min_size, max_size // sample_width *
+                            sample_width)
+        self.growth = growth
+        self._sample_width = sample_width
+        self.reset()
+
+    def reset(self):
+        """Start again from min_size."""
+        self._size = self.min_size
+
+    def next_size(self):
+        """Returns: the size of the next chunk."""
+        return self._size
+
+    def update(self, chunk):
+        """Grow the next chunk after a recorded chunk.
+
+        An empty chunk, at the end of the recording, does not grow it.
+        """
+        if len(chunk):
+            grown = int(self._size * self.growth) // self._sample_width
+            self._size = min(self.max_size, grown * self._sample_width)
+
+
 class ConversationStream(object):
     """Audio stream that supports half-duplex conversation.
 
@@ -260,13 +1620,20 @@ class ConversationStream(object):
       sink: file-like stream object to write output audio bytes to.
       iter_size: read size in bytes for each iteration.
       sample_width: size of a single sample in bytes.
+      chunk_policy: optional GrowingChunkPolicy choosing the read size of
+        each iteration instead of iter_size.
     """
-    def __init__(self, source, sink, iter_size, sample_width):
+    def __init__(self, source, sink, iter_size, sample_width,
+                 chunk_policy=None):
         self._source = source
         self._sink = sink
         self._iter_size = iter_size
+        self._chunk_policy = chunk_policy
         self._sample_width = sample_width
         self._volume_percentage = 50
+        self._audio_out_encoding = codec_helpers.LINEAR16
+        self._decoder = None
+        self._playback_buffer = PlaybackBuffer(sample_width)
         self._stop_recording = threading.Event()
         self._source_lock = threading.RLock()
         self._recording = False
@@ -276,6 +1643,8 @@ class ConversationStream(object):
         """Start recording from the audio source."""
         self._recording = True
         self._stop_recording.clear()
+        if self._chunk_policy:
+            self._chunk_policy.reset()
         self._source.start()
 
     def stop_recording(self):
@@ -287,15 +1656,62 @@ class ConversationStream(object):
 
     def start_playback(self):
         """Start playback to the audio sink."""
-        self._playing = True
+        self._prepare_playback()
         self._sink.start()
 
     def stop_playback(self):
         """Stop playback from the audio sink."""
+        for data in self._playback_tail():
+            if len(data):
+                self._sink.write(data)
         self._sink.flush()
         self._sink.stop()
         self._playing = False
 
+    def _prepare_playback(self):
+        self._playback_buffer.reset()
+        if self._audio_out_encoding != codec_helpers.LINEAR16:
+            self._decoder = codec_helpers.create_audio_out_decoder(
+                self._audio_out_encoding, self.sample_rate,
+                self._sample_width)
+        self._playing = True
+
+    def _scaled(self, buf):
+        if len(buf):
+            normalize_audio_buffer(buf, self.volume_percentage,
+                                   self._sample_width, in_place=True)
+        return buf
+
+    def _playback_data(self, buf):
+        """Returns: the PCM data of buf to write to the sink, scaled in
+        place to the volume, empty while it is buffered.
+        """
+        if self._decoder:
+            buf = self._decoder.decode(buf)
+        return self._scaled(self._playback_buffer.push(buf))
+
+    def _playback_tail(self):
+        """Yields the PCM data left to write to the sink when playback
+        stops, each written before the next is produced.
+        """
+        if self._decoder:
+            yield self._scaled(self._playback_buffer.push(
+                self._decoder.flush()))
+            self._decoder = None
+        yield self._scaled(self._playback_buffer.flush())
+
+    def interrupt_playback(self):
+        """Stop playback immediately, discarding pending output.
+
+        The sink is aborted instead of stopped: a sound device shared
+        with the source keeps recording.
+        """
+        self._decoder = None
+        self._playback_buffer.reset()
+        # Sinks without pending output just stop.
+        getattr(self._sink, 'abort', self._sink.stop)()
+        self._playing = False
+
     @property
     def recording(self):
         return self._recording
@@ -313,18 +1729,39 @@ class ConversationStream(object):
     def volume_percentage(self, new_volume_percentage):
         self._volume_percentage = new_volume_percentage
 
+    @property
+    def audio_out_encoding(self):
+        """The encoding of the data passed to write.
+
+        Takes effect at the next start_playback.
+        """
+        return self._audio_out_encoding
+
+    @audio_out_encoding.setter
+    def audio_out_encoding(self, new_audio_out_encoding):
+        self._audio_out_encoding = new_audio_out_encoding
+
     def read(self, size):
         """Read bytes from the source (if currently recording).
         """
         with self._source_lock:
             return self._source.read(size)
 
+    @property
+    def playback_stats(self):
+        """Allocation and copy counters of the playback path."""
+        return self._playback_buffer.stats
+
     def write(self, buf):
         """Write bytes to the sink (if currently playing).
+
+        Compressed audio is first decoded to PCM. The PCM data is copied
+        once into the playback buffer, scaled in place and passed to the
+        sink as a memoryview.
         """
-        buf = align_buf(buf, self._sample_width)
-        buf = normalize_audio_buffer(buf, self.volume_percentage)
-        return self._sink.write(buf)
+        data = self._playback_data(buf)
+        written = self._sink.write(data) if len(data) else 0
+        return len(buf) if self._decoder else written
 
     def close(self):
         """Close source and sink."""
@@ -332,16 +1769,232 @@ class ConversationStream(object):
         self._sink.close()
 
     def __iter__(self):
-        """Returns a generator reading data from the stream."""
+        """Returns a generator reading data from the stream.
+
+        The generator ends when recording stops or the source has no more
+        data.
+        """
         while True:
             if self._stop_recording.is_set():
                 return
-            yield self.read(self._iter_size)
+            if self._chunk_policy:
+                data = self.read(self._chunk_policy.next_size())
+                self._chunk_policy.update(data)
+            else:
+                data = self.read(self._iter_size)
+            if not len(data):
+                return
+            yield data
 
     @property
     def sample_rate(self):
         return self._source._sample_rate
 
+    @property
+    def sample_width(self):
+        return self._sample_width
+
+
+DEFAULT_AUDIO_PROFILE = os.path.join(
+    click.get_app_dir('googlesamples-assistant'), 'audio_profile.json')
+AUDIO_PROFILE_KEYS = ('audio_block_size', 'audio_iter_size')
+CALIBRATION_BLOCK_SIZES = (0, 1600, 3200, 6400)
+CALIBRATION_ITER_SIZES = (1600, 3200)
+# Level of the calibration clicks, detected above half of it.
+_CLICK_LEVEL = 16384
+_CLICK_MS = 5
+
+
+def _click_signal(sample_rate, duration, click_times):
+    """Returns: int16 silence of duration seconds with clicks."""
+    size = int(sample_rate * duration)
+    buf = bytearray(size * 2)
+    click_size = sample_rate * _CLICK_MS // 1000
+    click = struct.pack('<h', _CLICK_LEVEL) * click_size
+    for t in click_times:
+        start = int(sample_rate * t)
+        end = min(start + click_size, size)
+        buf[start * 2:end * 2] = click[:(end - start) * 2]
+    return bytes(buf)
+
+
+def _find_click(buf, start=0):
+    """Returns: index of the first click sample from start, or None."""
+    buf = align_buf(buf, 2)
+    samples = struct.unpack('<%dh' % (len(buf) // 2), buf)
+    for i in range(start, len(samples)):
+        if abs(samples[i]) > _CLICK_LEVEL // 2:
+            return i
+    return None
+
+
+def measure_audio_device(device, sample_rate, iter_size, seconds=2,
+                         tail_seconds=1, clock=None):
+    """Measure the latencies of a sound device looped back to itself.
+
+    The device plays a click at the start and at the end of seconds of
+    silence, while recording. Its output must be routed to its input,
+    through an ALSA loopback or a virtual device. Reads and writes are
+    interleaved on the calling thread, as blocking streams do not
+    support concurrent reads and writes.
+
+    The latencies are taken from the stream times reported by the
+    device callback when the device has stream_times, like
+    CallbackSoundDeviceStream, and from the clock otherwise.
+
+    Args:
+      device: SoundDeviceStream with 16-bit samples.
+      sample_rate: sample rate of the device stream in hertz.
+      iter_size: size of each read and write in bytes.
+      seconds: duration of the played audio.
+      tail_seconds: duration recorded after the flush, longer than the
+        output latency.
+      clock: function returning the current time in seconds, defaults
+        to time.monotonic (time.time on Python 2).
+
+    Returns: dict of measurements, the round trip and loopback latencies
+      are None when the clicks are not recorded, the loopback latency
+      also without stream times.
+    """
+    clock = clock or getattr(time, 'monotonic', time.time)
+    signal = _click_signal(sample_rate, seconds,
+                           (0.1, seconds - 2 * _CLICK_MS / 1000.0))
+    stats = device.stats
+
+    start = clock()
+    device.start()
+    # Time to the first recorded frame, not to a full iter_size read.
+    captured = [device.read(2)]
+    capture_start_latency = clock() - start
+
+    write_start = clock()
+    for i in range(0, len(signal), iter_size):
+        device.write(signal[i:i + iter_size])
+        # Reads lag one write behind, so that the device does not run
+        # out of audio to play while waiting for recorded audio.
+        if i:
+            captured.append(device.read(iter_size))
+    flush_start = clock()
+    device.flush()
+    flush_seconds = clock() - flush_start
+    tail_end = clock() + tail_seconds
+    while clock() < tail_end:
+        captured.append(device.read(iter_size))
+    device.stop()
+
+    capture = b''.join(captured)
+    first = _find_click(capture)
+    last = None
+    round_trip_latency = loopback_latency = None
+    if first is not None:
+        # Skip the first click before looking for the last one.
+        last = _find_click(capture, first + sample_rate * _CLICK_MS // 500)
+        captured_at = first / float(sample_rate)
+        capture_times, playback_times = getattr(
+            device, 'stream_times', (None, None))
+        if capture_times and playback_times:
+            # Callback times from the callback playing the click to the
+            # callback recording it, and ADC time of the recorded click
+            # from the DAC time of the played click.
+            round_trip_latency = (capture_times[0] + captured_at -
+                                  playback_times[0] - 0.1)
+            loopback_latency = (capture_times[1] + captured_at -
+                                playback_times[1] - 0.1)
+        else:
+            # Recording starts with the stream and playback with the
+            # first write.
+            round_trip_latency = captured_at - 0.1 - (write_start - start)
+    new_stats = device.stats
+    return {
+        'capture_start_latency': capture_start_latency,
+        'round_trip_latency': round_trip_latency,
+        'loopback_latency': loopback_latency,
+        'output_latency': getattr(device, 'output_latency', None),
+        'flush_seconds': flush_seconds,
+        'truncated': first is not None and last is None,
+        'underflows_per_second': (
+            (new_stats['underflows'] - stats['underflows']) /
+            float(seconds)),
+        'overflows_per_second': (
+            (new_stats['overflows'] - stats['overflows']) /
+            float(seconds)),
+    }
+
+
+def calibrate_audio_device(open_device, sample_rate,
+                           block_sizes=CALIBRATION_BLOCK_SIZES,
+                           iter_sizes=CALIBRATION_ITER_SIZES,
+                           seconds=2, tail_seconds=1):
+    """Measure a looped back sound device across a grid of sizes.
+
+    Args:
+      open_device: function returning a new device stream for a block
+        size.
+      sample_rate: sample rate of the device stream in hertz.
+      block_sizes, iter_sizes: sizes to measure.
+      seconds: duration of the played audio for each measurement.
+      tail_seconds: duration recorded after each flush.
+
+    Returns: list of measurement dicts, with the sizes measured.
+    """
+    results = []
+    for block_size in block_sizes:
+        device = open_device(block_size)
+        try:
+            for iter_size in iter_sizes:
+                result = measure_audio_device(device, sample_rate,
+                                              iter_size, seconds,
+                                              tail_seconds)
+                result.update(audio_block_size=block_size,
+                              audio_iter_size=iter_size)
+                logging.info('Measured %s', result)
+                results.append(result)
+        finally:
+            device.close()
+    return results
+
+
+def select_audio_profile(results):
+    """Select the best sizes from calibration results.
+
+    Sizes without underflows and truncated audio are preferred, then the
+    lowest measured round trip latency, then the lowest capture start
+    latency.
+
+    Returns: dict of the selected sizes and their measurements.
+    """
+    best = min(results, key=lambda r: (
+        r['underflows_per_second'] > 0,
+        r['truncated'],
+        r['overflows_per_second'] > 0,
+        (float('inf') if r['round_trip_latency'] is None
+         else r['round_trip_latency']),
+        r['capture_start_latency']))
+    return dict(best)
+
+
+def save_audio_profile(profile, path):
+    """Write an audio profile as JSON."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+
+
+def load_audio_profile(path):
+    """Load the sizes of an audio profile.
+
+    Returns: dict of the AUDIO_PROFILE_KEYS found, empty if path is
+      missing.
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        profile = json.load(f)
+    logging.info('Loaded audio profile from %s', path)
+    return {k: profile[k] for k in AUDIO_PROFILE_KEYS if k in profile}
+
 
 @click.command()
 @click.option('--record-time', default=5,
@@ -367,20 +2020,83 @@ class ConversationStream(object):
 @click.option('--audio-flush-size',
               default=DEFAULT_AUDIO_DEVICE_FLUSH_SIZE,
               metavar='<audio flush size>', show_default=True,
-              help=('Size of silence data in bytes written '
-                    'during flush operation'))
+              help=('Deprecated and ignored: flush waits for the written '
+                    'audio to play.'))
+@click.option('--audio-device-sample-rate', type=int,
+              metavar='<audio device sample rate>',
+              help=('Sample rate of the audio device in hertz, resampled '
+                    'from and to --audio-sample-rate. If missing, uses '
+                    '--audio-sample-rate.'))
+@click.option('--audio-device-callback', is_flag=True, default=False,
+              help=('Exchange audio with the device from its callback '
+                    'through lock-free ring buffers.'))
+@click.option('--calibrate', is_flag=True, default=False,
+              help=('Measure the round trip latency, capture start latency '
+                    'and underflow rate of the sound device across a grid '
+                    'of block and iter sizes, and write the best sizes to '
+                    '--audio-profile. Route the device output to its input, '
+                    'with an ALSA loopback or a virtual device.'))
+@click.option('--calibrate-block-size', multiple=True, type=int,
+              default=CALIBRATION_BLOCK_SIZES,
+              metavar='<audio block size>', show_default=True,
+              help='Block size to calibrate, can be repeated.')
+@click.option('--calibrate-iter-size', multiple=True, type=int,
+              default=CALIBRATION_ITER_SIZES,
+              metavar='<audio iter size>', show_default=True,
+              help='Iter size to calibrate, can be repeated.')
+@click.option('--calibrate-seconds', default=2.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the audio played for each measurement.')
+@click.option('--audio-profile', default=DEFAULT_AUDIO_PROFILE,
+              metavar='<audio profile>', show_default=True,
+              help='Path to write the calibrated audio profile to.')
 def main(record_time, audio_sample_rate, audio_sample_width,
-         audio_iter_size, audio_block_size, audio_flush_size):
+         audio_iter_size, audio_block_size, audio_flush_size,
+         audio_device_sample_rate, audio_device_callback,
+         calibrate, calibrate_block_size, calibrate_iter_size,
+         calibrate_seconds, audio_profile):
     """Helper command to test audio stream processing.
 
     - Record 5 seconds of 16-bit samples at 16khz.
     - Playback the recorded samples.
+
+    With --calibrate, tune the audio sizes of a looped back device
+    instead.
     """
     end_time = time.time() + record_time
-    audio_device = SoundDeviceStream(sample_rate=audio_sample_rate,
-                                     sample_width=audio_sample_width,
-                                     block_size=audio_block_size,
-                                     flush_size=audio_flush_size)
+    audio_device_class = (CallbackSoundDeviceStream
+                          if audio_device_callback else SoundDeviceStream)
+    if calibrate:
+        logging.basicConfig(level=logging.INFO)
+        if audio_sample_width != 2:
+            raise click.BadParameter('calibration requires 16-bit samples')
+
+        def open_device(block_size):
+            return audio_device_class(
+                sample_rate=audio_sample_rate,
+                sample_width=audio_sample_width,
+                block_size=block_size,
+                flush_size=0,
+                device_sample_rate=audio_device_sample_rate)
+        results = calibrate_audio_device(
+            open_device, audio_sample_rate,
+            block_sizes=calibrate_block_size,
+            iter_sizes=calibrate_iter_size,
+            seconds=calibrate_seconds)
+        if all(r['round_trip_latency'] is None for r in results):
+            logging.warning('No click recorded, is the device looped back?')
+        profile = select_audio_profile(results)
+        save_audio_profile(profile, audio_profile)
+        logging.info('Selected block size %d, iter size %d, written to %s',
+                     profile['audio_block_size'], profile['audio_iter_size'],
+                     audio_profile)
+        return
+    audio_device = audio_device_class(
+        sample_rate=audio_sample_rate,
+        sample_width=audio_sample_width,
+        block_size=audio_block_size,
+        flush_size=audio_flush_size,
+        device_sample_rate=audio_device_sample_rate)
     stream = ConversationStream(source=audio_device,
                                 sink=audio_device,
                                 iter_size=audio_iter_size,
@@ -403,6 +2119,9 @@ def main(record_time, audio_sample_rate, audio_sample_width,
     logging.info('Finished playback.')
     stream.stop_playback()
 
+    stats = audio_device.stats
+    logging.info('Device overflows: %d, underflows: %d',
+                 stats['overflows'], stats['underflows'])
     logging.info('audio test completed.')
     stream.close()
 
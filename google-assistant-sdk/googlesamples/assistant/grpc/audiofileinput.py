@@ -14,11 +14,16 @@
 
 """Simple file-based sample for the Google Assistant Service."""
 
+import concurrent.futures
+import glob
 import json
 import logging
 import os
 import os.path
+import pathlib2 as pathlib
 import sys
+import threading
+import time
 
 import click
 import google.auth.transport.grpc
@@ -30,8 +35,246 @@ from google.assistant.embedded.v1alpha2 import (
     embedded_assistant_pb2_grpc
 )
 
+try:
+    from . import codec_helpers
+except (SystemError, ImportError):
+    import codec_helpers
+
 
 END_OF_UTTERANCE = embedded_assistant_pb2.AssistResponse.END_OF_UTTERANCE
+BATCH_EXTENSIONS = ('.wav', '.riff', '.raw')
+
+
+class FileAssistant(object):
+    """Assistant answering requests recorded in audio files.
+
+    Args:
+      language_code: language for the conversation.
+      device_model_id: identifier of the device model.
+      device_id: identifier of the registered device instance.
+      channel: authorized gRPC channel for connection to the
+        Google Assistant API, may be shared between threads.
+      deadline_sec: gRPC deadline in seconds for Google Assistant API call.
+      block_size: size of each input stream read in bytes.
+      audio_out_encoding: encoding of the audio response, decoded to
+        LINEAR16 before it is written.
+    """
+    def __init__(self, language_code, device_model_id, device_id,
+                 channel, deadline_sec, block_size,
+                 audio_out_encoding=codec_helpers.LINEAR16):
+        self.language_code = language_code
+        self.device_model_id = device_model_id
+        self.device_id = device_id
+        self.assistant = embedded_assistant_pb2_grpc.EmbeddedAssistantStub(
+            channel
+        )
+        self.deadline = deadline_sec
+        self.block_size = block_size
+        # Decode compressed responses back to LINEAR16.
+        self.audio_out_encoding = codec_helpers.select_audio_out_encoding(
+            audio_out_encoding, 16000, 2)
+
+    def gen_assist_requests(self, input_stream):
+        """Yields: AssistRequest messages with the audio of input_stream."""
+        dialog_state_in = embedded_assistant_pb2.DialogStateIn(
+            language_code=self.language_code,
+            conversation_state=b''
+        )
+        config = embedded_assistant_pb2.AssistConfig(
+            audio_in_config=embedded_assistant_pb2.AudioInConfig(
+                encoding='LINEAR16',
+                sample_rate_hertz=16000,
+            ),
+            audio_out_config=embedded_assistant_pb2.AudioOutConfig(
+                encoding=self.audio_out_encoding,
+                sample_rate_hertz=16000,
+                volume_percentage=100,
+            ),
+            dialog_state_in=dialog_state_in,
+            device_config=embedded_assistant_pb2.DeviceConfig(
+                device_id=self.device_id,
+                device_model_id=self.device_model_id,
+            )
+        )
+        # Send first AssistRequest message with configuration.
+        yield embedded_assistant_pb2.AssistRequest(config=config)
+        while True:
+            # Read user request from file.
+            data = input_stream.read(self.block_size)
+            if not data:
+                break
+            # Send following AssitRequest message with audio chunks.
+            yield embedded_assistant_pb2.AssistRequest(audio_in=data)
+
+    def assist(self, input_stream, output_stream):
+        """Send the request of input_stream and write the audio response.
+
+        Returns: dict with the transcript, display text and device
+        requests of the response.
+        """
+        decoder = codec_helpers.create_audio_out_decoder(
+            self.audio_out_encoding, 16000, 2)
+        result = {
+            'transcript': None,
+            'display_text': None,
+            'device_requests': [],
+        }
+        for resp in self.assistant.Assist(
+                self.gen_assist_requests(input_stream), self.deadline):
+            # Iterate on AssistResponse messages.
+            if resp.event_type == END_OF_UTTERANCE:
+                logging.info('End of audio request detected')
+            if resp.speech_results:
+                result['transcript'] = ' '.join(r.transcript
+                                                for r in resp.speech_results)
+                logging.info('Transcript of user request: "%s".',
+                             result['transcript'])
+            if len(resp.audio_out.audio_data) > 0:
+                # Write assistant response to supplied file.
+                audio_data = resp.audio_out.audio_data
+                if decoder:
+                    audio_data = decoder.decode(audio_data)
+                output_stream.write(audio_data)
+            if resp.dialog_state_out.supplemental_display_text:
+                result['display_text'] = (
+                    resp.dialog_state_out.supplemental_display_text)
+                logging.info('Assistant display text: "%s"',
+                             result['display_text'])
+            if resp.device_action.device_request_json:
+                device_request = json.loads(
+                    resp.device_action.device_request_json)
+                result['device_requests'].append(device_request)
+                logging.info('Device request: %s', device_request)
+        if decoder:
+            output_stream.write(decoder.flush())
+        return result
+
+
+def list_batch_inputs(batch):
+    """Returns: list of the input audio files of a batch.
+
+    Args:
+      batch: directory searched recursively for WAV, RIFF and RAW files,
+        glob pattern, single audio file, or manifest file listing one
+        path per line, relative to the manifest.
+    """
+    if os.path.isdir(batch):
+        paths = []
+        for root, _, files in os.walk(batch):
+            paths.extend(os.path.join(root, f) for f in files
+                         if os.path.splitext(f)[1].lower()
+                         in BATCH_EXTENSIONS)
+        return sorted(paths)
+    if os.path.isfile(batch):
+        if os.path.splitext(batch)[1].lower() in BATCH_EXTENSIONS:
+            return [batch]
+        base = os.path.dirname(batch)
+        with open(batch, 'r') as f:
+            return [os.path.join(base, line.strip()) for line in f
+                    if line.strip() and not line.startswith('#')]
+    try:
+        return sorted(glob.glob(batch, recursive=True))
+    except TypeError:
+        # Python 2 glob does not support recursive ** patterns.
+        return sorted(glob.glob(batch))
+
+
+def common_dir(paths):
+    """Returns: the deepest directory containing all the paths."""
+    dirs = [os.path.dirname(os.path.abspath(p)).split(os.sep) for p in paths]
+    # os.path.commonpath is missing on Python 2.
+    return os.sep.join(os.path.commonprefix(dirs)) or os.sep
+
+
+def load_results(results_file):
+    """Returns: set of the inputs successfully processed in results_file.
+
+    A truncated last line, left by an interrupted run, is ignored.
+    """
+    done = set()
+    if not os.path.exists(results_file):
+        return done
+    with open(results_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning('Ignoring invalid result: %s', line.strip())
+                continue
+            if record.get('error'):
+                done.discard(record['input'])
+            else:
+                done.add(record['input'])
+    return done
+
+
+def ends_with_newline(path):
+    """Returns: False if the last line of path is not terminated."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if not f.tell():
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def output_path(output_dir, base, path):
+    """Returns: path of the output audio of the input path."""
+    relpath = os.path.relpath(path, base)
+    return os.path.join(output_dir, os.path.splitext(relpath)[0] + '.raw')
+
+
+def run_batch(assistant, paths, output_dir, results_file, concurrency):
+    """Process the requests of paths with concurrent Assist calls.
+
+    Output audio is written in output_dir (format: LINEAR16 16000 Hz),
+    mirroring the layout of the inputs. A JSON record is appended to
+    results_file per input and flushed to disk, inputs already processed
+    successfully are skipped so that an interrupted batch can be resumed.
+
+    Returns: the number of failed inputs.
+    """
+    done = load_results(results_file)
+    todo = [p for p in paths if p not in done]
+    logging.info('Processing %d inputs (%d already done).',
+                 len(todo), len(paths) - len(todo))
+    if not todo:
+        return 0
+    base = common_dir(paths)
+    lock = threading.Lock()
+    errors = []
+
+    def process(path):
+        record = {'input': path, 'output': output_path(output_dir, base,
+                                                       os.path.abspath(path))}
+        start = time.time()
+        try:
+            pathlib.Path(record['output']).parent.mkdir(parents=True,
+                                                        exist_ok=True)
+            with open(path, 'rb') as input_stream:
+                with open(record['output'], 'wb') as output_stream:
+                    record.update(assistant.assist(input_stream,
+                                                   output_stream))
+            record['error'] = None
+        except Exception as e:
+            logging.error('Failed to process %s: %s', path, e)
+            record['error'] = str(e)
+        record['elapsed'] = time.time() - start
+        with lock:
+            if record['error']:
+                errors.append(path)
+            results.write(json.dumps(record, sort_keys=True) + '\n')
+            results.flush()
+            os.fsync(results.fileno())
+
+    with open(results_file, 'a') as results:
+        if not ends_with_newline(results_file):
+            # Terminate the last line left by an interrupted run.
+            results.write('\n')
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            for _ in executor.map(process, todo):
+                pass
+    return len(errors)
 
 
 @click.command()
@@ -55,27 +298,58 @@ END_OF_UTTERANCE = embedded_assistant_pb2.AssistResponse.END_OF_UTTERANCE
               help='Language code of the Assistant.')
 @click.option('--verbose', '-v', is_flag=True, default=False,
               help='Enable verbose logging.')
-@click.option('--input-audio-file', '-i', required=True,
+@click.option('--input-audio-file', '-i',
               metavar='<input file>', type=click.File('rb'),
               help='Path to input audio file (format: LINEAR16 16000 Hz).')
-@click.option('--output-audio-file', '-o', required=True,
+@click.option('--output-audio-file', '-o',
               metavar='<output file>', type=click.File('wb'),
               help='Path to output audio file (format: LINEAR16 16000 Hz).')
+@click.option('--batch', '-b',
+              metavar='<directory, glob or manifest>',
+              help=('Process many input audio files: a directory searched '
+                    'for .wav, .riff and .raw files, a glob pattern, or a '
+                    'manifest file listing one input path per line.'))
+@click.option('--output-dir', default='.',
+              metavar='<output dir>', show_default=True,
+              help='Batch mode: directory to write output audio files to.')
+@click.option('--results-file', default='results.jsonl',
+              metavar='<results file>', show_default=True,
+              help=('Batch mode: JSONL file to append per input results to, '
+                    'inputs already in it are skipped.'))
+@click.option('--concurrency', default=8,
+              metavar='<concurrency>', show_default=True,
+              help='Batch mode: number of concurrent Assist calls.')
 @click.option('--block-size', default=1024,
               metavar='<block size>', show_default=True,
               help='Size of each input stream read in bytes.')
+@click.option('--audio-out-encoding', default=codec_helpers.LINEAR16,
+              type=click.Choice(codec_helpers.AUDIO_OUT_ENCODINGS),
+              show_default=True,
+              help=('Encoding of the audio response sent by the Assistant, '
+                    'decoded to LINEAR16 before writing the output file. '
+                    'MP3 and OPUS_IN_OGG require PyAV.'))
 @click.option('--grpc-deadline', default=300,
               metavar='<grpc deadline>', show_default=True,
               help='gRPC deadline in seconds')
 def main(api_endpoint, credentials,
          device_model_id, device_id, lang, verbose,
          input_audio_file, output_audio_file,
-         block_size, grpc_deadline, *args, **kwargs):
+         batch, output_dir, results_file, concurrency,
+         block_size, audio_out_encoding, grpc_deadline, *args, **kwargs):
     """File based sample for the Google Assistant API.
 
     Examples:
       $ python -m audiofileinput -i <input file> -o <output file>
+
+      Process a directory of recordings with 16 concurrent calls:
+
+        $ python -m audiofileinput -b <input dir> --output-dir <output dir>
+            --concurrency 16 --results-file results.jsonl
     """
+    if not batch and not (input_audio_file and output_audio_file):
+        raise click.UsageError('Either --batch or both --input-audio-file '
+                               'and --output-audio-file are required.')
+
     # Setup logging.
     logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
 
@@ -92,64 +366,27 @@ def main(api_endpoint, credentials,
                       'new OAuth 2.0 credentials.')
         sys.exit(-1)
 
-    # Create an authorized gRPC channel.
+    # Create an authorized gRPC channel, shared by all the calls of a
+    # batch. Credentials are refreshed when they expire.
     grpc_channel = google.auth.transport.grpc.secure_authorized_channel(
         credentials, http_request, api_endpoint)
     logging.info('Connecting to %s', api_endpoint)
 
-    # Create gRPC stubs
-    assistant = embedded_assistant_pb2_grpc.EmbeddedAssistantStub(grpc_channel)
-
-    # Generate gRPC requests.
-    def gen_assist_requests(input_stream):
-        dialog_state_in = embedded_assistant_pb2.DialogStateIn(
-            language_code=lang,
-            conversation_state=b''
-        )
-        config = embedded_assistant_pb2.AssistConfig(
-            audio_in_config=embedded_assistant_pb2.AudioInConfig(
-                encoding='LINEAR16',
-                sample_rate_hertz=16000,
-            ),
-            audio_out_config=embedded_assistant_pb2.AudioOutConfig(
-                encoding='LINEAR16',
-                sample_rate_hertz=16000,
-                volume_percentage=100,
-            ),
-            dialog_state_in=dialog_state_in,
-            device_config=embedded_assistant_pb2.DeviceConfig(
-                device_id=device_id,
-                device_model_id=device_model_id,
-            )
-        )
-        # Send first AssistRequest message with configuration.
-        yield embedded_assistant_pb2.AssistRequest(config=config)
-        while True:
-            # Read user request from file.
-            data = input_stream.read(block_size)
-            if not data:
-                break
-            # Send following AssitRequest message with audio chunks.
-            yield embedded_assistant_pb2.AssistRequest(audio_in=data)
+    assistant = FileAssistant(lang, device_model_id, device_id,
+                              grpc_channel, grpc_deadline, block_size,
+                              audio_out_encoding)
+    if not batch:
+        assistant.assist(input_audio_file, output_audio_file)
+        return
 
-    for resp in assistant.Assist(gen_assist_requests(input_audio_file),
-                                 grpc_deadline):
-        # Iterate on AssistResponse messages.
-        if resp.event_type == END_OF_UTTERANCE:
-            logging.info('End of audio request detected')
-        if resp.speech_results:
-            logging.info('Transcript of user request: "%s".',
-                         ' '.join(r.transcript
-                                  for r in resp.speech_results))
-        if len(resp.audio_out.audio_data) > 0:
-            # Write assistant response to supplied file.
-            output_audio_file.write(resp.audio_out.audio_data)
-        if resp.dialog_state_out.supplemental_display_text:
-            logging.info('Assistant display text: "%s"',
-                         resp.dialog_state_out.supplemental_display_text)
-        if resp.device_action.device_request_json:
-            device_request = json.loads(resp.device_action.device_request_json)
-            logging.info('Device request: %s', device_request)
+    paths = list_batch_inputs(batch)
+    start = time.time()
+    errors = run_batch(assistant, paths, output_dir, results_file,
+                       concurrency)
+    logging.info('Processed %d inputs in %.1fs, %d errors.',
+                 len(paths), time.time() - start, errors)
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,1090 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the Google Assistant gRPC samples."""
+
+import io
+import os
+import shutil
+import tempfile
+import time
+import timeit
+import wave
+
+import click
+import grpc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+try:
+    from . import (
+        aec_helpers,
+        audio_helpers,
+        codec_helpers,
+        fakeassistant,
+        pushtotalk,
+        trace_helpers,
+        vad_helpers
+    )
+except (SystemError, ImportError):
+    import aec_helpers
+    import audio_helpers
+    import codec_helpers
+    import fakeassistant
+    import pushtotalk
+    import trace_helpers
+    import vad_helpers
+
+
+def report(name, seconds, audio_seconds):
+    """Print the CPU cost of processing audio_seconds of audio."""
+    click.echo('%-24s %10.3f ms per second of audio (%.1fx real-time)' % (
+        name, 1000.0 * seconds / audio_seconds,
+        audio_seconds / seconds if seconds else float('inf')))
+
+
+def best_of(fn, repeat):
+    """Returns the best wall time in seconds of repeat calls to fn."""
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def peak_memory(fn):
+    """Returns the peak traced memory in bytes during a call to fn.
+
+    Returns NaN when tracemalloc is not available.
+    """
+    if tracemalloc is None:
+        fn()
+        return float('nan')
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def cpu_time():
+    """Returns the user and system CPU time of this process in seconds."""
+    if resource:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    if hasattr(time, 'process_time'):
+        return time.process_time()
+    times = os.times()  # Python 2
+    return times[0] + times[1]
+
+
+def wav_bytes(audio_seconds, sample_rate, sample_width, data=None):
+    """Returns a WAV file containing data, or audio_seconds of silence."""
+    if data is None:
+        data = b'\0' * int(audio_seconds * sample_rate) * sample_width
+    stream = io.BytesIO()
+    w = wave.open(stream, 'wb')
+    w.setframerate(sample_rate)
+    w.setsampwidth(sample_width)
+    w.setnchannels(1)
+    w.writeframes(data)
+    w.close()
+    return stream.getvalue()
+
+
+class NullSink(object):
+    """Audio sink discarding all data."""
+    def write(self, buf):
+        return len(buf)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--audio-seconds', default=10.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the audio buffer to normalize.')
+@click.option('--audio-sample-rate',
+              default=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+              metavar='<audio sample rate>', show_default=True,
+              help='Audio sample rate in hertz.')
+@click.option('--audio-sample-width',
+              default=str(audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH),
+              type=click.Choice(['2', '4']), show_default=True,
+              help='Audio sample width in bytes.')
+@click.option('--volume-percentage', default=50,
+              metavar='<volume>', show_default=True,
+              help='Volume setting as an integer percentage (1-100).')
+@click.option('--repeat', default=5,
+              metavar='<repeat>', show_default=True,
+              help='Number of timed runs, the best one is reported.')
+def normalize(audio_seconds, audio_sample_rate, audio_sample_width,
+              volume_percentage, repeat):
+    """Compare volume normalization implementations."""
+    sample_width = int(audio_sample_width)
+    size = int(audio_seconds * audio_sample_rate) * sample_width
+    data = os.urandom(size)
+    scale = audio_helpers.volume_scale(volume_percentage)
+    click.echo('Normalizing %d bytes (%.1fs) at %d%% volume.' % (
+        size, audio_seconds, volume_percentage))
+    report('python loop', best_of(
+        lambda: audio_helpers._scale_samples_python(
+            data, scale, sample_width, False), repeat), audio_seconds)
+    if audio_helpers.np is None:
+        click.echo('NumPy is not installed: skipping vectorized runs.')
+        return
+    report('numpy copy', best_of(
+        lambda: audio_helpers._scale_samples_numpy(
+            data, scale, sample_width, False), repeat), audio_seconds)
+    buf = memoryview(bytearray(data))
+    report('numpy in-place', best_of(
+        lambda: audio_helpers._scale_samples_numpy(
+            buf, scale, sample_width, True), repeat), audio_seconds)
+
+
+@cli.command()
+@click.option('--chunk-size', default=1599,
+              metavar='<chunk size>', show_default=True,
+              help='Size in bytes of each audio_out chunk.')
+@click.option('--chunk-count', default=500,
+              metavar='<chunk count>', show_default=True,
+              help='Number of audio_out chunks per run.')
+@click.option('--volume-percentage', default=50,
+              metavar='<volume>', show_default=True,
+              help='Volume setting as an integer percentage (1-100).')
+@click.option('--repeat', default=5,
+              metavar='<repeat>', show_default=True,
+              help='Number of timed runs, the best one is reported.')
+def playback(chunk_size, chunk_count, volume_percentage, repeat):
+    """Compare copying and zero-copy audio_out playback paths."""
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    chunks = [os.urandom(chunk_size) for _ in range(chunk_count)]
+    audio_seconds = (chunk_size * chunk_count /
+                     float(sample_width *
+                           audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE))
+    sink = NullSink()
+
+    def copying():
+        for chunk in chunks:
+            buf = audio_helpers.align_buf(chunk, sample_width)
+            sink.write(audio_helpers.normalize_audio_buffer(
+                buf, volume_percentage, sample_width))
+
+    def zero_copy(stream=None):
+        if stream is None:
+            stream = audio_helpers.ConversationStream(
+                source=None, sink=sink, iter_size=0,
+                sample_width=sample_width)
+            stream.volume_percentage = volume_percentage
+        stream.start_playback()
+        for chunk in chunks:
+            stream.write(chunk)
+        return stream
+
+    click.echo('Writing %d chunks of %d bytes (%.1fs).' % (
+        chunk_count, chunk_size, audio_seconds))
+    report('copying', best_of(copying, repeat), audio_seconds)
+    click.echo('%-24s %10.0f bytes peak memory' % (
+        '', peak_memory(copying)))
+    report('zero-copy', best_of(zero_copy, repeat), audio_seconds)
+    click.echo('%-24s %10.0f bytes peak memory' % (
+        '', peak_memory(zero_copy)))
+    stats = zero_copy().playback_stats
+    click.echo('%-24s %10d allocations, %d copies (%d bytes)' % (
+        '', stats['allocations'], stats['copies'], stats['bytes_copied']))
+
+
+@cli.command()
+@click.option('--input-audio-file', '-i',
+              metavar='<input file>', type=click.Path(exists=True),
+              help=('Path to input audio file (WAV/RIFF or RAW), '
+                    'if missing a synthetic voice-like signal is used.'))
+@click.option('--audio-seconds', default=10.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the synthetic signal.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+def flac(input_audio_file, audio_seconds, audio_iter_size):
+    """Measure FLAC audio_in bandwidth and encode latency."""
+    if codec_helpers.np is None:
+        click.echo('NumPy is not installed: FLAC encoding is not available.')
+        return
+    np = codec_helpers.np
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    if input_audio_file:
+        try:
+            w = wave.open(input_audio_file, 'rb')
+            data = w.readframes(w.getnframes())
+            w.close()
+        except wave.Error:
+            with open(input_audio_file, 'rb') as f:
+                data = f.read()
+    else:
+        t = np.arange(int(audio_seconds * sample_rate)) / float(sample_rate)
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)
+        signal = envelope * (4000 * np.sin(2 * np.pi * 220 * t) +
+                             2000 * np.sin(2 * np.pi * 660 * t))
+        signal += np.random.RandomState(0).normal(0, 100, len(t))
+        data = signal.astype('<i2').tobytes()
+    chunks = [data[i:i + audio_iter_size]
+              for i in range(0, len(data), audio_iter_size)]
+    audio_seconds = len(data) / float(sample_rate * sample_width)
+
+    encoder = codec_helpers.FlacEncoder(sample_rate, sample_width)
+    latencies = []
+    encoded = 0
+    for chunk in chunks:
+        start = timeit.default_timer()
+        encoded += len(encoder.encode(chunk))
+        latencies.append(timeit.default_timer() - start)
+    encoded += len(encoder.flush())
+
+    click.echo('Encoding %d chunks of %d bytes (%.1fs).' % (
+        len(chunks), audio_iter_size, audio_seconds))
+    for name, size in (('LINEAR16', len(data)), ('FLAC', encoded)):
+        click.echo('%-24s %10.0f bytes per second (%.1f%%)' % (
+            name, size / audio_seconds, 100.0 * size / len(data)))
+    percentiles = trace_helpers.PERCENTILES
+    click.echo('%-24s' % 'encode latency (ms)' +
+               ''.join('%10s' % ('p%d' % p) for p in percentiles))
+    click.echo('%-24s' % '' +
+               ''.join('%10.3f' %
+                       (1000 * trace_helpers.percentile(latencies, p))
+                       for p in percentiles))
+    report('FLAC encode', sum(latencies), audio_seconds)
+
+
+def encode_audio(data, encoding, sample_rate, bit_rate):
+    """Returns data encoded with PyAV in the given audio_out encoding."""
+    av = codec_helpers.av
+    np = codec_helpers.np
+    formats = {
+        codec_helpers.MP3: ('mp3', 'libmp3lame', sample_rate),
+        codec_helpers.OPUS_IN_OGG: ('ogg', 'libopus',
+                                    codec_helpers.OPUS_SAMPLE_RATE),
+    }
+    container_format, codec, rate = formats[encoding]
+    output = io.BytesIO()
+    container = av.open(output, 'w', format=container_format)
+    stream = container.add_stream(codec, rate=rate)
+    stream.layout = 'mono'
+    stream.bit_rate = bit_rate
+    frame = av.AudioFrame.from_ndarray(
+        np.frombuffer(data, dtype='<i2')[None, :], format='s16',
+        layout='mono')
+    frame.sample_rate = sample_rate
+    resampler = av.AudioResampler(format=stream.codec_context.format.name,
+                                  layout='mono', rate=rate)
+    for f in resampler.resample(frame) + resampler.resample(None) + [None]:
+        for packet in stream.encode(f):
+            container.mux(packet)
+    container.close()
+    return output.getvalue()
+
+
+class TimingSink(NullSink):
+    """Audio sink recording the time of the first write."""
+    def __init__(self):
+        self.first_write = None
+        self.written = 0
+
+    def write(self, buf):
+        if self.first_write is None:
+            self.first_write = timeit.default_timer()
+        self.written += len(buf)
+        return len(buf)
+
+
+@cli.command()
+@click.option('--audio-seconds', default=5.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the audio response.')
+@click.option('--chunk-seconds', default=0.1,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the audio in each audio_out message.')
+@click.option('--bit-rate', default=32000,
+              metavar='<bits per second>', show_default=True,
+              help='Bit rate of the compressed encodings.')
+@click.option('--repeat', default=5,
+              metavar='<repeat>', show_default=True,
+              help='Number of timed runs, the best one is reported.')
+def decode(audio_seconds, chunk_seconds, bit_rate, repeat):
+    """Compare audio_out encodings: bytes and start of playback latency.
+
+    Start of playback is the time from the first audio_out message
+    written to the conversation stream to the first PCM write to the
+    sink. An encoded stream is cut in audio_out messages carrying
+    chunk-seconds of audio on average.
+    """
+    if codec_helpers.av is None or codec_helpers.np is None:
+        click.echo('PyAV and NumPy are required to encode test audio.')
+        return
+    np = codec_helpers.np
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    t = np.arange(int(audio_seconds * sample_rate)) / float(sample_rate)
+    pcm = (4000 * np.sin(2 * np.pi * 220 * t) *
+           (0.5 + 0.5 * np.sin(2 * np.pi * 3 * t))).astype('<i2').tobytes()
+    click.echo('Playing %.1fs responses in %dms audio_out messages.' % (
+        audio_seconds, 1000 * chunk_seconds))
+    click.echo('%-14s %10s %14s %14s' % ('encoding', 'bytes/s',
+                                         'first pcm (ms)', 'cpu (ms/s)'))
+    for encoding in codec_helpers.AUDIO_OUT_ENCODINGS:
+        data = pcm
+        if encoding != codec_helpers.LINEAR16:
+            data = encode_audio(pcm, encoding, sample_rate, bit_rate)
+        size = max(int(len(data) * chunk_seconds / audio_seconds), 1)
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+
+        def play():
+            sink = TimingSink()
+            stream = audio_helpers.ConversationStream(
+                source=audio_helpers.WaveSource(
+                    io.BytesIO(wav_bytes(0, sample_rate, sample_width)),
+                    sample_rate, sample_width),
+                sink=sink, iter_size=0, sample_width=sample_width)
+            stream.audio_out_encoding = encoding
+            start = timeit.default_timer()
+            stream.start_playback()
+            for chunk in chunks:
+                stream.write(chunk)
+            stream.stop_playback()
+            end = timeit.default_timer()
+            return sink.first_write - start, end - start
+        runs = [play() for _ in range(repeat)]
+        click.echo('%-14s %10.0f %14.3f %14.3f' % (
+            encoding, len(data) / audio_seconds,
+            1000 * min(r[0] for r in runs),
+            1000 * min(r[1] for r in runs) / audio_seconds))
+
+
+@cli.command()
+@click.option('--audio-seconds', default=2.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the audio request.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+@click.option('--pacing', '-p', multiple=True, type=audio_helpers.PACING,
+              default=['realtime', '2x', '4x', 'burst'],
+              metavar='<pacing>', show_default=True,
+              help='Input pacing policy to compare, can be repeated.')
+@click.option('--endpoint-silence', default=0.0,
+              metavar='<seconds>', show_default=True,
+              help='Trailing silence the fake server waits for before '
+              'END_OF_UTTERANCE.')
+@click.option('--trailing-silence-ms', type=int, metavar='<milliseconds>',
+              help='Silence sent after the end of the file before ending '
+              'the request, unlimited if missing.')
+def pacing(audio_seconds, audio_iter_size, pacing, endpoint_silence,
+           trailing_silence_ms):
+    """Compare input pacing policies of file driven turns.
+
+    Each turn replays an audio file against a fake server sending
+    END_OF_UTTERANCE once the whole file and endpoint-silence seconds of
+    trailing silence were received, or when the request ends.
+    """
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    data = wav_bytes(audio_seconds, sample_rate, sample_width)
+    servicer_kwargs = {
+        'end_of_utterance_size': int((audio_seconds + endpoint_silence) *
+                                     sample_rate * sample_width),
+    }
+    click.echo('Replaying %.1fs of audio in %d byte chunks.' % (
+        audio_seconds, audio_iter_size))
+    click.echo('%-10s %24s %12s %14s' % ('pacing', 'end of utterance (ms)',
+                                         'turn (ms)', 'audio in (s)'))
+    with fakeassistant.serve_in_subprocess(**servicer_kwargs) as address:
+        channel = grpc.insecure_channel(address)
+        for speed in pacing:
+            tracer = trace_helpers.TurnTracer()
+            source = audio_helpers.WaveSource(
+                io.BytesIO(data), sample_rate, sample_width, pacing=speed,
+                trailing_silence_ms=trailing_silence_ms)
+            stream = audio_helpers.ConversationStream(
+                source=source, sink=NullSink(), iter_size=audio_iter_size,
+                sample_width=sample_width)
+            assistant = pushtotalk.SampleAssistant(
+                'en-US', 'device-model-id', 'device-id', stream, False,
+                channel, pushtotalk.DEFAULT_GRPC_DEADLINE, None,
+                tracer=tracer)
+            assistant.assist()
+            span = tracer.last_span
+            name = {audio_helpers.REALTIME: 'realtime',
+                    audio_helpers.BURST: 'burst'}.get(speed, '%gx' % speed)
+            click.echo('%-10s %24.1f %12.1f %14.2f' % (
+                name, 1000 * span.elapsed(trace_helpers.END_OF_UTTERANCE),
+                1000 * span.duration, source.stats['seconds']))
+        channel.close()
+
+
+@cli.command()
+@click.option('--files', default=20,
+              metavar='<files>', show_default=True,
+              help='Number of audio files in the corpus.')
+@click.option('--audio-seconds', default=30.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of each audio file.')
+@click.option('--sessions', default=100,
+              metavar='<sessions>', show_default=True,
+              help='Number of concurrent sessions replaying the corpus.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+def mmap(files, audio_seconds, sessions, audio_iter_size):
+    """Compare heap and memory-mapped sources replaying a corpus.
+
+    Sessions are assigned files round robin and read them in interleaved
+    chunks as concurrent turns would, without pacing.
+    """
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    data = wav_bytes(audio_seconds, sample_rate, sample_width)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i in range(files):
+            paths.append(os.path.join(tmpdir, '%d.wav' % i))
+            with open(paths[-1], 'wb') as f:
+                f.write(data)
+
+        def heap_source(contents):
+            return lambda path: audio_helpers.WaveSource(
+                io.BytesIO(contents[path]), sample_rate, sample_width,
+                pacing=audio_helpers.BURST)
+
+        def replay(make_source):
+            sources = [make_source(paths[i % files])
+                       for i in range(sessions)]
+            chunks = len(data) // audio_iter_size
+            for _ in range(chunks):
+                for source in sources:
+                    source.read(audio_iter_size)
+            for source in sources:
+                source.close()
+
+        def read_files():
+            # Files are read once and shared by the sessions.
+            contents = {}
+            for path in paths:
+                with open(path, 'rb') as f:
+                    contents[path] = f.read()
+            replay(heap_source(contents))
+
+        def map_files():
+            replay(lambda path: audio_helpers.MappedWaveSource(
+                path, sample_rate, sample_width,
+                pacing=audio_helpers.BURST))
+
+        click.echo('Replaying %d files of %.1fs over %d sessions.' % (
+            files, audio_seconds, sessions))
+        for name, fn in (('read', read_files), ('mmap', map_files)):
+            seconds = best_of(fn, 3)
+            click.echo('%-8s %10.1f ms %10.1f MB peak heap' % (
+                name, 1000 * seconds, peak_memory(fn) / 1e6))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def speech_like(speech_seconds, silence_seconds, sample_rate):
+    """Returns int16 samples of a voiced signal followed by silence.
+
+    The voiced part is a harmonic signal modulated at a syllabic rate,
+    both parts carry a low level of white noise.
+    """
+    np = codec_helpers.np
+    rng = np.random.RandomState(0)
+    t = np.arange(int(speech_seconds * sample_rate)) / float(sample_rate)
+    voiced = sum(np.sin(2 * np.pi * 150 * k * t) / k for k in range(1, 6))
+    voiced *= 3000 * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+    samples = np.concatenate(
+        (voiced, np.zeros(int(silence_seconds * sample_rate))))
+    samples += rng.normal(0, 30, len(samples))
+    return samples.astype('<i2')
+
+
+@cli.command()
+@click.option('--speech-seconds', default=1.5,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the speech in the audio request.')
+@click.option('--endpoint-silence', default=1.0,
+              metavar='<seconds>', show_default=True,
+              help='Trailing silence the fake server waits for before '
+              'END_OF_UTTERANCE.')
+@click.option('--trailing-silence-ms',
+              default=vad_helpers.DEFAULT_TRAILING_SILENCE_MS,
+              metavar='<milliseconds>', show_default=True,
+              help='Trailing silence ending the utterance locally.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+def vad(speech_seconds, endpoint_silence, trailing_silence_ms,
+        audio_iter_size):
+    """Compare local and server endpointing of realtime turns.
+
+    The fake server sends END_OF_UTTERANCE once the speech and
+    endpoint-silence seconds of trailing silence were received, or when
+    the request ends.
+    """
+    if codec_helpers.np is None:
+        click.echo('NumPy is required for voice activity detection.')
+        return
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    data = speech_like(speech_seconds, endpoint_silence + 1.0,
+                       sample_rate).tobytes()
+    endpointer = vad_helpers.create_endpointer(
+        vad_helpers.OBSERVE, sample_rate, sample_width,
+        trailing_silence_ms=trailing_silence_ms)
+    audio_seconds = len(data) / float(sample_rate * sample_width)
+    chunks = [data[i:i + audio_iter_size]
+              for i in range(0, len(data), audio_iter_size)]
+    report('vad', best_of(lambda: list(endpointer.process(chunks)), 5),
+           audio_seconds)
+
+    servicer_kwargs = {
+        'end_of_utterance_size': int((speech_seconds + endpoint_silence) *
+                                     sample_rate * sample_width),
+    }
+    click.echo('%-10s %18s %18s %12s' % ('endpointing', 'local eou (ms)',
+                                         'server eou (ms)', 'turn (ms)'))
+    with fakeassistant.serve_in_subprocess(**servicer_kwargs) as address:
+        channel = grpc.insecure_channel(address)
+        for mode in vad_helpers.ENDPOINTING_MODES:
+            tracer = trace_helpers.TurnTracer()
+            stream = audio_helpers.ConversationStream(
+                source=audio_helpers.WaveSource(
+                    io.BytesIO(wav_bytes(0, sample_rate, sample_width, data)),
+                    sample_rate, sample_width),
+                sink=NullSink(), iter_size=audio_iter_size,
+                sample_width=sample_width)
+            assistant = pushtotalk.SampleAssistant(
+                'en-US', 'device-model-id', 'device-id', stream, False,
+                channel, pushtotalk.DEFAULT_GRPC_DEADLINE, None,
+                tracer=tracer, endpointer=vad_helpers.create_endpointer(
+                    mode, sample_rate, sample_width,
+                    trailing_silence_ms=trailing_silence_ms))
+            assistant.assist()
+            span = tracer.last_span
+            local = span.elapsed(trace_helpers.LOCAL_END_OF_UTTERANCE)
+            click.echo('%-10s %18s %18.1f %12.1f' % (
+                mode, '-' if local is None else '%.1f' % (1000 * local),
+                1000 * span.elapsed(trace_helpers.END_OF_UTTERANCE),
+                1000 * span.duration))
+        channel.close()
+
+
+class SimulatedCapture(object):
+    """Audio source returning recorded audio as a microphone captures it.
+
+    Each read returns once its last sample would have been captured,
+    silence follows the recorded audio. The size of each read is kept.
+    """
+    def __init__(self, data, sample_rate, sample_width):
+        self._data = data
+        self._bytes_per_second = float(sample_rate * sample_width)
+        self._start = None
+        self._position = 0
+        self.sample_rate = sample_rate
+        self._sample_rate = sample_rate
+        self.sizes = []
+
+    def start(self):
+        self._start = timeit.default_timer()
+        self._position = 0
+        self.sizes = []
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    def read(self, size):
+        end = self._position + size
+        delay = (self._start + end / self._bytes_per_second -
+                 timeit.default_timer())
+        if delay > 0:
+            time.sleep(delay)
+        data = self._data[self._position:end]
+        data += b'\0' * (size - len(data))
+        self._position = end
+        self.sizes.append(size)
+        return data
+
+
+# gRPC length prefixed message and HTTP/2 DATA frame headers.
+GRPC_MESSAGE_HEADER_SIZE = 5
+HTTP2_FRAME_HEADER_SIZE = 9
+
+
+def framing_overhead(size):
+    """Returns: bytes sent on the wire for an audio_in chunk of size."""
+    request = pushtotalk.embedded_assistant_pb2.AssistRequest(
+        audio_in=b'\0' * size)
+    return (request.ByteSize() - size + GRPC_MESSAGE_HEADER_SIZE +
+            HTTP2_FRAME_HEADER_SIZE)
+
+
+@cli.command()
+@click.option('--speech-seconds', default=1.5,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the speech in the audio request.')
+@click.option('--endpoint-silence', default=0.5,
+              metavar='<seconds>', show_default=True,
+              help='Trailing silence the fake server waits for before '
+              'END_OF_UTTERANCE.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of the fixed chunks, and ceiling of growing chunks.')
+@click.option('--audio-in-min-chunk-size',
+              default=audio_helpers.DEFAULT_AUDIO_IN_MIN_CHUNK_SIZE,
+              metavar='<audio in min chunk size>', show_default=True,
+              help='Size in bytes of the smallest growing chunk.')
+@click.option('--turns', default=4,
+              metavar='<turns>', show_default=True,
+              help='Number of turns for each policy.')
+def chunking(speech_seconds, endpoint_silence, audio_iter_size,
+             audio_in_min_chunk_size, turns):
+    """Compare the chunking policies of recorded audio.
+
+    Each turn captures speech in real time, sent to a fake server
+    sending END_OF_UTTERANCE once the speech and endpoint-silence
+    seconds of trailing silence were received. Server endpoints do not
+    align with chunks: the endpoint of each turn moves by a fraction of
+    audio-iter-size. Reports the mean audio_in messages and framing
+    bytes sent per second until the endpoint, the time to the first
+    audio_in message and the delay from the endpoint to the reception of
+    END_OF_UTTERANCE.
+    """
+    np = codec_helpers.np
+    if np is None:
+        click.echo('NumPy is required for voice activity detection.')
+        return
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    data = speech_like(speech_seconds, endpoint_silence + 1.0,
+                       sample_rate).tobytes()
+    bytes_per_second = float(sample_rate * sample_width)
+    results = dict((mode, []) for mode in audio_helpers.CHUNKING_POLICIES)
+    for turn in range(turns):
+        end_of_utterance_size = int(
+            (speech_seconds + endpoint_silence) * bytes_per_second +
+            turn * audio_iter_size // turns) // sample_width * sample_width
+        utterance_seconds = end_of_utterance_size / bytes_per_second
+        with fakeassistant.serve_in_subprocess(
+                end_of_utterance_size=end_of_utterance_size) as address:
+            channel = grpc.insecure_channel(address)
+            for mode in audio_helpers.CHUNKING_POLICIES:
+                chunk_policy = None
+                if mode != audio_helpers.FIXED_CHUNKS:
+                    chunk_policy = audio_helpers.GrowingChunkPolicy(
+                        audio_in_min_chunk_size, audio_iter_size,
+                        sample_width=sample_width)
+                if mode == audio_helpers.VAD_CHUNKS:
+                    chunk_policy = vad_helpers.create_vad_chunk_policy(
+                        chunk_policy, sample_rate, sample_width)
+                tracer = trace_helpers.TurnTracer()
+                source = SimulatedCapture(data, sample_rate, sample_width)
+                stream = audio_helpers.ConversationStream(
+                    source=source, sink=NullSink(),
+                    iter_size=audio_iter_size, sample_width=sample_width,
+                    chunk_policy=chunk_policy)
+                assistant = pushtotalk.SampleAssistant(
+                    'en-US', 'device-model-id', 'device-id', stream, False,
+                    channel, pushtotalk.DEFAULT_GRPC_DEADLINE, None,
+                    tracer=tracer)
+                assistant.assist()
+                span = tracer.last_span
+                # Chunks sent until the server endpoint.
+                sizes = []
+                for size in source.sizes:
+                    if sum(sizes) >= end_of_utterance_size:
+                        break
+                    sizes.append(size)
+                results[mode].append((
+                    len(sizes) / utterance_seconds,
+                    sum(framing_overhead(size)
+                        for size in sizes) / utterance_seconds,
+                    span.elapsed(trace_helpers.FIRST_AUDIO_IN),
+                    span.elapsed(trace_helpers.END_OF_UTTERANCE) -
+                    utterance_seconds))
+            channel.close()
+    click.echo('%-10s %12s %16s %18s %10s' % (
+        'chunking', 'messages/s', 'overhead (B/s)', 'first audio (ms)',
+        'eou (ms)'))
+    for mode in audio_helpers.CHUNKING_POLICIES:
+        rate, overhead, first_audio, eou = np.mean(results[mode], axis=0)
+        click.echo('%-10s %12.1f %16.0f %18.1f %10.1f' % (
+            mode, rate, overhead, 1000 * first_audio, 1000 * eou))
+
+
+class SimulatedMicrophone(object):
+    """Sound device capturing in real time after a start latency.
+
+    Each sample holds its index since the epoch modulo 65536, so that
+    readers can tell when the audio they received was captured.
+    """
+    def __init__(self, sample_rate, start_latency, epoch):
+        self._sample_rate = sample_rate
+        self._start_latency = start_latency
+        self._epoch = epoch
+        self._position = None
+
+    def start(self):
+        if self._position is None:
+            time.sleep(self._start_latency)
+            self._position = int((timeit.default_timer() - self._epoch) *
+                                 self._sample_rate)
+
+    def stop(self):
+        self._position = None
+
+    def close(self):
+        self.stop()
+
+    def read(self, size):
+        np = codec_helpers.np
+        frames = size // 2
+        end = self._position + frames
+        delay = (self._epoch + end / float(self._sample_rate) -
+                 timeit.default_timer())
+        if delay > 0:
+            time.sleep(delay)
+        data = np.arange(self._position, end).astype('<u2').tobytes()
+        self._position = end
+        return data
+
+
+@cli.command()
+@click.option('--turns', default=5,
+              metavar='<turns>', show_default=True,
+              help='Number of recordings.')
+@click.option('--start-latency-ms', default=150,
+              metavar='<milliseconds>', show_default=True,
+              help='Simulated startup latency of the audio device.')
+@click.option('--pre-roll-ms', default=300,
+              metavar='<milliseconds>', show_default=True,
+              help='Pre-roll of the always open capture.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+def preroll(turns, start_latency_ms, pre_roll_ms, audio_iter_size):
+    """Compare recordings starting the device and always open capture.
+
+    Reports the delay from start_recording to the first audio chunk and
+    when the first sample of the recording was captured relative to
+    start_recording: positive offsets are clipped speech.
+    """
+    np = codec_helpers.np
+    if np is None:
+        click.echo('NumPy is required to time the captured audio.')
+        return
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    epoch = timeit.default_timer()
+    click.echo('%-12s %18s %18s' % ('capture', 'first chunk (ms)',
+                                    'audio offset (ms)'))
+    for mode in ('cold', 'always-open'):
+        source = SimulatedMicrophone(sample_rate, start_latency_ms / 1000.0,
+                                     epoch)
+        if mode != 'cold':
+            source = audio_helpers.AlwaysOpenSource(
+                source, sample_rate, sample_width, pre_roll_ms,
+                chunk_size=audio_iter_size)
+        stream = audio_helpers.ConversationStream(
+            source=source, sink=NullSink(), iter_size=audio_iter_size,
+            sample_width=sample_width)
+        latencies = []
+        offsets = []
+        for _ in range(turns):
+            # Leave the device idle between recordings.
+            time.sleep(0.5)
+            started = timeit.default_timer()
+            stream.start_recording()
+            first = stream.read(audio_iter_size)
+            latencies.append(timeit.default_timer() - started)
+            expected = (started - epoch) * sample_rate
+            index = int(np.frombuffer(first, dtype='<u2')[0])
+            # Unwrap the sample index nearest to the expected one.
+            index += int(round((expected - index) / 65536.0)) * 65536
+            offsets.append((index - expected) / sample_rate)
+            stream.stop_recording()
+        stream.close()
+        click.echo('%-12s %18.1f %18.1f' % (
+            mode, 1000 * np.median(latencies), 1000 * np.median(offsets)))
+
+
+def echo_path(filter_ms, gain, sample_rate, delay_ms=10):
+    """Returns a synthetic room impulse response with the given gain."""
+    np = codec_helpers.np
+    rng = np.random.RandomState(1)
+    delay = int(sample_rate * delay_ms / 1000)
+    size = int(sample_rate * filter_ms / 1000) - delay
+    response = np.zeros(delay + size)
+    # Reflections decaying by 60dB over the filter length.
+    response[delay:] = rng.normal(0, 1, size) * np.exp(
+        -np.arange(size) * 6.9 / size)
+    return response * gain / np.sqrt((response ** 2).sum())
+
+
+@cli.command()
+@click.option('--audio-seconds', default=10.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the played audio.')
+@click.option('--filter-ms', default=aec_helpers.DEFAULT_FILTER_MS,
+              metavar='<milliseconds>', show_default=True,
+              help='Length of the echo canceller filter.')
+@click.option('--echo-gain', default=0.2,
+              metavar='<gain>', show_default=True,
+              help='Gain of the echo path from the speaker to the microphone.')
+@click.option('--device-latency-ms', default=150,
+              metavar='<milliseconds>', show_default=True,
+              help='Output and input latency of the simulated sound device.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+def aec(audio_seconds, filter_ms, echo_gain, device_latency_ms,
+        audio_iter_size):
+    """Measure the CPU cost and echo reduction of echo cancellation.
+
+    The microphone records the played audio through a synthetic echo
+    path shorter than the filter, after the latency of the sound device,
+    with a low level of noise. The echo return loss enhancement (ERLE)
+    is reported for each second, with the reference delayed by the
+    device latency and without delay.
+    """
+    np = codec_helpers.np
+    if np is None:
+        click.echo('NumPy is required for echo cancellation.')
+        return
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    played = speech_like(audio_seconds, 0, sample_rate)
+    response = echo_path(filter_ms * 0.75, echo_gain, sample_rate)
+    rng = np.random.RandomState(0)
+    latency = np.zeros(int(sample_rate * device_latency_ms / 1000))
+    mic = (np.concatenate((latency, np.convolve(played, response)))[
+        :len(played)] + rng.normal(0, 10, len(played))).astype('<i2')
+    played = played.tobytes()
+    mic = mic.tobytes()
+
+    def cancel(delay_ms):
+        canceller = aec_helpers.EchoCanceller(sample_rate, sample_width,
+                                              filter_ms=filter_ms,
+                                              delay_ms=delay_ms)
+        cleaned = []
+        for i in range(0, len(mic), audio_iter_size):
+            canceller.add_reference(played[i:i + audio_iter_size])
+            cleaned.append(canceller.process(mic[i:i + audio_iter_size]))
+        return np.frombuffer(b''.join(cleaned), dtype='<i2')[
+            canceller.block_size:].astype(np.float64)
+
+    cpu_start = cpu_time()
+    cleaned = cancel(device_latency_ms)
+    report('aec', cpu_time() - cpu_start, audio_seconds)
+    undelayed = cancel(0)
+    recorded = np.frombuffer(mic, dtype='<i2')[:len(cleaned)].astype(
+        np.float64)
+
+    def erle(second, cleaned):
+        return 10 * np.log10((recorded[second] ** 2).sum() /
+                             ((cleaned[second] ** 2).sum() + 1.0))
+    click.echo('%-8s %18s %18s' % ('second', 'erle delayed (dB)',
+                                   'erle (dB)'))
+    for i in range(0, len(cleaned) // sample_rate):
+        second = slice(i * sample_rate, (i + 1) * sample_rate)
+        click.echo('%-8d %18.1f %18.1f' % (i + 1, erle(second, cleaned),
+                                           erle(second, undelayed)))
+
+
+class SimulatedSpeaker(object):
+    """Sound device playing in real time from a small device buffer.
+
+    Writes block while the device buffer is full. A write arriving after
+    the device played all the audio is an underflow.
+    """
+    def __init__(self, sample_rate, sample_width, buffer_ms=40):
+        self._bytes_per_second = sample_rate * sample_width
+        self._buffer = buffer_ms / 1000.0
+        self.start()
+
+    def start(self):
+        self._end = None
+        self.first_sound = None
+        self.underflows = 0
+        self.gap_seconds = 0
+
+    def write(self, buf):
+        now = timeit.default_timer()
+        if self._end is None:
+            self._end = self.first_sound = now
+        elif now > self._end:
+            self.underflows += 1
+            self.gap_seconds += now - self._end
+            self._end = now
+        # Block until the device buffer has room.
+        delay = self._end - self._buffer - now
+        if delay > 0:
+            time.sleep(delay)
+        self._end += len(buf) / float(self._bytes_per_second)
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@cli.command()
+@click.option('--audio-seconds', default=5.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the response audio.')
+@click.option('--chunk-ms', default=100,
+              metavar='<milliseconds>', show_default=True,
+              help='Duration of each audio_out chunk.')
+@click.option('--jitter-ms', default=40,
+              metavar='<milliseconds>', show_default=True,
+              help='Mean of the exponentially distributed chunk delays.')
+@click.option('--jitter-buffer-ms',
+              default=audio_helpers.DEFAULT_JITTER_BUFFER_MS,
+              metavar='<milliseconds>', show_default=True,
+              help='Initial target depth of the jitter buffer.')
+def jitter(audio_seconds, chunk_ms, jitter_ms, jitter_buffer_ms):
+    """Compare playback of jittery audio_out with and without buffer.
+
+    Chunks are sent at the playback rate, each delayed by a random
+    network jitter, to a simulated speaker with a 40ms device buffer.
+    """
+    np = codec_helpers.np
+    if np is None:
+        click.echo('NumPy is required to simulate the network jitter.')
+        return
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    sample_width = audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH
+    chunk = b'\0' * (int(sample_rate * chunk_ms / 1000) * sample_width)
+    count = int(audio_seconds * 1000 / chunk_ms)
+    delays = np.random.RandomState(0).exponential(jitter_ms / 1000.0, count)
+    click.echo('%-8s %10s %10s %16s %14s' % (
+        'buffer', 'underflows', 'gaps (ms)', 'first sound (ms)',
+        'target (ms)'))
+    for mode in ('none', 'jitter'):
+        speaker = SimulatedSpeaker(sample_rate, sample_width)
+        tracer = trace_helpers.TurnTracer()
+        sink = speaker
+        if mode == 'jitter':
+            sink = audio_helpers.JitterBuffer(
+                speaker, sample_rate, sample_width,
+                target_ms=jitter_buffer_ms, tracer=tracer)
+        stream = audio_helpers.ConversationStream(
+            source=None, sink=sink, iter_size=len(chunk),
+            sample_width=sample_width)
+        stream.volume_percentage = 100
+        stream.start_playback()
+        start = timeit.default_timer()
+        for i in range(count):
+            # Chunks are sent in order: a late chunk delays the next ones.
+            delay = start + i * chunk_ms / 1000.0 + delays[i] - \
+                timeit.default_timer()
+            if delay > 0:
+                time.sleep(delay)
+            stream.write(chunk)
+        stream.stop_playback()
+        target = tracer.gauges.get(
+            (trace_helpers.PLAYBACK_TARGET_DEPTH_METRIC, ()))
+        click.echo('%-8s %10d %10.0f %16.0f %14s' % (
+            mode, speaker.underflows, 1000 * speaker.gap_seconds,
+            1000 * (speaker.first_sound - start),
+            '-' if target is None else '%.0f' % (1000 * target)))
+
+
+@cli.command()
+@click.option('--audio-seconds', default=10.0,
+              metavar='<seconds>', show_default=True,
+              help='Duration of the resampled audio.')
+@click.option('--device-sample-rate', multiple=True,
+              default=(44100, 48000), type=int,
+              metavar='<device sample rate>', show_default=True,
+              help='Sample rate of the audio device.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+def resample(audio_seconds, device_sample_rate, audio_iter_size):
+    """Measure the CPU cost of resampling audio from and to devices.
+
+    Capture converts from the device rate to the API rate, playback from
+    the API rate to the device rate, both in chunks of audio iter size.
+    """
+    if codec_helpers.np is None:
+        click.echo('NumPy is required for resampling.')
+        return
+    sample_rate = audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE
+    duration = audio_iter_size / float(sample_rate * 2)
+    for device_rate in device_sample_rate:
+        for name, in_rate, out_rate in (('capture', device_rate, sample_rate),
+                                        ('playback', sample_rate,
+                                         device_rate)):
+            data = speech_like(audio_seconds, 0, in_rate).tobytes()
+            size = int(in_rate * duration) * 2
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+
+            def convert():
+                resampler = audio_helpers.Resampler(in_rate, out_rate)
+                for c in chunks:
+                    resampler.process(c)
+            report('%s %d' % (name, device_rate), best_of(convert, 3),
+                   audio_seconds)
+
+
+def main():
+    cli()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper functions for audio encodings."""
+
+import logging
+import struct
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+LINEAR16 = 'LINEAR16'
+FLAC = 'FLAC'
+MP3 = 'MP3'
+OPUS_IN_OGG = 'OPUS_IN_OGG'
+AUDIO_IN_ENCODINGS = (LINEAR16, FLAC)
+AUDIO_OUT_ENCODINGS = (LINEAR16, MP3, OPUS_IN_OGG)
+
+FLAC_MIN_BLOCK_SIZE = 16
+FLAC_MAX_BLOCK_SIZE = 65535
+FLAC_MAX_FIXED_ORDER = 4
+FLAC_MAX_RICE_PARAMETER = 14
+
+OPUS_SAMPLE_RATE = 48000
+PCM_FORMATS = {2: 's16', 4: 's32'}
+
+
+def _crc_table(poly, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for i in range(256):
+        crc = i << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & top else (crc << 1)
+        table.append(crc & mask)
+    return table
+
+
+_CRC8_TABLE = _crc_table(0x07, 8)
+_CRC16_TABLE = _crc_table(0x8005, 16)
+
+
+def crc8(data):
+    """CRC-8 of a FLAC frame header."""
+    crc = 0
+    for b in bytearray(data):
+        crc = _CRC8_TABLE[crc ^ b]
+    return crc
+
+
+def crc16(data):
+    """CRC-16 of a FLAC frame."""
+    crc = 0
+    for b in bytearray(data):
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[(crc >> 8) ^ b]
+    return crc
+
+
+def _utf8_coded(value):
+    """FLAC extended UTF-8 coding of a frame or sample number."""
+    if value < 0x80:
+        return bytearray([value])
+    for count in range(2, 8):
+        if value < (1 << (5 * count + 1)) or count == 7:
+            break
+    out = bytearray()
+    for _ in range(count - 1):
+        out.insert(0, 0x80 | (value & 0x3f))
+        value >>= 6
+    out.insert(0, ((0xff00 >> count) & 0xff) | value)
+    return out
+
+
+def _int_bits(values, width):
+    """Returns the big-endian two's complement bits of values."""
+    shifts = np.arange(width - 1, -1, -1, dtype=np.int64)
+    return ((np.asarray(values, dtype=np.int64)[:, None] >> shifts) & 1
+            ).astype(np.uint8).ravel()
+
+
+def _rice_parameter(u):
+    """Returns (parameter, bits) minimizing the Rice coded size of u."""
+    n = len(u)
+    best = None
+    for k in range(FLAC_MAX_RICE_PARAMETER + 1):
+        bits = int(np.sum(u >> k)) + n * (k + 1)
+        if best is None or bits < best[1]:
+            best = (k, bits)
+        if not np.any(u >> k):
+            break
+    return best
+
+
+def _rice_bits(u, k):
+    """Returns the Rice coded bits of the unsigned values u."""
+    q = u >> k
+    lengths = q + 1 + k
+    starts = np.cumsum(lengths) - lengths
+    bits = np.zeros(int(np.sum(lengths)), dtype=np.uint8)
+    stops = starts + q
+    bits[stops] = 1
+    for j in range(k):
+        bits[stops + 1 + j] = (u >> (k - 1 - j)) & 1
+    return bits
+
+
+class FlacEncoder(object):
+    """Streaming FLAC encoder for mono PCM audio.
+
+    Each call to encode turns the given PCM chunk into a single FLAC
+    frame, so the only added latency is the encoding time. Frames use
+    fixed linear predictors with Rice coded residuals, and fall back to
+    verbatim or constant subframes when those are smaller. The variable
+    block size strategy lets chunks of any size be encoded.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes (2).
+    """
+    def __init__(self, sample_rate, sample_width):
+        if np is None:
+            raise Exception('FLAC encoding requires NumPy')
+        if sample_width != 2:
+            raise Exception('unsupported sample width:', sample_width)
+        self._sample_rate = sample_rate
+        self._sample_width = sample_width
+        self._bits_per_sample = 8 * sample_width
+        self._dtype = np.dtype('<i%d' % sample_width)
+        self._pending = bytearray()
+        self._sample_number = 0
+        self._header_sent = False
+
+    def stream_header(self):
+        """Returns the fLaC marker and STREAMINFO metadata block.
+
+        Frame sizes, total samples and MD5 signature are left unknown.
+        """
+        streaminfo = struct.pack(
+            '>HH3s3sQ16x',
+            FLAC_MIN_BLOCK_SIZE, FLAC_MAX_BLOCK_SIZE,
+            b'\0\0\0', b'\0\0\0',
+            (self._sample_rate << 44) |
+            (0 << 41) |  # channels - 1
+            ((self._bits_per_sample - 1) << 36)  # total samples unknown
+        )
+        # Last metadata block flag and STREAMINFO type.
+        header = struct.pack('>I', (1 << 31) | len(streaminfo))
+        return b'fLaC' + header + streaminfo
+
+    def encode(self, data):
+        """Encode a PCM chunk.
+
+        The stream header is prepended to the first encoded data. Chunks
+        shorter than the FLAC minimum block size are held back until
+        enough samples are available.
+
+        Args:
+          data: bytes-like object of little-endian PCM samples.
+
+        Returns: bytes of encoded FLAC data, possibly empty.
+        """
+        self._pending.extend(data)
+        samples = len(self._pending) // self._sample_width
+        if samples < FLAC_MIN_BLOCK_SIZE:
+            return self._take_header()
+        return self._take_header() + self._encode_pending(samples)
+
+    def flush(self):
+        """Encode any remaining samples as the last frame."""
+        samples = len(self._pending) // self._sample_width
+        if not samples:
+            return self._take_header()
+        return self._take_header() + self._encode_pending(samples)
+
+    def _take_header(self):
+        if self._header_sent:
+            return b''
+        self._header_sent = True
+        return self.stream_header()
+
+    def _encode_pending(self, samples):
+        size = samples * self._sample_width
+        x = np.frombuffer(bytes(self._pending[:size]),
+                          dtype=self._dtype).astype(np.int64)
+        del self._pending[:size]
+        frames = []
+        for start in range(0, samples, FLAC_MAX_BLOCK_SIZE):
+            frames.append(self.encode_frame(
+                x[start:start + FLAC_MAX_BLOCK_SIZE]))
+        return b''.join(frames)
+
+    def encode_frame(self, x):
+        """Encode a block of samples as a FLAC frame.
+
+        Args:
+          x: numpy array of int64 samples.
+        """
+        n = len(x)
+        # Sync code, variable block size, 16-bit (block size - 1) at the
+        # end of the header, sample rate from STREAMINFO, mono, 16 bits.
+        header = bytearray(struct.pack('>HBB', 0xfff9, 0x70,
+                                       0x08 if self._bits_per_sample == 16
+                                       else 0x0c))
+        header += _utf8_coded(self._sample_number)
+        header += struct.pack('>H', n - 1)
+        header.append(crc8(header))
+        self._sample_number += n
+        frame = header + np.packbits(self._subframe_bits(x)).tobytes()
+        return bytes(frame + struct.pack('>H', crc16(frame)))
+
+    def _subframe_bits(self, x):
+        bps = self._bits_per_sample
+        if np.all(x == x[0]):
+            return np.concatenate([_int_bits([0b00000000], 8),
+                                   _int_bits(x[:1], bps)])
+        best = (n_bits_verbatim(len(x), bps), None, None)
+        for order in range(min(FLAC_MAX_FIXED_ORDER, len(x) - 1) + 1):
+            residual = np.diff(x, n=order) if order else x
+            u = np.where(residual >= 0, 2 * residual, -2 * residual - 1)
+            k, bits = _rice_parameter(u)
+            bits += 8 + order * bps + 2 + 4 + 4
+            if bits < best[0]:
+                best = (bits, order, (u, k))
+        _, order, rice = best
+        if order is None:
+            return np.concatenate([_int_bits([0b00000010], 8),
+                                   _int_bits(x, bps)])
+        u, k = rice
+        # Fixed predictor subframe, residual coding method 0 with a
+        # single partition.
+        return np.concatenate([
+            _int_bits([0b00010000 | (order << 1)], 8),
+            _int_bits(x[:order], bps),
+            _int_bits([0b00], 2),
+            _int_bits([0], 4),
+            _int_bits([k], 4),
+            _rice_bits(u, k),
+        ])
+
+
+def n_bits_verbatim(n, bits_per_sample):
+    """Size in bits of a verbatim subframe of n samples."""
+    return 8 + n * bits_per_sample
+
+
+def create_audio_in_encoder(encoding, sample_rate, sample_width):
+    """Create an encoder for the requested audio_in encoding.
+
+    Falls back to LINEAR16 when the encoding is not available.
+
+    Returns: (encoding, encoder) tuple of the selected encoding and its
+    encoder, None for LINEAR16.
+    """
+    if encoding == FLAC:
+        try:
+            return FLAC, FlacEncoder(sample_rate, sample_width)
+        except Exception as e:
+            logging.warning('FLAC encoding not available (%s), '
+                            'falling back to LINEAR16', e)
+    return LINEAR16, None
+
+
+def encode_chunks(encoder, chunks):
+    """Yields: encoded data of each chunk, followed by the last frame."""
+    for chunk in chunks:
+        data = encoder.encode(chunk)
+        if data:
+            yield data
+    data = encoder.flush()
+    if data:
+        yield data
+
+
+class OggDemuxer(object):
+    """Incremental demuxer of the packets of an Ogg stream.
+
+    Packets are returned as soon as their data is received, without
+    waiting for the end of their page. Only the first logical bitstream
+    is kept.
+    """
+    def __init__(self):
+        self._buf = bytearray()
+        self._packet = bytearray()
+        self._lacing = []
+        self._keep = True
+        self._serial = None
+
+    def feed(self, data):
+        """Add data to the stream.
+
+        Returns: list of the packets completed by data.
+        """
+        self._buf.extend(data)
+        packets = []
+        while True:
+            if not self._lacing and not self._read_page_header():
+                break
+            size = self._lacing[0]
+            if len(self._buf) < size:
+                break
+            self._lacing.pop(0)
+            if self._keep:
+                self._packet.extend(self._buf[:size])
+                if size < 255:
+                    packets.append(bytes(self._packet))
+                    del self._packet[:]
+            del self._buf[:size]
+        return packets
+
+    def _read_page_header(self):
+        while len(self._buf) >= 27:
+            if self._buf[:4] != b'OggS':
+                raise ValueError('invalid Ogg page')
+            header_size = 27 + self._buf[26]
+            if len(self._buf) < header_size:
+                return False
+            serial, = struct.unpack_from('<I', self._buf, 14)
+            if self._serial is None:
+                self._serial = serial
+            self._keep = serial == self._serial
+            self._lacing = list(bytearray(self._buf[27:header_size]))
+            del self._buf[:header_size]
+            if self._lacing:
+                return True
+        return False
+
+
+class _AVDecoder(object):
+    """Conversion of the audio frames decoded by PyAV to PCM.
+
+    Subclasses create the PyAV codec context as _codec and define
+    decode(data), see create_audio_out_decoder.
+
+    Args:
+      sample_rate: sample rate in hertz of the decoded PCM.
+      sample_width: size of a single decoded sample in bytes.
+    """
+    def __init__(self, sample_rate, sample_width):
+        if av is None:
+            raise Exception('audio decoding requires PyAV')
+        if sample_width not in PCM_FORMATS:
+            raise Exception('unsupported sample width:', sample_width)
+        self._sample_width = sample_width
+        self._resampler = av.AudioResampler(
+            format=PCM_FORMATS[sample_width], layout='mono',
+            rate=sample_rate)
+        self._skip = 0
+
+    def flush(self):
+        """Returns: bytes of the remaining decoded PCM samples."""
+        return self._pcm(self._codec.decode(None) + [None])
+
+    def _pcm(self, frames):
+        pcm = bytearray()
+        for frame in frames:
+            for f in self._resampler.resample(frame):
+                pcm.extend(
+                    memoryview(f.planes[0])[:f.samples * self._sample_width])
+        if self._skip:
+            skip = min(self._skip, len(pcm))
+            del pcm[:skip]
+            self._skip -= skip
+        return bytes(pcm)
+
+
+class Mp3Decoder(_AVDecoder):
+    """Incremental decoder of MP3 audio to PCM.
+
+    A leading ID3v2 tag is skipped.
+    """
+    def __init__(self, sample_rate, sample_width):
+        super(Mp3Decoder, self).__init__(sample_rate, sample_width)
+        self._codec = av.CodecContext.create('mp3', 'r')
+        self._header = bytearray()
+        self._tag_size = None
+
+    def decode(self, data):
+        if self._tag_size != 0:
+            data = self._skip_tag(data)
+        frames = []
+        for packet in self._codec.parse(bytes(data)):
+            frames.extend(self._codec.decode(packet))
+        return self._pcm(frames)
+
+    def flush(self):
+        frames = []
+        for packet in self._codec.parse(None):
+            frames.extend(self._codec.decode(packet))
+        return self._pcm(frames) + super(Mp3Decoder, self).flush()
+
+    def _skip_tag(self, data):
+        self._header.extend(data)
+        if self._tag_size is None:
+            if len(self._header) < 10:
+                return b''
+            self._tag_size = 0
+            if self._header[:3] == b'ID3':
+                # Syncsafe tag size, excluding the header and footer.
+                for b in bytearray(self._header[6:10]):
+                    self._tag_size = (self._tag_size << 7) | (b & 0x7f)
+                self._tag_size += 20 if self._header[5] & 0x10 else 10
+        skip = min(self._tag_size, len(self._header))
+        self._tag_size -= skip
+        data = bytes(self._header[skip:])
+        del self._header[:]
+        return data
+
+
+class OggOpusDecoder(_AVDecoder):
+    """Incremental decoder of Opus audio in an Ogg container to PCM."""
+    def __init__(self, sample_rate, sample_width):
+        super(OggOpusDecoder, self).__init__(sample_rate, sample_width)
+        self._sample_rate = sample_rate
+        self._demuxer = OggDemuxer()
+        self._codec = None
+        self._headers = 0
+
+    def decode(self, data):
+        frames = []
+        for packet in self._demuxer.feed(data):
+            if self._headers == 0:
+                self._codec = self._open(packet)
+            if self._headers < 2:
+                # OpusHead and OpusTags header packets.
+                self._headers += 1
+                continue
+            frames.extend(self._codec.decode(av.Packet(packet)))
+        return self._pcm(frames)
+
+    def flush(self):
+        if self._codec is None:
+            return b''
+        return super(OggOpusDecoder, self).flush()
+
+    def _open(self, head):
+        if head[:8] != b'OpusHead':
+            raise ValueError('invalid OpusHead packet')
+        channels = bytearray(head)[9]
+        pre_skip, = struct.unpack_from('<H', head, 10)
+        # Pre-skip is counted at 48 kHz.
+        self._skip = (pre_skip * self._sample_rate // OPUS_SAMPLE_RATE *
+                      self._sample_width)
+        codec = av.CodecContext.create('opus', 'r')
+        codec.extradata = bytes(head)
+        codec.sample_rate = OPUS_SAMPLE_RATE
+        codec.layout = 'mono' if channels == 1 else 'stereo'
+        return codec
+
+
+AUDIO_OUT_DECODERS = {
+    MP3: Mp3Decoder,
+    OPUS_IN_OGG: OggOpusDecoder,
+}
+
+
+def create_audio_out_decoder(encoding, sample_rate, sample_width):
+    """Create a decoder for the given audio_out encoding.
+
+    Decoders are incremental: decode(data) takes a chunk of compressed
+    audio and returns the bytes of the PCM samples decoded so far,
+    possibly empty, and flush() returns the remaining PCM samples.
+
+    Returns: decoder converting the encoding to PCM, None for LINEAR16.
+    """
+    if encoding == LINEAR16:
+        return None
+    return AUDIO_OUT_DECODERS[encoding](sample_rate, sample_width)
+
+
+def select_audio_out_encoding(encoding, sample_rate, sample_width):
+    """Returns: encoding if it can be decoded, LINEAR16 otherwise."""
+    try:
+        create_audio_out_decoder(encoding, sample_rate, sample_width)
+        return encoding
+    except Exception as e:
+        logging.warning('%s decoding not available (%s), '
+                        'falling back to LINEAR16', encoding, e)
+    return LINEAR16
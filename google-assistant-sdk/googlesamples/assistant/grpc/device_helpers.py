@@ -81,12 +81,16 @@ class DeviceRequestHandler(object):
                 logging.warning('Ignoring noop execution')
                 continue
             for command in execution:
-                f = self.executor.submit(
-                    self.dispatch_command, **command
-                )
-                fs.append(f)
+                fs.append(self.schedule_command(command))
         return fs
 
+    def schedule_command(self, command):
+        """Schedule a single command execution.
+
+        Returns: a future for the scheduled execution.
+        """
+        return self.executor.submit(self.dispatch_command, **command)
+
     def dispatch_command(self, command, params=None):
         """Dispatch device commands to the appropriate handler."""
         try:
@@ -0,0 +1,398 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-in for the Google Assistant API."""
+
+import concurrent.futures
+import contextlib
+import logging
+import multiprocessing
+import random
+import time
+
+import click
+import grpc
+
+from google.assistant.embedded.v1alpha1 import (
+    embedded_assistant_pb2 as v1alpha1_pb2,
+    embedded_assistant_pb2_grpc as v1alpha1_pb2_grpc
+)
+from google.assistant.embedded.v1alpha2 import (
+    embedded_assistant_pb2,
+    embedded_assistant_pb2_grpc
+)
+
+
+END_OF_UTTERANCE = embedded_assistant_pb2.AssistResponse.END_OF_UTTERANCE
+HTML = embedded_assistant_pb2.ScreenOut.HTML
+DEFAULT_END_OF_UTTERANCE_SIZE = 32000
+DEFAULT_AUDIO_OUT_SIZE = 1600
+DEFAULT_AUDIO_OUT_COUNT = 10
+DEFAULT_MAX_WORKERS = 256
+API_VERSIONS = ('v1alpha2', 'v1alpha1')
+
+
+class FakeAssistant(object):
+    """Scripted behavior shared by the fake servicers.
+
+    Each call waits for the end of the user utterance, then replies with
+    the transcript, dialog state, optional device action and screen out,
+    and the audio response. Delays may be injected at each step, with up
+    to jitter seconds of uniform random noise added to each of them.
+
+    Args:
+      transcript: transcript of the user request.
+      display_text: supplemental display text of the response.
+      end_of_utterance_size: audio_in bytes received before
+        END_OF_UTTERANCE is sent, text queries end right away.
+      end_of_utterance_delay: seconds between the end of the utterance
+        and the END_OF_UTTERANCE event.
+      response_delay: seconds between END_OF_UTTERANCE and the response.
+      audio_out_size: size in bytes of each audio_out chunk.
+      audio_out_count: number of audio_out chunks.
+      audio_out_data: audio response to send in audio_out_size chunks,
+        instead of audio_out_count chunks of silence.
+      audio_out_rate: audio_out bytes sent per second, 0 sends all the
+        chunks at once.
+      microphone_mode: CLOSE_MICROPHONE or DIALOG_FOLLOW_ON.
+      volume_percentage: volume setting to send, 0 leaves it unchanged.
+      conversation_state: opaque conversation state to send.
+      device_request_json: device action request JSON to send.
+      screen_out_html: HTML screen out data to send (v1alpha2 only).
+      jitter: maximum random delay in seconds added to each delay.
+      seed: seed of the jitter random generator.
+    """
+
+    def __init__(self, transcript='what time is it',
+                 display_text='It is time.',
+                 end_of_utterance_size=DEFAULT_END_OF_UTTERANCE_SIZE,
+                 end_of_utterance_delay=0,
+                 response_delay=0,
+                 audio_out_size=DEFAULT_AUDIO_OUT_SIZE,
+                 audio_out_count=DEFAULT_AUDIO_OUT_COUNT,
+                 audio_out_data=None,
+                 audio_out_rate=0,
+                 microphone_mode='CLOSE_MICROPHONE',
+                 volume_percentage=0,
+                 conversation_state=b'fake-conversation-state',
+                 device_request_json=None,
+                 screen_out_html=None,
+                 jitter=0,
+                 seed=None):
+        self.transcript = transcript
+        self.display_text = display_text
+        self.end_of_utterance_size = end_of_utterance_size
+        self.end_of_utterance_delay = end_of_utterance_delay
+        self.response_delay = response_delay
+        self.audio_out_size = audio_out_size
+        self.audio_out_count = audio_out_count
+        self.audio_out_data = audio_out_data
+        self.audio_out_rate = audio_out_rate
+        self.microphone_mode = microphone_mode
+        self.volume_percentage = volume_percentage
+        self.conversation_state = conversation_state
+        self.device_request_json = device_request_json
+        self.screen_out_html = screen_out_html
+        self.jitter = jitter
+        self._random = random.Random(seed)
+
+    def delay(self, seconds):
+        """Sleep for seconds plus random jitter."""
+        if self.jitter:
+            seconds += self._random.uniform(0, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait_for_end_of_utterance(self, request_iterator):
+        """Consume audio_in requests until the end of the utterance.
+
+        Returns: the number of audio bytes received.
+        """
+        received = 0
+        for req in request_iterator:
+            received += len(req.audio_in)
+            if received >= self.end_of_utterance_size:
+                break
+        self.delay(self.end_of_utterance_delay)
+        return received
+
+    def audio_out_chunks(self):
+        """Yields: audio_out data paced at audio_out_rate."""
+        if self.audio_out_data is None:
+            chunks = [b'\0' * self.audio_out_size] * self.audio_out_count
+        else:
+            chunks = [self.audio_out_data[i:i + self.audio_out_size]
+                      for i in range(0, len(self.audio_out_data),
+                                     self.audio_out_size)]
+        interval = (float(self.audio_out_size) / self.audio_out_rate
+                    if self.audio_out_rate else 0)
+        for i, audio_data in enumerate(chunks):
+            if i:
+                self.delay(interval)
+            yield audio_data
+
+
+class FakeEmbeddedAssistantServicer(
+        FakeAssistant,
+        embedded_assistant_pb2_grpc.EmbeddedAssistantServicer):
+    """Fake v1alpha2 servicer replying to Assist calls.
+
+    See FakeAssistant for arguments.
+    """
+
+    def Assist(self, request_iterator, context):
+        config = next(request_iterator).config
+        if not config.text_query:
+            self.wait_for_end_of_utterance(request_iterator)
+            yield embedded_assistant_pb2.AssistResponse(
+                event_type=END_OF_UTTERANCE
+            )
+            yield embedded_assistant_pb2.AssistResponse(
+                speech_results=[
+                    embedded_assistant_pb2.SpeechRecognitionResult(
+                        transcript=self.transcript, stability=1.0
+                    )
+                ]
+            )
+        self.delay(self.response_delay)
+        if self.screen_out_html and config.screen_out_config.screen_mode:
+            yield embedded_assistant_pb2.AssistResponse(
+                screen_out=embedded_assistant_pb2.ScreenOut(
+                    format=HTML, data=self.screen_out_html
+                )
+            )
+        yield embedded_assistant_pb2.AssistResponse(
+            dialog_state_out=embedded_assistant_pb2.DialogStateOut(
+                supplemental_display_text=self.display_text,
+                conversation_state=self.conversation_state,
+                microphone_mode=self.microphone_mode,
+                volume_percentage=self.volume_percentage,
+            )
+        )
+        if self.device_request_json:
+            yield embedded_assistant_pb2.AssistResponse(
+                device_action=embedded_assistant_pb2.DeviceAction(
+                    device_request_json=self.device_request_json
+                )
+            )
+        for audio_data in self.audio_out_chunks():
+            yield embedded_assistant_pb2.AssistResponse(
+                audio_out=embedded_assistant_pb2.AudioOut(
+                    audio_data=audio_data
+                )
+            )
+
+
+class FakeConverseServicer(FakeAssistant,
+                           v1alpha1_pb2_grpc.EmbeddedAssistantServicer):
+    """Fake v1alpha1 servicer replying to Converse calls.
+
+    See FakeAssistant for arguments, screen_out_html is ignored.
+    """
+
+    def Converse(self, request_iterator, context):
+        next(request_iterator)
+        self.wait_for_end_of_utterance(request_iterator)
+        yield v1alpha1_pb2.ConverseResponse(
+            event_type=v1alpha1_pb2.ConverseResponse.END_OF_UTTERANCE
+        )
+        self.delay(self.response_delay)
+        yield v1alpha1_pb2.ConverseResponse(
+            result=v1alpha1_pb2.ConverseResult(
+                spoken_request_text=self.transcript,
+                spoken_response_text=self.display_text,
+                conversation_state=self.conversation_state,
+                microphone_mode=self.microphone_mode,
+                volume_percentage=self.volume_percentage,
+            )
+        )
+        if self.device_request_json:
+            yield v1alpha1_pb2.ConverseResponse(
+                device_action=v1alpha1_pb2.DeviceAction(
+                    device_request_json=self.device_request_json
+                )
+            )
+        for audio_data in self.audio_out_chunks():
+            yield v1alpha1_pb2.ConverseResponse(
+                audio_out=v1alpha1_pb2.AudioOut(audio_data=audio_data)
+            )
+
+
+def create_servicer(api_version='v1alpha2', **kwargs):
+    """Create a fake servicer for the given API version."""
+    if api_version == 'v1alpha1':
+        return FakeConverseServicer(**kwargs)
+    return FakeEmbeddedAssistantServicer(**kwargs)
+
+
+def serve(servicer, address='localhost:0', max_workers=DEFAULT_MAX_WORKERS):
+    """Start a gRPC server for the given servicer.
+
+    Args:
+      servicer: EmbeddedAssistantServicer implementation.
+      address: address to listen on, port 0 picks a free port.
+      max_workers: maximum number of concurrent calls.
+
+    Returns: (server, port) tuple of the started server and bound port.
+    """
+    server = grpc.server(
+        concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    )
+    if isinstance(servicer, v1alpha1_pb2_grpc.EmbeddedAssistantServicer):
+        v1alpha1_pb2_grpc.add_EmbeddedAssistantServicer_to_server(
+            servicer, server
+        )
+    else:
+        embedded_assistant_pb2_grpc.add_EmbeddedAssistantServicer_to_server(
+            servicer, server
+        )
+    port = server.add_insecure_port(address)
+    server.start()
+    return server, port
+
+
+def _serve_forever(conn, max_workers, servicer_kwargs):
+    servicer = create_servicer(**servicer_kwargs)
+    server, port = serve(servicer, 'localhost:0', max_workers)
+    conn.send(port)
+    conn.close()
+    server.wait_for_termination()
+
+
+@contextlib.contextmanager
+def serve_in_subprocess(max_workers=DEFAULT_MAX_WORKERS, **servicer_kwargs):
+    """Run a fake servicer server in a child process.
+
+    Keeping the server out of the calling process leaves its CPU time
+    to the client being measured. The child is spawned rather than
+    forked, as gRPC does not support fork after it is imported.
+
+    Args:
+      max_workers: maximum number of concurrent calls.
+      servicer_kwargs: create_servicer arguments.
+
+    Yields: the address of the server, once it accepts connections.
+    """
+    # Python 2 has no start methods; it always forks.
+    context = (multiprocessing.get_context('spawn')
+               if hasattr(multiprocessing, 'get_context')
+               else multiprocessing)
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_serve_forever, args=(child_conn, max_workers, servicer_kwargs)
+    )
+    process.daemon = True
+    process.start()
+    child_conn.close()
+    try:
+        if not parent_conn.poll(30):
+            raise RuntimeError('fake assistant server failed to start')
+        address = 'localhost:%d' % parent_conn.recv()
+        channel = grpc.insecure_channel(address)
+        grpc.channel_ready_future(channel).result(timeout=10)
+        channel.close()
+        yield address
+    finally:
+        parent_conn.close()
+        process.terminate()
+        process.join()
+
+
+@click.command()
+@click.option('--address', default='localhost:50051',
+              metavar='<address>', show_default=True,
+              help='Address to listen on.')
+@click.option('--api-version', default='v1alpha2',
+              type=click.Choice(API_VERSIONS), show_default=True,
+              help='Version of the Google Assistant API to serve.')
+@click.option('--max-workers', default=DEFAULT_MAX_WORKERS,
+              metavar='<max workers>', show_default=True,
+              help='Maximum number of concurrent calls.')
+@click.option('--transcript', default='what time is it',
+              metavar='<transcript>', show_default=True,
+              help='Transcript of the user request.')
+@click.option('--display-text', default='It is time.',
+              metavar='<display text>', show_default=True,
+              help='Supplemental display text of the response.')
+@click.option('--end-of-utterance-size',
+              default=DEFAULT_END_OF_UTTERANCE_SIZE,
+              metavar='<size>', show_default=True,
+              help='Audio bytes received before END_OF_UTTERANCE.')
+@click.option('--end-of-utterance-delay', default=0.0,
+              metavar='<seconds>', show_default=True,
+              help='Delay before sending END_OF_UTTERANCE.')
+@click.option('--response-delay', default=0.0,
+              metavar='<seconds>', show_default=True,
+              help='Delay between END_OF_UTTERANCE and the response.')
+@click.option('--audio-out-size', default=DEFAULT_AUDIO_OUT_SIZE,
+              metavar='<size>', show_default=True,
+              help='Size in bytes of each audio_out chunk.')
+@click.option('--audio-out-count', default=DEFAULT_AUDIO_OUT_COUNT,
+              metavar='<count>', show_default=True,
+              help='Number of audio_out chunks per response.')
+@click.option('--audio-out-file', type=click.File('rb'),
+              metavar='<audio file>',
+              help=('Path to the audio response to send, in the encoding '
+                    'requested by the client. If missing, silence is sent.'))
+@click.option('--audio-out-rate', default=0,
+              metavar='<bytes per second>', show_default=True,
+              help='Rate of audio_out data, 0 sends all chunks at once.')
+@click.option('--microphone-mode', default='CLOSE_MICROPHONE',
+              type=click.Choice(['CLOSE_MICROPHONE', 'DIALOG_FOLLOW_ON']),
+              show_default=True,
+              help='Microphone mode of the dialog state.')
+@click.option('--volume-percentage', default=0,
+              metavar='<volume>', show_default=True,
+              help='Volume setting to send, 0 leaves it unchanged.')
+@click.option('--device-request-json',
+              metavar='<json>',
+              help='Device action request JSON to send.')
+@click.option('--screen-out-html', type=click.File('rb'),
+              metavar='<html file>',
+              help='Path to HTML screen out data to send.')
+@click.option('--jitter', default=0.0,
+              metavar='<seconds>', show_default=True,
+              help='Maximum random delay added to each injected delay.')
+@click.option('--verbose', '-v', is_flag=True, default=False,
+              help='Verbose logging.')
+def main(address, api_version, max_workers, screen_out_html,
+         audio_out_file, verbose, **kwargs):
+    """Serve a local stand-in for the Google Assistant API.
+
+    Examples:
+      Serve scripted responses with 300ms of server latency:
+
+        $ python -m fakeassistant --response-delay 0.3 --jitter 0.05
+
+      Run the load generator against the fake server:
+
+        $ python -m loadtest --address localhost:50051 -i in.wav
+    """
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+    if screen_out_html:
+        kwargs['screen_out_html'] = screen_out_html.read()
+    if audio_out_file:
+        kwargs['audio_out_data'] = audio_out_file.read()
+    servicer = create_servicer(api_version, **kwargs)
+    server, port = serve(servicer, address, max_workers)
+    logging.info('Serving %s on port %d', api_version, port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load generator replaying audio files over concurrent Assist calls.
+
+Requires Python >= 3.7 for the asyncio client.
+"""
+
+import asyncio
+import io
+import logging
+import time
+
+import click
+import grpc
+
+from google.assistant.embedded.v1alpha2 import embedded_assistant_pb2
+
+try:
+    from . import (
+        aioassistant,
+        audio_helpers,
+        fakeassistant,
+        trace_helpers
+    )
+except (SystemError, ImportError):
+    import aioassistant
+    import audio_helpers
+    import fakeassistant
+    import trace_helpers
+
+
+END_OF_UTTERANCE = embedded_assistant_pb2.AssistResponse.END_OF_UTTERANCE
+METRICS = (
+    ('end_of_utterance', 'time to END_OF_UTTERANCE'),
+    ('first_audio_out', 'time to first audio_out'),
+    ('turn', 'total turn latency'),
+)
+
+
+async def assist_turn(channel, audio_data, sample_rate, sample_width,
+                      iter_size, deadline, pacing=audio_helpers.REALTIME,
+                      trailing_silence_ms=None):
+    """Replay audio_data in a single Assist call.
+
+    audio_data is either the audio file contents or the path of a file,
+    memory-mapped so that concurrent turns share the page cache.
+
+    Returns: dict of latencies in seconds since the start of the call,
+    keyed by metric name, missing metrics were not observed.
+    """
+    if isinstance(audio_data, bytes):
+        source = aioassistant.AsyncWaveSource(
+            io.BytesIO(audio_data), sample_rate, sample_width,
+            pacing=pacing, trailing_silence_ms=trailing_silence_ms)
+    else:
+        source = aioassistant.AsyncMappedWaveSource(
+            audio_data, sample_rate, sample_width,
+            pacing=pacing, trailing_silence_ms=trailing_silence_ms)
+    conversation_stream = aioassistant.AsyncConversationStream(
+        source=source,
+        sink=aioassistant.NullSink(),
+        iter_size=iter_size,
+        sample_width=sample_width,
+    )
+    assistant = aioassistant.AsyncSampleAssistant(
+        'en-US', 'loadtest-device-model', 'loadtest-device',
+        conversation_stream, False, channel, deadline, None
+    )
+    timings = {}
+    start = time.monotonic()
+    await conversation_stream.start_recording()
+    call = assistant.assistant.Assist(assistant.gen_assist_requests(),
+                                      timeout=deadline)
+    async for resp in call:
+        elapsed = time.monotonic() - start
+        if resp.event_type == END_OF_UTTERANCE:
+            timings.setdefault('end_of_utterance', elapsed)
+            await conversation_stream.stop_recording()
+        if len(resp.audio_out.audio_data) > 0:
+            timings.setdefault('first_audio_out', elapsed)
+            if conversation_stream.recording:
+                await conversation_stream.stop_recording()
+    timings['turn'] = time.monotonic() - start
+    if conversation_stream.recording:
+        await conversation_stream.stop_recording()
+    source.close()
+    return timings
+
+
+async def run_load(address, audio_files, streams, turns,
+                   sample_rate=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+                   sample_width=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+                   iter_size=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+                   deadline=aioassistant.DEFAULT_GRPC_DEADLINE,
+                   pacing=audio_helpers.REALTIME, trailing_silence_ms=None,
+                   channel=None):
+    """Run streams concurrent sessions of turns sequential Assist calls.
+
+    Audio files are assigned to turns round robin.
+
+    Args:
+      address: address of an insecure Google Assistant API server,
+        ignored when channel is given.
+      audio_files: list of audio file contents (WAV/RIFF or RAW bytes)
+        or paths.
+      streams: number of concurrent sessions.
+      turns: number of Assist calls per session.
+      pacing: speed factor of audio file reads, see WaveSource.
+      trailing_silence_ms: silence sent after the end of audio files,
+        see WaveSource.
+      channel: optional grpc.aio channel to use.
+
+    Returns: (timings, errors) tuple of the per turn timing dicts and
+    the number of failed turns.
+    """
+    results = []
+    errors = []
+
+    async def session(index):
+        for turn in range(turns):
+            data = audio_files[(index * turns + turn) % len(audio_files)]
+            try:
+                results.append(await assist_turn(channel, data,
+                                                 sample_rate, sample_width,
+                                                 iter_size, deadline,
+                                                 pacing, trailing_silence_ms))
+            except grpc.RpcError as e:
+                logging.warning('Assist call failed: %s', e)
+                errors.append(e)
+
+    own_channel = channel is None
+    if own_channel:
+        channel = grpc.aio.insecure_channel(address)
+    try:
+        await asyncio.gather(*[session(i) for i in range(streams)])
+    finally:
+        if own_channel:
+            await channel.close()
+    return results, len(errors)
+
+
+def report(timings, errors, wall_time):
+    """Print latency percentiles of the given turn timings."""
+    click.echo('%d turns, %d errors in %.2fs (%.1f turns/s)' % (
+        len(timings), errors, wall_time,
+        len(timings) / wall_time if wall_time else 0))
+    percentiles = trace_helpers.PERCENTILES
+    click.echo('%-28s' % 'metric (ms)' +
+               ''.join('%10s' % ('p%d' % p) for p in percentiles))
+    for key, name in METRICS:
+        values = [t[key] for t in timings if key in t]
+        click.echo('%-28s' % name +
+                   ''.join('%10.1f' % (1000 *
+                                       trace_helpers.percentile(values, p))
+                           for p in percentiles))
+
+
+@click.command()
+@click.option('--input-audio-file', '-i', required=True, multiple=True,
+              metavar='<input file>', type=click.Path(exists=True),
+              help='Path to input audio file, can be repeated.')
+@click.option('--input-pacing', default='realtime',
+              type=audio_helpers.PACING, metavar='<pacing>',
+              show_default=True,
+              help=('Pacing of input audio file reads: realtime, a speed '
+                    'factor such as 4x, or burst.'))
+@click.option('--trailing-silence-ms', type=int, metavar='<milliseconds>',
+              help=('Silence sent after the end of the input audio file '
+                    'before ending the request, 0 ends it at the end of '
+                    'file. If missing, silence is sent until the end of '
+                    'the utterance is detected.'))
+@click.option('--streams', default=10,
+              metavar='<streams>', show_default=True,
+              help='Number of concurrent Assist sessions.')
+@click.option('--turns', default=1,
+              metavar='<turns>', show_default=True,
+              help='Number of sequential Assist calls per session.')
+@click.option('--address',
+              metavar='<address>',
+              help=('Address of an insecure Google Assistant API server, '
+                    'if missing a local fake server is started.'))
+@click.option('--end-of-utterance-size',
+              default=fakeassistant.DEFAULT_END_OF_UTTERANCE_SIZE,
+              metavar='<size>', show_default=True,
+              help='Fake server: audio bytes received before '
+              'END_OF_UTTERANCE.')
+@click.option('--response-delay', default=0.0,
+              metavar='<seconds>', show_default=True,
+              help='Fake server: delay between END_OF_UTTERANCE and the '
+              'response.')
+@click.option('--jitter', default=0.0,
+              metavar='<seconds>', show_default=True,
+              help='Fake server: maximum random delay added to each '
+              'injected delay.')
+@click.option('--audio-out-size',
+              default=fakeassistant.DEFAULT_AUDIO_OUT_SIZE,
+              metavar='<size>', show_default=True,
+              help='Fake server: size in bytes of each audio_out chunk.')
+@click.option('--audio-out-count',
+              default=fakeassistant.DEFAULT_AUDIO_OUT_COUNT,
+              metavar='<count>', show_default=True,
+              help='Fake server: number of audio_out chunks per response.')
+@click.option('--audio-sample-rate',
+              default=audio_helpers.DEFAULT_AUDIO_SAMPLE_RATE,
+              metavar='<audio sample rate>', show_default=True,
+              help='Audio sample rate in hertz.')
+@click.option('--audio-sample-width',
+              default=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
+              metavar='<audio sample width>', show_default=True,
+              help='Audio sample width in bytes.')
+@click.option('--audio-iter-size',
+              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+              metavar='<audio iter size>', show_default=True,
+              help='Size of each read during audio stream iteration in bytes.')
+@click.option('--grpc-deadline', default=aioassistant.DEFAULT_GRPC_DEADLINE,
+              metavar='<grpc deadline>', show_default=True,
+              help='gRPC deadline in seconds')
+@click.option('--verbose', '-v', is_flag=True, default=False,
+              help='Verbose logging.')
+def main(input_audio_file, input_pacing, trailing_silence_ms,
+         streams, turns, address,
+         end_of_utterance_size, response_delay, jitter,
+         audio_out_size, audio_out_count,
+         audio_sample_rate, audio_sample_width, audio_iter_size,
+         grpc_deadline, verbose):
+    """Measure Assist latencies under concurrent load.
+
+    Examples:
+      Replay a recording over 100 concurrent streams against a local
+      fake server:
+
+        $ python -m loadtest -i tests/data/whattimeisit.riff --streams 100
+    """
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.WARNING)
+
+    def run(address):
+        start = time.monotonic()
+        timings, errors = asyncio.run(run_load(
+            address, list(input_audio_file), streams, turns,
+            sample_rate=audio_sample_rate, sample_width=audio_sample_width,
+            iter_size=audio_iter_size, deadline=grpc_deadline,
+            pacing=input_pacing, trailing_silence_ms=trailing_silence_ms,
+        ))
+        report(timings, errors, time.monotonic() - start)
+
+    if address:
+        run(address)
+        return
+    with fakeassistant.serve_in_subprocess(
+            max_workers=max(streams, fakeassistant.DEFAULT_MAX_WORKERS),
+            end_of_utterance_size=end_of_utterance_size,
+            response_delay=response_delay,
+            jitter=jitter,
+            audio_out_size=audio_out_size,
+            audio_out_count=audio_out_count) as address:
+        run(address)
+
+
+if __name__ == '__main__':
+    main()
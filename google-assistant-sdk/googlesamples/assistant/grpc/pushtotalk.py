@@ -21,6 +21,7 @@ import os
 import os.path
 import pathlib2 as pathlib
 import sys
+import threading
 import time
 import uuid
 
@@ -38,16 +39,26 @@ from tenacity import retry, stop_after_attempt, retry_if_exception
 
 try:
     from . import (
+        aec_helpers,
         assistant_helpers,
         audio_helpers,
         browser_helpers,
-        device_helpers
+        codec_helpers,
+        device_helpers,
+        trace_helpers,
+        trigger_helpers,
+        vad_helpers
     )
 except (SystemError, ImportError):
+    import aec_helpers
     import assistant_helpers
     import audio_helpers
     import browser_helpers
+    import codec_helpers
     import device_helpers
+    import trace_helpers
+    import trigger_helpers
+    import vad_helpers
 
 
 ASSISTANT_API_ENDPOINT = 'embeddedassistant.googleapis.com'
@@ -70,11 +81,26 @@ class SampleAssistant(object):
         Google Assistant API.
       deadline_sec: gRPC deadline in seconds for Google Assistant API call.
       device_handler: callback for device actions.
+      tracer: optional trace_helpers.TurnTracer receiving a TurnSpan
+        for each turn.
+      audio_in_encoding: encoding of the audio sent to the API (LINEAR16
+        or FLAC), falls back to LINEAR16 if FLAC is not available.
+      audio_out_encoding: encoding of the audio received from the API
+        (LINEAR16, MP3 or OPUS_IN_OGG), falls back to LINEAR16 if it
+        cannot be decoded.
+      endpointer: optional vad_helpers.Endpointer detecting the end of
+        the utterance locally.
+      barge_in: optional trigger_helpers.TriggerStage wrapping the audio
+        source of conversation_stream. When set, recording continues
+        during playback and user speech interrupts the response.
     """
 
     def __init__(self, language_code, device_model_id, device_id,
                  conversation_stream, display,
-                 channel, deadline_sec, device_handler):
+                 channel, deadline_sec, device_handler, tracer=None,
+                 audio_in_encoding=codec_helpers.LINEAR16,
+                 audio_out_encoding=codec_helpers.LINEAR16,
+                 endpointer=None, barge_in=None):
         self.language_code = language_code
         self.device_model_id = device_model_id
         self.device_id = device_id
@@ -98,6 +124,14 @@ class SampleAssistant(object):
         self.deadline = deadline_sec
 
         self.device_handler = device_handler
+        self.tracer = tracer or trace_helpers.NullTracer()
+        self.audio_in_encoding = audio_in_encoding
+        self.audio_out_encoding = codec_helpers.select_audio_out_encoding(
+            audio_out_encoding, conversation_stream.sample_rate,
+            conversation_stream.sample_width)
+        self.endpointer = endpointer
+        self.barge_in = barge_in
+        self.interrupted = False
 
     def __enter__(self):
         return self
@@ -119,81 +153,154 @@ class SampleAssistant(object):
     def assist(self):
         """Send a voice request to the Assistant and playback the response.
 
-        Returns: True if conversation should continue.
+        Returns: True if conversation should continue, always True when
+          the user interrupted the response.
         """
         continue_conversation = False
         device_actions_futures = []
+        span = self.tracer.start_turn()
+        self.interrupted = False
+        monitor = None
 
         self.conversation_stream.start_recording()
+        span.mark(trace_helpers.RECORDING_STARTED)
         logging.info('Recording audio request.')
 
         def iter_log_assist_requests():
             for c in self.gen_assist_requests():
                 assistant_helpers.log_assist_request_without_audio(c)
+                if len(c.audio_in) > 0:
+                    span.mark(trace_helpers.FIRST_AUDIO_IN)
+                if self.endpointer and self.endpointer.endpointed:
+                    span.mark(trace_helpers.LOCAL_END_OF_UTTERANCE)
                 yield c
             logging.debug('Reached end of AssistRequest iteration.')
 
+        def monitor_barge_in(call):
+            if self.barge_in.wait():
+                span.mark(trace_helpers.BARGE_IN)
+                logging.info('User speech detected, interrupting response.')
+                self.interrupted = True
+                call.cancel()
+
         # This generator yields AssistResponse proto messages
         # received from the gRPC Google Assistant API.
-        for resp in self.assistant.Assist(iter_log_assist_requests(),
-                                          self.deadline):
-            assistant_helpers.log_assist_response_without_audio(resp)
-            if resp.event_type == END_OF_UTTERANCE:
-                logging.info('End of audio request detected.')
-                logging.info('Stopping recording.')
-                self.conversation_stream.stop_recording()
-            if resp.speech_results:
-                logging.info('Transcript of user request: "%s".',
-                             ' '.join(r.transcript
-                                      for r in resp.speech_results))
-            if len(resp.audio_out.audio_data) > 0:
-                if not self.conversation_stream.playing:
+        call = self.assistant.Assist(iter_log_assist_requests(),
+                                     self.deadline)
+        try:
+            for resp in call:
+                if self.interrupted:
+                    break
+                assistant_helpers.log_assist_response_without_audio(resp)
+                if resp.event_type == END_OF_UTTERANCE:
+                    span.mark(trace_helpers.END_OF_UTTERANCE)
+                    logging.info('End of audio request detected.')
+                    logging.info('Stopping recording.')
                     self.conversation_stream.stop_recording()
-                    self.conversation_stream.start_playback()
-                    logging.info('Playing assistant response.')
-                self.conversation_stream.write(resp.audio_out.audio_data)
-            if resp.dialog_state_out.conversation_state:
-                conversation_state = resp.dialog_state_out.conversation_state
-                logging.debug('Updating conversation state.')
-                self.conversation_state = conversation_state
-            if resp.dialog_state_out.volume_percentage != 0:
-                volume_percentage = resp.dialog_state_out.volume_percentage
-                logging.info('Setting volume to %s%%', volume_percentage)
-                self.conversation_stream.volume_percentage = volume_percentage
-            if resp.dialog_state_out.microphone_mode == DIALOG_FOLLOW_ON:
-                continue_conversation = True
-                logging.info('Expecting follow-on query from user.')
-            elif resp.dialog_state_out.microphone_mode == CLOSE_MICROPHONE:
-                continue_conversation = False
-            if resp.device_action.device_request_json:
-                device_request = json.loads(
-                    resp.device_action.device_request_json
-                )
-                fs = self.device_handler(device_request)
-                if fs:
-                    device_actions_futures.extend(fs)
-            if self.display and resp.screen_out.data:
-                system_browser = browser_helpers.system_browser
-                system_browser.display(resp.screen_out.data)
+                if resp.speech_results:
+                    span.mark(trace_helpers.FIRST_SPEECH_RESULT)
+                    logging.info('Transcript of user request: "%s".',
+                                 ' '.join(r.transcript
+                                          for r in resp.speech_results))
+                if len(resp.audio_out.audio_data) > 0:
+                    span.mark(trace_helpers.FIRST_AUDIO_OUT)
+                    if not self.conversation_stream.playing:
+                        self.conversation_stream.stop_recording()
+                        self.conversation_stream.start_playback()
+                        logging.info('Playing assistant response.')
+                        if self.barge_in:
+                            # Keep listening during playback.
+                            monitor = threading.Thread(
+                                target=monitor_barge_in, args=(call,))
+                            monitor.start()
+                    if self.conversation_stream.write(
+                            resp.audio_out.audio_data):
+                        # Once the sink took the audio, which may block.
+                        span.mark(trace_helpers.FIRST_PLAYBACK_WRITE)
+                dialog_state_out = resp.dialog_state_out
+                if dialog_state_out.conversation_state:
+                    conversation_state = dialog_state_out.conversation_state
+                    logging.debug('Updating conversation state.')
+                    self.conversation_state = conversation_state
+                if dialog_state_out.volume_percentage != 0:
+                    volume_percentage = dialog_state_out.volume_percentage
+                    logging.info('Setting volume to %s%%', volume_percentage)
+                    self.conversation_stream.volume_percentage = (
+                        volume_percentage)
+                if dialog_state_out.microphone_mode == DIALOG_FOLLOW_ON:
+                    continue_conversation = True
+                    logging.info('Expecting follow-on query from user.')
+                elif dialog_state_out.microphone_mode == CLOSE_MICROPHONE:
+                    continue_conversation = False
+                if resp.device_action.device_request_json:
+                    device_request = json.loads(
+                        resp.device_action.device_request_json
+                    )
+                    span.mark(trace_helpers.DEVICE_ACTION_DISPATCHED)
+                    fs = self.device_handler(device_request)
+                    if fs:
+                        for f in fs:
+                            f.add_done_callback(lambda f: span.update(
+                                trace_helpers.DEVICE_ACTION_COMPLETED))
+                        device_actions_futures.extend(fs)
+                if self.display and resp.screen_out.data:
+                    system_browser = browser_helpers.system_browser
+                    system_browser.display(resp.screen_out.data)
+        except grpc.RpcError as e:
+            if not self.interrupted or e.code() != grpc.StatusCode.CANCELLED:
+                raise
+        finally:
+            if monitor:
+                self.barge_in.cancel()
+                monitor.join()
+
+        if self.interrupted:
+            self.conversation_stream.interrupt_playback()
+            span.mark(trace_helpers.PLAYBACK_INTERRUPTED)
+            # Start the next turn immediately, with the interrupting
+            # speech buffered by the barge-in detector.
+            self.tracer.observe(trace_helpers.INTERRUPT_LATENCY_METRIC,
+                                span.interval(
+                                    trace_helpers.BARGE_IN,
+                                    trace_helpers.PLAYBACK_INTERRUPTED))
+            span.mark(trace_helpers.PLAYBACK_STOPPED)
+            self.tracer.end_turn(span)
+            return True
 
         if len(device_actions_futures):
             logging.info('Waiting for device executions to complete.')
             concurrent.futures.wait(device_actions_futures)
 
         logging.info('Finished playing assistant response.')
+        span.mark(trace_helpers.PLAYBACK_DRAINING)
         self.conversation_stream.stop_playback()
+        span.mark(trace_helpers.PLAYBACK_STOPPED)
+        self.tracer.observe(trace_helpers.PLAYBACK_TAIL_METRIC,
+                            span.interval(trace_helpers.PLAYBACK_DRAINING,
+                                          trace_helpers.PLAYBACK_STOPPED))
+        lead = span.interval(trace_helpers.LOCAL_END_OF_UTTERANCE,
+                             trace_helpers.END_OF_UTTERANCE)
+        if lead is not None:
+            # How much earlier the local endpointer ended the utterance.
+            self.tracer.observe(trace_helpers.ENDPOINT_LEAD_METRIC, lead)
+        self.tracer.end_turn(span)
         return continue_conversation
 
     def gen_assist_requests(self):
         """Yields: AssistRequest messages to send to the API."""
 
+        encoding, encoder = codec_helpers.create_audio_in_encoder(
+            self.audio_in_encoding,
+            self.conversation_stream.sample_rate,
+            self.conversation_stream.sample_width)
+        self.conversation_stream.audio_out_encoding = self.audio_out_encoding
         config = embedded_assistant_pb2.AssistConfig(
             audio_in_config=embedded_assistant_pb2.AudioInConfig(
-                encoding='LINEAR16',
+                encoding=encoding,
                 sample_rate_hertz=self.conversation_stream.sample_rate,
             ),
             audio_out_config=embedded_assistant_pb2.AudioOutConfig(
-                encoding='LINEAR16',
+                encoding=self.audio_out_encoding,
                 sample_rate_hertz=self.conversation_stream.sample_rate,
                 volume_percentage=self.conversation_stream.volume_percentage,
             ),
@@ -214,9 +321,17 @@ class SampleAssistant(object):
         # The first AssistRequest must contain the AssistConfig
         # and no audio data.
         yield embedded_assistant_pb2.AssistRequest(config=config)
-        for data in self.conversation_stream:
+        audio_in = iter(self.conversation_stream)
+        if self.endpointer:
+            audio_in = self.endpointer.process(audio_in)
+        if encoder:
+            # Each chunk is encoded as soon as it is recorded.
+            audio_in = codec_helpers.encode_chunks(encoder, audio_in)
+        for data in audio_in:
             # Subsequent requests need audio data, but not config.
-            yield embedded_assistant_pb2.AssistRequest(audio_in=data)
+            # Sources may return memoryviews, copied once here.
+            yield embedded_assistant_pb2.AssistRequest(
+                audio_in=memoryview(data).tobytes())
 
 
 @click.command()
@@ -260,6 +375,19 @@ class SampleAssistant(object):
               metavar='<input file>',
               help='Path to input audio file. '
               'If missing, uses audio capture')
+@click.option('--input-audio-mmap', is_flag=True, default=False,
+              help=('Memory-map the input audio file instead of reading '
+                    'it through a file object.'))
+@click.option('--input-pacing', default='realtime',
+              type=audio_helpers.PACING, metavar='<pacing>',
+              show_default=True,
+              help=('Pacing of input audio file reads: realtime, a speed '
+                    'factor such as 4x, or burst.'))
+@click.option('--trailing-silence-ms', type=int, metavar='<milliseconds>',
+              help=('Silence sent after the end of the input audio file '
+                    'before ending the request, 0 ends it at the end of '
+                    'file. If missing, silence is sent until the end of '
+                    'the utterance is detected.'))
 @click.option('--output-audio-file', '-o',
               metavar='<output file>',
               help='Path to output audio file. '
@@ -272,32 +400,153 @@ class SampleAssistant(object):
               default=audio_helpers.DEFAULT_AUDIO_SAMPLE_WIDTH,
               metavar='<audio sample width>', show_default=True,
               help='Audio sample width in bytes.')
-@click.option('--audio-iter-size',
-              default=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
-              metavar='<audio iter size>', show_default=True,
-              help='Size of each read during audio stream iteration in bytes.')
-@click.option('--audio-block-size',
-              default=audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE,
-              metavar='<audio block size>', show_default=True,
+@click.option('--audio-device-sample-rate', type=int,
+              metavar='<audio device sample rate>',
+              help=('Sample rate of the audio device in hertz, such as its '
+                    'native 44100 or 48000, resampled from and to '
+                    '--audio-sample-rate (requires NumPy). If missing, uses '
+                    '--audio-sample-rate.'))
+@click.option('--audio-device-callback', is_flag=True, default=False,
+              help=('Exchange audio with the device from its callback '
+                    'through lock-free ring buffers, instead of blocking '
+                    'reads and writes. Implied by --barge-in.'))
+@click.option('--audio-profile', show_default=True,
+              metavar='<audio profile>',
+              default=audio_helpers.DEFAULT_AUDIO_PROFILE,
+              help=('Path to the audio profile written by '
+                    'googlesamples-assistant-audiotest --calibrate, '
+                    'providing the audio sizes not given on the command '
+                    'line.'))
+@click.option('--audio-iter-size', type=int,
+              metavar='<audio iter size>',
+              help=('Size of each read during audio stream iteration in '
+                    'bytes. [default: from --audio-profile, else %d]'
+                    % audio_helpers.DEFAULT_AUDIO_ITER_SIZE))
+@click.option('--audio-block-size', type=int,
+              metavar='<audio block size>',
               help=('Block size in bytes for each audio device '
-                    'read and write operation.'))
+                    'read and write operation. [default: from '
+                    '--audio-profile, else %d]'
+                    % audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE))
 @click.option('--audio-flush-size',
               default=audio_helpers.DEFAULT_AUDIO_DEVICE_FLUSH_SIZE,
               metavar='<audio flush size>', show_default=True,
-              help=('Size of silence data in bytes written '
-                    'during flush operation'))
+              help=('Deprecated and ignored: flush waits for the written '
+                    'audio to play.'))
+@click.option('--audio-pre-roll-ms', default=0,
+              metavar='<milliseconds>', show_default=True,
+              help=('Keep the audio device open between requests and start '
+                    'each recording this far in the past, so that speech '
+                    'is not clipped while the device starts. 0 opens the '
+                    'device for each request.'))
+@click.option('--jitter-buffer-ms', default=0,
+              metavar='<milliseconds>', show_default=True,
+              help=('Play the response from a playback thread, once this '
+                    'much audio is buffered. The buffered duration adapts '
+                    'to the network jitter. 0 writes the response audio as '
+                    'it is received.'))
+@click.option('--audio-in-chunking', default=audio_helpers.FIXED_CHUNKS,
+              type=click.Choice(audio_helpers.CHUNKING_POLICIES),
+              show_default=True,
+              help=('Size of the recorded audio chunks sent to the '
+                    'Assistant: fixed --audio-iter-size chunks, chunks '
+                    'growing from --audio-in-min-chunk-size to '
+                    '--audio-iter-size over each request, or growing '
+                    'chunks restarting small in speech pauses (vad, '
+                    'requires NumPy).'))
+@click.option('--audio-in-min-chunk-size',
+              default=audio_helpers.DEFAULT_AUDIO_IN_MIN_CHUNK_SIZE,
+              metavar='<audio in min chunk size>', show_default=True,
+              help='Size in bytes of the smallest recorded audio chunk.')
+@click.option('--audio-in-encoding', default=codec_helpers.LINEAR16,
+              type=click.Choice(codec_helpers.AUDIO_IN_ENCODINGS),
+              show_default=True,
+              help=('Encoding of the audio request sent to the Assistant, '
+                    'FLAC requires NumPy.'))
+@click.option('--audio-out-encoding', default=codec_helpers.LINEAR16,
+              type=click.Choice(codec_helpers.AUDIO_OUT_ENCODINGS),
+              show_default=True,
+              help=('Encoding of the audio response sent by the Assistant, '
+                    'MP3 and OPUS_IN_OGG require PyAV.'))
+@click.option('--local-endpointing', default=vad_helpers.OFF,
+              type=click.Choice(vad_helpers.ENDPOINTING_MODES),
+              show_default=True,
+              help=('Detect the end of the utterance with a local voice '
+                    'activity detector: observe only records it in the turn '
+                    'metrics, on also ends the audio request there. '
+                    'Requires NumPy.'))
+@click.option('--local-endpointing-silence-ms',
+              default=vad_helpers.DEFAULT_TRAILING_SILENCE_MS,
+              metavar='<milliseconds>', show_default=True,
+              help='Trailing silence ending the utterance locally.')
+@click.option('--trigger', default=trigger_helpers.ENTER,
+              type=click.Choice(trigger_helpers.TRIGGERS),
+              show_default=True,
+              help=('How new conversations are started: by pressing Enter, '
+                    'by speaking, or by saying the phrase recorded in '
+                    '--trigger-template. Voice triggers require NumPy.'))
+@click.option('--trigger-template',
+              metavar='<trigger template>', type=click.Path(exists=True),
+              help='WAV recording of the trigger phrase.')
+@click.option('--trigger-threshold',
+              default=trigger_helpers.DEFAULT_TEMPLATE_THRESHOLD,
+              metavar='<threshold>', show_default=True,
+              help='Similarity to the template above which it triggers.')
+@click.option('--trigger-model',
+              metavar='<module:function>',
+              help=('Pluggable trigger detector: function(sample_rate, '
+                    'sample_width) returns a callable taking audio bytes '
+                    'and returning True to trigger. Overrides --trigger.'))
+@click.option('--trigger-pre-roll-ms',
+              default=trigger_helpers.DEFAULT_PRE_ROLL_MS,
+              metavar='<milliseconds>', show_default=True,
+              help='Audio preceding the trigger sent with the request.')
+@click.option('--barge-in', is_flag=True, default=False,
+              help=('Keep listening while the response is playing, and '
+                    'interrupt it to start a new request when speech is '
+                    'detected. Use headphones or --echo-cancellation: the '
+                    'response itself is heard as speech otherwise. '
+                    'Requires NumPy.'))
+@click.option('--barge-in-min-speech-ms', default=300,
+              metavar='<milliseconds>', show_default=True,
+              help='Speech needed to interrupt a response.')
+@click.option('--echo-cancellation', is_flag=True, default=False,
+              help=('Remove the echo of the response from the audio '
+                    'recorded while it is playing, with --barge-in or '
+                    '--audio-pre-roll-ms. Requires NumPy.'))
+@click.option('--echo-filter-ms', default=aec_helpers.DEFAULT_FILTER_MS,
+              metavar='<milliseconds>', show_default=True,
+              help='Longest echo path removed by the echo canceller.')
+@click.option('--echo-delay-ms', type=int,
+              metavar='<milliseconds>',
+              help=('Delay of the echo from the played to the recorded '
+                    'audio, before the echo path. [default: input and '
+                    'output latency reported by the sound device]'))
 @click.option('--grpc-deadline', default=DEFAULT_GRPC_DEADLINE,
               metavar='<grpc deadline>', show_default=True,
               help='gRPC deadline in seconds')
 @click.option('--once', default=False, is_flag=True,
               help='Force termination after a single conversation.')
+@click.option('--metrics-file',
+              metavar='<metrics file>',
+              help=('Path to write turn latency metrics to after each turn, '
+                    'in OpenMetrics text format.'))
 def main(api_endpoint, credentials, project_id,
          device_model_id, device_id, device_config,
          lang, display, verbose,
-         input_audio_file, output_audio_file,
-         audio_sample_rate, audio_sample_width,
+         input_audio_file, input_audio_mmap, input_pacing,
+         trailing_silence_ms, output_audio_file,
+         audio_sample_rate, audio_sample_width, audio_device_sample_rate,
+         audio_device_callback, audio_profile,
          audio_iter_size, audio_block_size, audio_flush_size,
-         grpc_deadline, once, *args, **kwargs):
+         audio_pre_roll_ms, jitter_buffer_ms,
+         audio_in_chunking, audio_in_min_chunk_size,
+         audio_in_encoding, audio_out_encoding,
+         local_endpointing, local_endpointing_silence_ms,
+         trigger, trigger_template, trigger_threshold, trigger_model,
+         trigger_pre_roll_ms, barge_in, barge_in_min_speech_ms,
+         echo_cancellation, echo_filter_ms, echo_delay_ms,
+         grpc_deadline, once, metrics_file, *args, **kwargs):
     """Samples for the Google Assistant API.
 
     Examples:
@@ -334,23 +583,56 @@ def main(api_endpoint, credentials, project_id,
         credentials, http_request, api_endpoint)
     logging.info('Connecting to %s', api_endpoint)
 
+    tracer = trace_helpers.TurnTracer()
+
+    # Sizes given on the command line override the calibrated profile.
+    profile = audio_helpers.load_audio_profile(audio_profile)
+    if audio_iter_size is None:
+        audio_iter_size = profile.get(
+            'audio_iter_size', audio_helpers.DEFAULT_AUDIO_ITER_SIZE)
+    if audio_block_size is None:
+        audio_block_size = profile.get(
+            'audio_block_size', audio_helpers.DEFAULT_AUDIO_DEVICE_BLOCK_SIZE)
+
     # Configure audio source and sink.
     audio_device = None
-    if input_audio_file:
+    # Barge-in records while playing from another thread: the callback
+    # stream rings let both sides run without sharing the device calls.
+    audio_device_class = (audio_helpers.CallbackSoundDeviceStream
+                          if audio_device_callback or barge_in
+                          else audio_helpers.SoundDeviceStream)
+    if input_audio_file and input_audio_mmap:
+        audio_source = audio_helpers.MappedWaveSource(
+            input_audio_file,
+            sample_rate=audio_sample_rate,
+            sample_width=audio_sample_width,
+            pacing=input_pacing,
+            trailing_silence_ms=trailing_silence_ms
+        )
+    elif input_audio_file:
         audio_source = audio_helpers.WaveSource(
             open(input_audio_file, 'rb'),
             sample_rate=audio_sample_rate,
-            sample_width=audio_sample_width
+            sample_width=audio_sample_width,
+            pacing=input_pacing,
+            trailing_silence_ms=trailing_silence_ms
         )
     else:
         audio_source = audio_device = (
-            audio_device or audio_helpers.SoundDeviceStream(
+            audio_device or audio_device_class(
                 sample_rate=audio_sample_rate,
                 sample_width=audio_sample_width,
                 block_size=audio_block_size,
-                flush_size=audio_flush_size
+                flush_size=audio_flush_size,
+                device_sample_rate=audio_device_sample_rate,
+                always_open=audio_pre_roll_ms > 0,
+                tracer=tracer
             )
         )
+        if audio_pre_roll_ms > 0:
+            audio_source = audio_helpers.AlwaysOpenSource(
+                audio_device, audio_sample_rate, audio_sample_width,
+                audio_pre_roll_ms, chunk_size=audio_iter_size)
     if output_audio_file:
         audio_sink = audio_helpers.WaveSink(
             open(output_audio_file, 'wb'),
@@ -359,19 +641,71 @@ def main(api_endpoint, credentials, project_id,
         )
     else:
         audio_sink = audio_device = (
-            audio_device or audio_helpers.SoundDeviceStream(
+            audio_device or audio_device_class(
                 sample_rate=audio_sample_rate,
                 sample_width=audio_sample_width,
                 block_size=audio_block_size,
-                flush_size=audio_flush_size
+                flush_size=audio_flush_size,
+                device_sample_rate=audio_device_sample_rate,
+                tracer=tracer
             )
         )
+    # Remove the echo of the playback from the recorded audio.
+    if (echo_cancellation and audio_device and
+            not (input_audio_file or output_audio_file)):
+        if echo_delay_ms is None:
+            echo_delay_ms = int(1000 * (audio_device.input_latency +
+                                        audio_device.output_latency))
+        canceller = aec_helpers.create_echo_canceller(
+            audio_sample_rate, audio_sample_width, filter_ms=echo_filter_ms,
+            delay_ms=echo_delay_ms)
+        if canceller:
+            audio_source = aec_helpers.EchoCancellingSource(audio_source,
+                                                            canceller)
+            audio_sink = aec_helpers.EchoReferenceSink(audio_sink, canceller)
+    # Absorb the network jitter of the response audio.
+    if jitter_buffer_ms > 0 and not output_audio_file:
+        audio_sink = audio_helpers.JitterBuffer(
+            audio_sink, audio_sample_rate, audio_sample_width,
+            target_ms=jitter_buffer_ms, tracer=tracer)
+    # Listen for speech interrupting the responses.
+    barge_in_stage = None
+    if not input_audio_file and barge_in:
+        audio_source = barge_in_stage = trigger_helpers.TriggerStage(
+            audio_source,
+            trigger_helpers.VoiceTrigger(
+                audio_sample_rate, audio_sample_width,
+                min_speech_ms=barge_in_min_speech_ms),
+            audio_sample_rate, audio_sample_width,
+            chunk_size=audio_iter_size,
+            pre_roll_ms=barge_in_min_speech_ms + trigger_pre_roll_ms)
+    # Wait for a voice trigger before each conversation.
+    trigger_stage = None
+    if not input_audio_file and (trigger != trigger_helpers.ENTER or
+                                 trigger_model):
+        detector = trigger_helpers.create_detector(
+            trigger, audio_sample_rate, audio_sample_width,
+            template=trigger_template, threshold=trigger_threshold,
+            model=trigger_model)
+        audio_source = trigger_stage = trigger_helpers.TriggerStage(
+            audio_source, detector, audio_sample_rate, audio_sample_width,
+            chunk_size=audio_iter_size, pre_roll_ms=trigger_pre_roll_ms)
+    # Choose the size of the recorded audio chunks.
+    chunk_policy = None
+    if audio_in_chunking != audio_helpers.FIXED_CHUNKS:
+        chunk_policy = audio_helpers.GrowingChunkPolicy(
+            audio_in_min_chunk_size, audio_iter_size,
+            sample_width=audio_sample_width)
+    if audio_in_chunking == audio_helpers.VAD_CHUNKS:
+        chunk_policy = vad_helpers.create_vad_chunk_policy(
+            chunk_policy, audio_sample_rate, audio_sample_width)
     # Create conversation stream with the given audio source and sink.
     conversation_stream = audio_helpers.ConversationStream(
         source=audio_source,
         sink=audio_sink,
         iter_size=audio_iter_size,
         sample_width=audio_sample_width,
+        chunk_policy=chunk_policy,
     )
 
     if not device_id or not device_model_id:
@@ -437,14 +771,36 @@ def main(api_endpoint, credentials, project_id,
             logging.info('Device is blinking.')
             time.sleep(delay)
 
+    endpointer = vad_helpers.create_endpointer(
+        local_endpointing, audio_sample_rate, audio_sample_width,
+        trailing_silence_ms=local_endpointing_silence_ms)
+
+    def assist():
+        continue_conversation = assistant.assist()
+        logging.debug('Turn latency: %s', tracer.last_span)
+        if trigger_stage and trigger_stage.triggered_at:
+            first_audio_in = tracer.last_span.events.get(
+                trace_helpers.FIRST_AUDIO_IN)
+            if first_audio_in:
+                tracer.observe(trace_helpers.TRIGGER_LATENCY_METRIC,
+                               first_audio_in - trigger_stage.triggered_at)
+            trigger_stage.triggered_at = None
+        if metrics_file:
+            trace_helpers.write_metrics(tracer, metrics_file)
+        return continue_conversation
+
     with SampleAssistant(lang, device_model_id, device_id,
                          conversation_stream, display,
                          grpc_channel, grpc_deadline,
-                         device_handler) as assistant:
+                         device_handler, tracer=tracer,
+                         audio_in_encoding=audio_in_encoding,
+                         audio_out_encoding=audio_out_encoding,
+                         endpointer=endpointer,
+                         barge_in=barge_in_stage) as assistant:
         # If file arguments are supplied:
         # exit after the first turn of the conversation.
         if input_audio_file or output_audio_file:
-            assistant.assist()
+            assist()
             return
 
         # If no file arguments supplied:
@@ -453,9 +809,12 @@ def main(api_endpoint, credentials, project_id,
         # When the once flag is set, don't wait for a trigger. Otherwise, wait.
         wait_for_user_trigger = not once
         while True:
-            if wait_for_user_trigger:
+            if wait_for_user_trigger and trigger_stage:
+                click.echo('Waiting for the trigger...')
+                trigger_stage.wait()
+            elif wait_for_user_trigger:
                 click.pause(info='Press Enter to send a new request...')
-            continue_conversation = assistant.assist()
+            continue_conversation = assist()
             # wait for user trigger if there is no follow-up turn in
             # the conversation.
             wait_for_user_trigger = not continue_conversation
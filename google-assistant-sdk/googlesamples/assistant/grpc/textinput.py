@@ -32,10 +32,12 @@ try:
     from . import (
         assistant_helpers,
         browser_helpers,
+        codec_helpers,
     )
 except (SystemError, ImportError):
     import assistant_helpers
     import browser_helpers
+    import codec_helpers
 
 
 ASSISTANT_API_ENDPOINT = 'embeddedassistant.googleapis.com'
@@ -54,10 +56,13 @@ class SampleTextAssistant(object):
       channel: authorized gRPC channel for connection to the
         Google Assistant API.
       deadline_sec: gRPC deadline in seconds for Google Assistant API call.
+      audio_out_encoding: encoding of the audio response, the response
+        is not played back.
     """
 
     def __init__(self, language_code, device_model_id, device_id,
-                 display, channel, deadline_sec):
+                 display, channel, deadline_sec,
+                 audio_out_encoding=codec_helpers.LINEAR16):
         self.language_code = language_code
         self.device_model_id = device_model_id
         self.device_id = device_id
@@ -69,6 +74,7 @@ class SampleTextAssistant(object):
             channel
         )
         self.deadline = deadline_sec
+        self.audio_out_encoding = audio_out_encoding
 
     def __enter__(self):
         return self
@@ -83,7 +89,7 @@ class SampleTextAssistant(object):
         def iter_assist_requests():
             config = embedded_assistant_pb2.AssistConfig(
                 audio_out_config=embedded_assistant_pb2.AudioOutConfig(
-                    encoding='LINEAR16',
+                    encoding=self.audio_out_encoding,
                     sample_rate_hertz=16000,
                     volume_percentage=0,
                 ),
@@ -150,12 +156,17 @@ class SampleTextAssistant(object):
               help='Enable visual display of Assistant responses in HTML.')
 @click.option('--verbose', '-v', is_flag=True, default=False,
               help='Verbose logging.')
+@click.option('--audio-out-encoding', default=codec_helpers.LINEAR16,
+              type=click.Choice(codec_helpers.AUDIO_OUT_ENCODINGS),
+              show_default=True,
+              help=('Encoding of the audio response sent by the Assistant, '
+                    'compressed encodings reduce the downloaded bytes.'))
 @click.option('--grpc-deadline', default=DEFAULT_GRPC_DEADLINE,
               metavar='<grpc deadline>', show_default=True,
               help='gRPC deadline in seconds')
 def main(api_endpoint, credentials,
          device_model_id, device_id, lang, display, verbose,
-         grpc_deadline, *args, **kwargs):
+         audio_out_encoding, grpc_deadline, *args, **kwargs):
     # Setup logging.
     logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
 
@@ -178,7 +189,8 @@ def main(api_endpoint, credentials,
     logging.info('Connecting to %s', api_endpoint)
 
     with SampleTextAssistant(lang, device_model_id, device_id, display,
-                             grpc_channel, grpc_deadline) as assistant:
+                             grpc_channel, grpc_deadline,
+                             audio_out_encoding) as assistant:
         while True:
             query = click.prompt('')
             click.echo('<you> %s' % query)
@@ -0,0 +1,290 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper functions to trace the latency of Assistant turns."""
+
+import bisect
+import logging
+import math
+import os
+import threading
+import time
+
+
+RECORDING_STARTED = 'recording_started'
+FIRST_AUDIO_IN = 'first_audio_in'
+END_OF_UTTERANCE = 'end_of_utterance'
+LOCAL_END_OF_UTTERANCE = 'local_end_of_utterance'
+FIRST_SPEECH_RESULT = 'first_speech_result'
+FIRST_AUDIO_OUT = 'first_audio_out'
+FIRST_PLAYBACK_WRITE = 'first_playback_write'
+DEVICE_ACTION_DISPATCHED = 'device_action_dispatched'
+DEVICE_ACTION_COMPLETED = 'device_action_completed'
+BARGE_IN = 'barge_in'
+PLAYBACK_INTERRUPTED = 'playback_interrupted'
+PLAYBACK_DRAINING = 'playback_draining'
+PLAYBACK_STOPPED = 'playback_stopped'
+TURN_EVENTS = (
+    RECORDING_STARTED,
+    FIRST_AUDIO_IN,
+    LOCAL_END_OF_UTTERANCE,
+    END_OF_UTTERANCE,
+    FIRST_SPEECH_RESULT,
+    FIRST_AUDIO_OUT,
+    FIRST_PLAYBACK_WRITE,
+    DEVICE_ACTION_DISPATCHED,
+    DEVICE_ACTION_COMPLETED,
+    BARGE_IN,
+    PLAYBACK_INTERRUPTED,
+    PLAYBACK_DRAINING,
+    PLAYBACK_STOPPED,
+)
+TURN_EVENT_METRIC = 'assistant_turn_event_seconds'
+TURN_DURATION_METRIC = 'assistant_turn_duration_seconds'
+TURNS_METRIC = 'assistant_turns'
+ENDPOINT_LEAD_METRIC = 'assistant_endpoint_lead_seconds'
+TRIGGER_LATENCY_METRIC = 'assistant_trigger_to_stream_seconds'
+INTERRUPT_LATENCY_METRIC = 'assistant_time_to_interrupt_seconds'
+PLAYBACK_UNDERFLOWS_METRIC = 'assistant_playback_underflows'
+PLAYBACK_BUFFER_DEPTH_METRIC = 'assistant_playback_buffer_depth_seconds'
+PLAYBACK_TARGET_DEPTH_METRIC = 'assistant_playback_target_depth_seconds'
+AUDIO_OVERFLOWS_METRIC = 'assistant_audio_device_overflows'
+AUDIO_UNDERFLOWS_METRIC = 'assistant_audio_device_underflows'
+PLAYBACK_TAIL_METRIC = 'assistant_playback_tail_seconds'
+PERCENTILES = (50, 95, 99)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class TurnSpan(object):
+    """Timestamps of the events of a single Assistant turn.
+
+    Times are read from a monotonic clock and reported in seconds since
+    the start of the span.
+
+    Args:
+      clock: function returning the current time in seconds, defaults to
+        time.monotonic (time.time on Python 2).
+    """
+    def __init__(self, clock=None):
+        self._clock = clock or getattr(time, 'monotonic', time.time)
+        self.start = self._clock()
+        self.end = None
+        self.events = {}
+
+    def mark(self, event):
+        """Record the first occurrence of event."""
+        if event not in self.events:
+            self.events[event] = self._clock()
+
+    def update(self, event):
+        """Record the last occurrence of event."""
+        self.events[event] = self._clock()
+
+    def finish(self):
+        """Record the end of the span."""
+        self.end = self._clock()
+
+    def elapsed(self, event):
+        """Seconds from the start of the span to event, None if missing."""
+        if event not in self.events:
+            return None
+        return self.events[event] - self.start
+
+    def interval(self, start_event, end_event):
+        """Seconds between two events, None if any of them is missing."""
+        if start_event not in self.events or end_event not in self.events:
+            return None
+        return self.events[end_event] - self.events[start_event]
+
+    @property
+    def duration(self):
+        """Seconds from the start to the end of the span."""
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def __repr__(self):
+        return 'TurnSpan(%s)' % ', '.join(
+            '%s=%.3f' % (e, self.elapsed(e))
+            for e in TURN_EVENTS if e in self.events
+        )
+
+
+class Histogram(object):
+    """Cumulative histogram of observed values.
+
+    Args:
+      buckets: sorted upper bounds of the buckets.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of values using the nearest rank."""
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class NullTracer(object):
+    """Tracer discarding all spans and metrics."""
+    def start_turn(self):
+        return TurnSpan(clock=lambda: 0)
+
+    def end_turn(self, span):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def set_gauge(self, name, value, **labels):
+        pass
+
+
+class TurnTracer(NullTracer):
+    """Tracer aggregating turn spans and audio path metrics.
+
+    Subclass and override end_turn to forward spans elsewhere.
+
+    Args:
+      buckets: upper bounds of the histogram buckets in seconds.
+      clock: function returning the current time in seconds, defaults to
+        time.monotonic (time.time on Python 2).
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, clock=None):
+        self._buckets = buckets
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.last_span = None
+
+    def start_turn(self):
+        """Returns: a new TurnSpan for the turn starting now."""
+        return TurnSpan(clock=self._clock)
+
+    def end_turn(self, span):
+        """Finish span and aggregate its events."""
+        span.finish()
+        for event in TURN_EVENTS:
+            elapsed = span.elapsed(event)
+            if elapsed is not None:
+                self.observe(TURN_EVENT_METRIC, elapsed, event=event)
+        self.observe(TURN_DURATION_METRIC, span.duration)
+        self.increment(TURNS_METRIC)
+        self.last_span = span
+        logging.debug('%s', span)
+
+    def observe(self, name, value, **labels):
+        """Add value to the histogram name with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self._buckets)
+            self.histograms[key].observe(value)
+
+    def increment(self, name, value=1, **labels):
+        """Add value to the counter name with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """Set the gauge name with the given labels to value."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def openmetrics(tracer):
+    """Export the metrics of a TurnTracer in OpenMetrics text format.
+
+    The output is also accepted by the Prometheus text format parsers.
+    """
+    lines = []
+    with tracer._lock:
+        histograms = sorted(tracer.histograms.items())
+        counters = sorted(tracer.counters.items())
+        gauges = sorted(tracer.gauges.items())
+    families = set()
+
+    def add_type(name, metric_type):
+        if name not in families:
+            families.add(name)
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+    for (name, labels), h in histograms:
+        add_type(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(h.buckets + (float('inf'),), h.counts):
+            cumulative += count
+            le = (('le', _format_value(bound)),)
+            lines.append('%s_bucket%s %d' % (
+                name, _format_labels(labels, le), cumulative))
+        lines.append('%s_count%s %d' % (
+            name, _format_labels(labels), h.count))
+        lines.append('%s_sum%s %s' % (
+            name, _format_labels(labels), _format_value(h.sum)))
+    for (name, labels), value in counters:
+        add_type(name, 'counter')
+        lines.append('%s_total%s %s' % (
+            name, _format_labels(labels), _format_value(value)))
+    for (name, labels), value in gauges:
+        add_type(name, 'gauge')
+        lines.append('%s%s %s' % (
+            name, _format_labels(labels), _format_value(value)))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(tracer, path):
+    """Atomically write the metrics of tracer to path.
+
+    Suitable for the textfile collector of the Prometheus node exporter.
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(openmetrics(tracer))
+    # os.rename replaces the target atomically on POSIX, os.replace is
+    # missing on Python 2.
+    getattr(os, 'replace', os.rename)(tmp_path, path)
@@ -0,0 +1,296 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper functions to trigger Assistant turns from audio."""
+
+import importlib
+import logging
+import threading
+import time
+import wave
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from . import (
+        audio_helpers,
+        vad_helpers
+    )
+except (SystemError, ImportError):
+    import audio_helpers
+    import vad_helpers
+
+
+ENTER = 'enter'
+VOICE = 'voice'
+TEMPLATE = 'template'
+TRIGGERS = (ENTER, VOICE, TEMPLATE)
+
+DEFAULT_PRE_ROLL_MS = 300
+DEFAULT_TEMPLATE_THRESHOLD = 0.75
+DEFAULT_BANDS = 16
+DEFAULT_MIN_SPEECH_MS = 150
+
+
+def band_energies(samples, frame_size, bands=DEFAULT_BANDS):
+    """Log energies of the frequency bands of consecutive frames.
+
+    Args:
+      samples: NumPy array of int16 samples.
+      frame_size: number of samples per frame.
+      bands: number of equal width frequency bands.
+
+    Returns: NumPy array of shape (frames, bands).
+    """
+    count = len(samples) // frame_size
+    frames = samples[:count * frame_size].reshape(count, frame_size)
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame_size), axis=1))
+    bins = spectrum.shape[1] // bands
+    power = (spectrum[:, :bins * bands] ** 2).reshape(
+        count, bands, bins).sum(axis=2)
+    return np.log10(power + 1.0)
+
+
+def _normalize(features):
+    features = features - features.mean(axis=0)
+    norm = np.linalg.norm(features)
+    return features / norm if norm else features
+
+
+class VoiceTrigger(object):
+    """Trigger on the onset of speech.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      min_speech_ms: speech needed to trigger in milliseconds.
+    """
+    def __init__(self, sample_rate, sample_width,
+                 min_speech_ms=DEFAULT_MIN_SPEECH_MS):
+        self.vad = vad_helpers.VoiceActivityDetector(sample_rate,
+                                                     sample_width)
+        self.min_speech_ms = min_speech_ms
+        self.reset()
+
+    def reset(self):
+        """Wait for a new onset of speech."""
+        self._speech_frames = 0
+
+    def __call__(self, buf):
+        """Returns: True when buf completes the speech onset."""
+        frames = self.vad.frames(buf)
+        silence = np.flatnonzero(~frames)
+        if len(silence):
+            # Only count the speech since the last silent frame.
+            self._speech_frames = len(frames) - 1 - silence[-1]
+        else:
+            self._speech_frames += len(frames)
+        if self._speech_frames * self.vad.frame_ms >= self.min_speech_ms:
+            self.reset()
+            return True
+        return False
+
+
+class TemplateTrigger(object):
+    """Energy gated template matcher.
+
+    Band energies of the most recent audio are compared to those of a
+    recorded template of the trigger phrase, only while the voice
+    activity detector hears speech. The similarity is the cosine of the
+    mean normalized features, in [-1, 1].
+
+    Args:
+      template: NumPy array of int16 samples of the trigger phrase.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      threshold: similarity above which the trigger fires.
+    """
+    def __init__(self, template, sample_rate, sample_width,
+                 threshold=DEFAULT_TEMPLATE_THRESHOLD):
+        self.vad = vad_helpers.VoiceActivityDetector(sample_rate,
+                                                     sample_width)
+        self.frame_size = self.vad.frame_size
+        features = band_energies(template, self.frame_size)
+        # Trim leading and trailing silence of the template.
+        speech = np.flatnonzero(self.vad.frames(template.tobytes()))
+        if len(speech):
+            features = features[speech[0]:speech[-1] + 1]
+        if not len(features):
+            raise ValueError('empty trigger template')
+        self.template = _normalize(features)
+        self.threshold = threshold
+        self.reset()
+
+    @classmethod
+    def from_wav(cls, path, sample_rate, sample_width, **kwargs):
+        """Load the template from a WAV file."""
+        with wave.open(path, 'rb') as w:
+            if (w.getframerate(), w.getsampwidth()) != (sample_rate,
+                                                        sample_width):
+                raise ValueError('template format does not match the audio '
+                                 'configuration')
+            template = np.frombuffer(w.readframes(w.getnframes()),
+                                     dtype='<i2')
+        return cls(template, sample_rate, sample_width, **kwargs)
+
+    def reset(self):
+        """Forget the recent audio."""
+        self.vad.reset()
+        self._features = np.zeros((0, self.template.shape[1]))
+        self._speech = np.zeros(0, dtype=bool)
+        self._carry = np.zeros(0, dtype='<i2')
+        self.score = 0.0
+
+    def __call__(self, buf):
+        """Returns: True when the recent audio matches the template."""
+        samples = audio_helpers._samples(buf)
+        if len(self._carry):
+            samples = np.concatenate((self._carry, samples))
+        count = len(samples) // self.frame_size
+        self._carry = samples[count * self.frame_size:].copy()
+        samples = samples[:count * self.frame_size]
+        size = len(self.template)
+        self._speech = np.concatenate(
+            (self._speech, self.vad.frames(samples.tobytes())))[-size:]
+        self._features = np.concatenate(
+            (self._features,
+             band_energies(samples, self.frame_size)))[-size:]
+        # Energy gate: the spectral comparison only runs over speech.
+        if len(self._features) < size or self._speech.sum() < size // 2:
+            return False
+        self.score = float((_normalize(self._features) *
+                            self.template).sum())
+        if self.score >= self.threshold:
+            self.reset()
+            return True
+        return False
+
+
+def load_model(spec, sample_rate, sample_width):
+    """Load a pluggable trigger model.
+
+    Args:
+      spec: 'module:function', function is called with the sample rate
+        and width and returns a callable taking a chunk of audio bytes
+        and returning True to trigger a turn.
+    """
+    module_name, _, name = spec.partition(':')
+    if not name:
+        raise ValueError('trigger model must be module:function: %s' % spec)
+    factory = getattr(importlib.import_module(module_name), name)
+    return factory(sample_rate, sample_width)
+
+
+def create_detector(trigger, sample_rate, sample_width,
+                    template=None, threshold=DEFAULT_TEMPLATE_THRESHOLD,
+                    model=None):
+    """Create the trigger detector for the requested trigger.
+
+    Returns: a detector callable, None for ENTER.
+    """
+    if model:
+        return load_model(model, sample_rate, sample_width)
+    if trigger == VOICE:
+        return VoiceTrigger(sample_rate, sample_width)
+    if trigger == TEMPLATE:
+        if not template:
+            raise ValueError('the template trigger requires a template')
+        return TemplateTrigger.from_wav(template, sample_rate, sample_width,
+                                        threshold=threshold)
+    return None
+
+
+class TriggerStage(object):
+    """Audio source waiting for a trigger before each turn.
+
+    While waiting, audio is read from the source into a ring buffer and
+    passed to the detector. Once it triggers, reads return the buffered
+    pre-roll audio before the live audio, so that speech overlapping the
+    trigger is not lost and the request starts streaming immediately.
+
+    Args:
+      source: audio source, usually a SoundDeviceStream.
+      detector: callable taking a chunk of audio bytes and returning True
+        to trigger a turn.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      chunk_size: size in bytes of each read while waiting.
+      pre_roll_ms: audio preceding the trigger sent with the request.
+      clock: function returning the current time in seconds, defaults to
+        time.monotonic (time.time on Python 2).
+    """
+    def __init__(self, source, detector, sample_rate, sample_width,
+                 chunk_size=audio_helpers.DEFAULT_AUDIO_ITER_SIZE,
+                 pre_roll_ms=DEFAULT_PRE_ROLL_MS, clock=None):
+        self._source = source
+        self._clock = clock or getattr(time, 'monotonic', time.time)
+        self._detector = detector
+        self._chunk_size = chunk_size
+        self._sample_rate = sample_rate
+        pre_roll = int(sample_rate * pre_roll_ms / 1000.0) * sample_width
+        self._ring = audio_helpers.AudioRingBuffer(pre_roll)
+        self._pending = memoryview(b'')
+        self._cancelled = threading.Event()
+        self.triggered_at = None
+
+    def wait(self):
+        """Block until the detector triggers.
+
+        Returns: True if triggered, False if cancelled or at the end of
+          the source.
+        """
+        self._cancelled.clear()
+        self._source.start()
+        self._ring.clear()
+        while True:
+            data = self._source.read(self._chunk_size)
+            if self._cancelled.is_set() or not len(data):
+                return False
+            self._ring.write(data)
+            if self._detector(data):
+                break
+        self.triggered_at = self._clock()
+        self._pending = memoryview(self._ring.latest())
+        logging.info('Triggered, sending %d bytes of pre-roll audio.',
+                     len(self._pending))
+        return True
+
+    def cancel(self):
+        """Make a wait in another thread return after the current read."""
+        self._cancelled.set()
+
+    def read(self, size):
+        """Read the pending pre-roll audio, then from the source."""
+        if len(self._pending):
+            data = self._pending[:size].tobytes()
+            self._pending = self._pending[size:]
+            return data
+        return self._source.read(size)
+
+    def start(self):
+        self._source.start()
+
+    def stop(self):
+        self._pending = memoryview(b'')
+        self._source.stop()
+
+    def close(self):
+        self._source.close()
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
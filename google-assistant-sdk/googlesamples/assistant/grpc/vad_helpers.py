@@ -0,0 +1,277 @@
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper functions for voice activity detection."""
+
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from . import audio_helpers
+except (SystemError, ImportError):
+    import audio_helpers
+
+
+OFF = 'off'
+OBSERVE = 'observe'
+ON = 'on'
+ENDPOINTING_MODES = (OFF, OBSERVE, ON)
+
+DEFAULT_FRAME_MS = 10
+DEFAULT_THRESHOLD_DB = -50.0
+DEFAULT_SNR_DB = 12.0
+DEFAULT_UNVOICED_MARGIN_DB = 6.0
+DEFAULT_ZCR_THRESHOLD = 0.3
+DEFAULT_NOISE_RISE_DB = 3.0
+DEFAULT_MIN_SPEECH_MS = 100
+DEFAULT_TRAILING_SILENCE_MS = 600
+DEFAULT_CHUNK_PAUSE_MS = 100
+
+# Full scale power of 16-bit samples.
+_FULL_SCALE = float(1 << 30)
+
+
+class VoiceActivityDetector(object):
+    """Energy and zero-crossing rate voice activity detector.
+
+    Audio is classified in frames of a few milliseconds. A frame is speech
+    when its energy is above both an absolute threshold and the estimated
+    noise floor plus a margin (voiced speech), or slightly below that
+    level with a high zero-crossing rate (unvoiced fricatives). Frames are
+    processed with vectorized NumPy operations, partial frames are carried
+    over to the next buffer.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes, only 2 is supported.
+      frame_ms: duration of a frame in milliseconds.
+      threshold_db: minimum speech energy in dBFS.
+      snr_db: minimum speech energy above the noise floor in dB.
+      unvoiced_margin_db: how far below the speech level frames with a
+        high zero-crossing rate are still speech.
+      zcr_threshold: zero-crossing rate, in crossings per sample, above
+        which quieter frames are unvoiced speech.
+      noise_rise_db: maximum rise of the noise floor estimate per second.
+    """
+    def __init__(self, sample_rate, sample_width,
+                 frame_ms=DEFAULT_FRAME_MS,
+                 threshold_db=DEFAULT_THRESHOLD_DB,
+                 snr_db=DEFAULT_SNR_DB,
+                 unvoiced_margin_db=DEFAULT_UNVOICED_MARGIN_DB,
+                 zcr_threshold=DEFAULT_ZCR_THRESHOLD,
+                 noise_rise_db=DEFAULT_NOISE_RISE_DB):
+        if np is None:
+            raise Exception('NumPy is required for voice activity detection')
+        if sample_width != 2:
+            raise Exception('unsupported sample width:', sample_width)
+        self.frame_size = int(sample_rate * frame_ms / 1000)
+        self.frame_ms = frame_ms
+        self.threshold_db = threshold_db
+        self.snr_db = snr_db
+        self.unvoiced_margin_db = unvoiced_margin_db
+        self.zcr_threshold = zcr_threshold
+        self.noise_rise_db = noise_rise_db
+        self.reset()
+
+    def reset(self):
+        """Forget the noise floor and any carried partial frame."""
+        # Start from the absolute threshold: the first frames may already
+        # be speech.
+        self.noise_db = self.threshold_db - self.snr_db
+        self._carry = np.zeros(0, dtype='<i2')
+
+    def frames(self, buf):
+        """Classify the complete frames of buf.
+
+        Args:
+          buf: int16 audio samples, any object supporting the buffer
+            protocol.
+
+        Returns: NumPy boolean array, True for speech frames.
+        """
+        samples = audio_helpers._samples(buf)
+        if len(self._carry):
+            samples = np.concatenate((self._carry, samples))
+        count = len(samples) // self.frame_size
+        self._carry = samples[count * self.frame_size:].copy()
+        frames = samples[:count * self.frame_size].reshape(
+            count, self.frame_size)
+        if not count:
+            return np.zeros(0, dtype=bool)
+        x = frames.astype(np.float32)
+        power = np.einsum('ij,ij->i', x, x) / (self.frame_size * _FULL_SCALE)
+        energy_db = 10 * np.log10(power + 1e-10)
+        signs = np.signbit(frames)
+        zcr = (np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) /
+               float(self.frame_size - 1))
+        # The noise floor follows the quietest frames down immediately
+        # and rises slowly, so that speech does not raise it.
+        floor = float(energy_db.min())
+        if floor < self.noise_db:
+            self.noise_db = floor
+        else:
+            self.noise_db = min(floor, self.noise_db + self.noise_rise_db *
+                                count * self.frame_ms / 1000.0)
+        level = max(self.threshold_db, self.noise_db + self.snr_db)
+        return ((energy_db > level) |
+                ((energy_db > level - self.unvoiced_margin_db) &
+                 (zcr > self.zcr_threshold)))
+
+
+class Endpointer(object):
+    """Detect the end of an utterance in outgoing audio.
+
+    The utterance ends after trailing_silence_ms of silence following at
+    least min_speech_ms of speech.
+
+    Args:
+      vad: VoiceActivityDetector classifying the audio.
+      trailing_silence_ms: silence ending the utterance in milliseconds.
+      min_speech_ms: speech starting the utterance in milliseconds.
+      close: end the audio stream at the end of the utterance, or only
+        record it to compare it with the server endpointing.
+    """
+    def __init__(self, vad,
+                 trailing_silence_ms=DEFAULT_TRAILING_SILENCE_MS,
+                 min_speech_ms=DEFAULT_MIN_SPEECH_MS, close=True):
+        self.vad = vad
+        self.trailing_silence_ms = trailing_silence_ms
+        self.min_speech_ms = min_speech_ms
+        self.close = close
+        self.reset()
+
+    def reset(self):
+        """Start a new utterance."""
+        self.vad.reset()
+        self.speech_ms = 0
+        self.silence_ms = 0
+        self.endpointed = False
+
+    @property
+    def speech_started(self):
+        return self.speech_ms >= self.min_speech_ms
+
+    def update(self, buf):
+        """Classify a chunk of audio.
+
+        Returns: True if the utterance ended.
+        """
+        frames = self.vad.frames(buf)
+        speech = np.flatnonzero(frames)
+        frame_ms = self.vad.frame_ms
+        if len(speech):
+            self.speech_ms += len(speech) * frame_ms
+            self.silence_ms = (len(frames) - 1 - speech[-1]) * frame_ms
+        else:
+            self.silence_ms += len(frames) * frame_ms
+        if (self.speech_started and
+                self.silence_ms >= self.trailing_silence_ms):
+            self.endpointed = True
+        return self.endpointed
+
+    def process(self, chunks):
+        """Yields: chunks until the end of the utterance.
+
+        All chunks are yielded when the endpointer does not close the
+        stream.
+        """
+        self.reset()
+        for chunk in chunks:
+            if not self.endpointed and self.update(chunk):
+                logging.info('End of utterance detected locally.')
+                if self.close:
+                    yield chunk
+                    return
+            yield chunk
+
+
+class VadChunkPolicy(object):
+    """Chunking policy returning to small chunks in speech pauses.
+
+    Chunk sizes grow during speech as decided by policy. Once
+    pause_ms of silence follow the speech, which may be the end of the
+    utterance, chunks are small again so that the trailing silence
+    reaches the server endpointer sooner.
+
+    Args:
+      policy: audio_helpers.GrowingChunkPolicy deciding the sizes.
+      vad: VoiceActivityDetector classifying the recorded audio.
+      pause_ms: silence after speech in milliseconds restarting with
+        small chunks.
+    """
+    def __init__(self, policy, vad, pause_ms=DEFAULT_CHUNK_PAUSE_MS):
+        self.policy = policy
+        self.endpointer = Endpointer(vad, trailing_silence_ms=pause_ms,
+                                     close=False)
+        self.reset()
+
+    def reset(self):
+        self.policy.reset()
+        self.endpointer.reset()
+
+    def next_size(self):
+        return self.policy.next_size()
+
+    def update(self, chunk):
+        self.policy.update(chunk)
+        self.endpointer.update(chunk)
+        if (self.endpointer.speech_started and
+                self.endpointer.silence_ms >=
+                self.endpointer.trailing_silence_ms):
+            self.policy.reset()
+
+
+def create_vad_chunk_policy(policy, sample_rate, sample_width,
+                            pause_ms=DEFAULT_CHUNK_PAUSE_MS):
+    """Create a chunking policy driven by voice activity.
+
+    Returns: a VadChunkPolicy wrapping policy, policy itself when voice
+      activity detection is not available.
+    """
+    try:
+        vad = VoiceActivityDetector(sample_rate, sample_width)
+    except Exception as e:
+        logging.warning('Voice activity chunking not available (%s), '
+                        'falling back to growing chunks', e)
+        return policy
+    return VadChunkPolicy(policy, vad, pause_ms=pause_ms)
+
+
+def create_endpointer(mode, sample_rate, sample_width,
+                      trailing_silence_ms=DEFAULT_TRAILING_SILENCE_MS):
+    """Create an endpointer for the requested endpointing mode.
+
+    Falls back to server endpointing when local endpointing is not
+    available.
+
+    Args:
+      mode: OFF, OBSERVE to only record the local end of utterance, or
+        ON to end the audio stream there.
+
+    Returns: an Endpointer, None for OFF.
+    """
+    if mode == OFF:
+        return None
+    try:
+        vad = VoiceActivityDetector(sample_rate, sample_width)
+    except Exception as e:
+        logging.warning('Local endpointing not available (%s), '
+                        'falling back to server endpointing', e)
+        return None
+    return Endpointer(vad, trailing_silence_ms=trailing_silence_ms,
+                      close=(mode == ON))
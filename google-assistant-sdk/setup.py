@@ -53,15 +53,25 @@ setup(
     install_requires=install_requires,
     extras_require={
         'samples': list(samples_requirements()),
+        'numpy': ['numpy>=1.13'],
+        'codecs': ['av>=9.0; python_version >= "3.7"'],
     },
     entry_points={
         'console_scripts': [
+            'googlesamples-assistant-aiobenchmark'
+            '=googlesamples.assistant.grpc.aiobenchmark:main [samples]',
             'googlesamples-assistant-audiotest'
             '=googlesamples.assistant.grpc.audio_helpers:main',
+            'googlesamples-assistant-benchmark'
+            '=googlesamples.assistant.grpc.benchmark:main [samples]',
             'googlesamples-assistant-devicetool'
             '=googlesamples.assistant.grpc.devicetool:main',
             'googlesamples-assistant-pushtotalk'
             '=googlesamples.assistant.grpc.pushtotalk:main [samples]',
+            'googlesamples-assistant-loadtest'
+            '=googlesamples.assistant.grpc.loadtest:main [samples]',
+            'googlesamples-assistant-fakeassistant'
+            '=googlesamples.assistant.grpc.fakeassistant:main [samples]',
         ],
     },
     license='Apache 2.0',
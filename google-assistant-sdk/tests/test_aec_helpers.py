@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import unittest
+
+from googlesamples.assistant.grpc import aec_helpers
+from googlesamples.assistant.grpc import audio_helpers
+from googlesamples.assistant.grpc import benchmark
+
+
+np = aec_helpers.np
+
+
+def power(samples):
+    return (samples.astype(np.float64) ** 2).sum()
+
+
+# io.BytesIO also accepts the memoryviews written to sinks on Python 2.
+class BytesSink(io.BytesIO):
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class EchoCancellerTest(unittest.TestCase):
+    def setUp(self):
+        self.canceller = aec_helpers.EchoCanceller(16000, 2)
+        self.played = benchmark.speech_like(3.0, 0, 16000)
+        response = benchmark.echo_path(96, 0.2, 16000)
+        self.echo = np.convolve(self.played,
+                                response)[:len(self.played)].astype('<i2')
+
+    def cancel(self, mic, chunk_size=1600):
+        cleaned = []
+        for i in range(0, len(mic), chunk_size):
+            self.canceller.add_reference(
+                self.played[i:i + chunk_size].tobytes())
+            cleaned.append(self.canceller.process(
+                mic[i:i + chunk_size].tobytes()))
+        return np.frombuffer(b''.join(cleaned), dtype='<i2')
+
+    def test_no_reference(self):
+        mic = self.played[:1600 * 4]
+        out = b''.join(self.canceller.process(mic[i:i + 1000].tobytes())
+                       for i in range(0, len(mic), 1000))
+        # The audio is one block late.
+        block_size = self.canceller.block_size
+        self.assertEqual(out, b'\0\0' * block_size +
+                         mic[:-block_size].tobytes())
+
+    def test_cancel(self):
+        cleaned = self.cancel(self.echo)
+        self.assertEqual(len(cleaned), len(self.echo))
+        # More than 12dB of echo reduction in the last second.
+        block_size = self.canceller.block_size
+        self.assertLess(power(cleaned[-16000:]),
+                        power(self.echo[-16000 - block_size:-block_size]) /
+                        16)
+
+    def test_cancel_device_latency(self):
+        # 200ms blocks through a device with 150ms of latency, beyond the
+        # filter length.
+        latency = np.zeros(2400, dtype='<i2')
+        mic = np.concatenate((latency, self.echo))[:len(self.echo)]
+        reduction = []
+        for delay_ms in (0, 150):
+            self.canceller = aec_helpers.EchoCanceller(16000, 2,
+                                                       delay_ms=delay_ms)
+            cleaned = self.cancel(mic, chunk_size=3200)
+            block_size = self.canceller.block_size
+            reduction.append(power(mic[-16000 - block_size:-block_size]) /
+                             power(cleaned[-16000:]))
+        self.assertLess(reduction[0], 4)
+        self.assertGreater(reduction[1], 16)
+
+    def test_double_talk(self):
+        # The near end talks louder than the played audio.
+        near = (np.roll(self.played, 2000) * 2).astype('<i2')
+        cleaned = self.cancel(self.echo + near)
+        stats = self.canceller.stats
+        self.assertLess(stats['adapted_blocks'], stats['blocks'] / 5)
+        self.assertGreater(power(cleaned), power(near) / 2)
+
+    def test_reference_limit(self):
+        canceller = aec_helpers.EchoCanceller(16000, 2,
+                                              max_reference_ms=100)
+        canceller.add_reference(b'\0' * 6400)
+        self.assertEqual(canceller.stats['dropped_reference'], 1600)
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class EchoReferenceSinkTest(unittest.TestCase):
+    def test_reference(self):
+        canceller = aec_helpers.EchoCanceller(16000, 2)
+        sink = aec_helpers.EchoReferenceSink(BytesSink(), canceller)
+        sink.write(b'\1\0' * 256)
+        self.assertEqual(len(canceller._take_reference(256).nonzero()[0]),
+                         256)
+        sink.write(b'\1\0' * 256)
+        sink.start()
+        self.assertFalse(canceller._take_reference(256).any())
+
+    def test_conversation_stream(self):
+        # Sinks of a conversation stream are written memoryviews.
+        canceller = aec_helpers.EchoCanceller(16000, 2)
+        sink = BytesSink()
+        stream = audio_helpers.ConversationStream(
+            source=None, sink=aec_helpers.EchoReferenceSink(sink, canceller),
+            iter_size=0, sample_width=2)
+        stream.volume_percentage = 100
+        stream.start_playback()
+        stream.write(b'\1\0' * 2000)
+        self.assertEqual(b'\1\0' * 2000, sink.getvalue())
+        self.assertEqual(len(canceller._take_reference(2000).nonzero()[0]),
+                         2000)
+
+    def test_delayed_reference(self):
+        canceller = aec_helpers.EchoCanceller(16000, 2, delay_ms=10)
+        sink = aec_helpers.EchoReferenceSink(BytesSink(), canceller)
+        sink.start()
+        sink.write(b'\1\0' * 256)
+        self.assertFalse(canceller._take_reference(160).any())
+        self.assertEqual(len(canceller._take_reference(256).nonzero()[0]),
+                         256)
+
+
+class CreateEchoCancellerTest(unittest.TestCase):
+    def test_fallback(self):
+        self.assertIsNone(aec_helpers.create_echo_canceller(16000, 4))
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import io
+from unittest import mock
+
+import grpc
+import pytest
+
+from googlesamples.assistant.grpc import aioassistant
+from googlesamples.assistant.grpc import fakeassistant
+
+
+@pytest.fixture
+def address():
+    servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+        end_of_utterance_size=6400, audio_out_count=3
+    )
+    server, port = fakeassistant.serve(servicer)
+    yield 'localhost:%d' % port
+    server.stop(0)
+
+
+class BytesSink(object):
+    def __init__(self):
+        self.data = bytearray()
+        self.started = False
+
+    async def write(self, buf):
+        self.data.extend(buf)
+        return len(buf)
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_text_assist(address):
+    async def run():
+        async with grpc.aio.insecure_channel(address) as channel:
+            assistant = aioassistant.AsyncSampleTextAssistant(
+                'en-US', 'model-id', 'device-id', False, channel, 10)
+            return await assistant.assist(text_query='what time is it')
+    text, html = asyncio.run(run())
+    assert text == 'It is time.'
+    assert html is None
+
+
+def test_concurrent_audio_assist(address):
+    sinks = [BytesSink() for _ in range(5)]
+
+    async def run():
+        async with grpc.aio.insecure_channel(address) as channel:
+            async def assist(sink):
+                stream = aioassistant.AsyncConversationStream(
+                    source=aioassistant.AsyncWaveSource(
+                        io.BytesIO(b'\0' * 1600), 16000, 2),
+                    sink=sink, iter_size=1600, sample_width=2)
+                assistant = aioassistant.AsyncSampleAssistant(
+                    'en-US', 'model-id', 'device-id', stream, False,
+                    channel, 10,
+                    aioassistant.AsyncDeviceRequestHandler('device-id'))
+                return await assistant.assist()
+            return await asyncio.gather(*[assist(s) for s in sinks])
+    assert asyncio.run(run()) == [False] * len(sinks)
+    for sink in sinks:
+        assert sink.started
+        assert len(sink.data) == 3 * fakeassistant.DEFAULT_AUDIO_OUT_SIZE
+
+
+class UnavailableError(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+def test_assist_retries_unavailable():
+    attempts = []
+
+    def failing_assist(failures):
+        async def assist():
+            attempts.append(None)
+            if len(attempts) <= failures:
+                raise UnavailableError()
+            return True
+        return assist
+
+    assistant = aioassistant.AsyncSampleAssistant(
+        'en-US', 'model-id', 'device-id', None, False, mock.Mock(), 10, None)
+    assistant._assist = failing_assist(aioassistant.ASSIST_ATTEMPTS - 1)
+    assert asyncio.run(assistant.assist())
+    assert len(attempts) == aioassistant.ASSIST_ATTEMPTS
+
+    attempts[:] = []
+    assistant._assist = failing_assist(aioassistant.ASSIST_ATTEMPTS)
+    with pytest.raises(UnavailableError):
+        asyncio.run(assistant.assist())
+    assert len(attempts) == aioassistant.ASSIST_ATTEMPTS
+
+
+def test_async_device_handler():
+    handler = aioassistant.AsyncDeviceRequestHandler('device-id')
+    calls = []
+
+    @handler.command('action.devices.commands.OnOff')
+    async def onoff(on):
+        calls.append(('async', on))
+
+    @handler.command('com.example.commands.BlinkLight')
+    def blink(number):
+        calls.append(('sync', number))
+
+    device_request = {
+        'inputs': [{
+            'intent': 'action.devices.EXECUTE',
+            'payload': {
+                'commands': [{
+                    'devices': [{'id': 'device-id'}],
+                    'execution': [
+                        {'command': 'action.devices.commands.OnOff',
+                         'params': {'on': True}},
+                        {'command': 'com.example.commands.BlinkLight',
+                         'params': {'number': 3}},
+                    ]
+                }]
+            }
+        }]
+    }
+
+    async def run():
+        await asyncio.wait(handler(device_request))
+    asyncio.run(run())
+    assert sorted(calls) == [('async', True), ('sync', 3)]
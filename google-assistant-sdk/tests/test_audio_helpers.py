@@ -13,15 +13,164 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
 import unittest
 
 import time
 import wave
 
 from googlesamples.assistant.grpc import audio_helpers
+from googlesamples.assistant.grpc import trace_helpers
 from six import BytesIO
 
 
+class PlaybackBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.buffer = audio_helpers.PlaybackBuffer(2, size=4)
+
+    def test_push_aligned(self):
+        self.assertEqual(b'abcd', self.buffer.push(b'abcd').tobytes())
+        self.assertEqual(0, self.buffer.pending)
+
+    def test_push_carry(self):
+        self.assertEqual(b'ab', self.buffer.push(b'abc').tobytes())
+        self.assertEqual(1, self.buffer.pending)
+        self.assertEqual(b'cd', self.buffer.push(b'd').tobytes())
+        self.assertEqual(0, self.buffer.pending)
+
+    def test_push_grow(self):
+        view = self.buffer.push(b'abc')
+        self.assertEqual(b'cdefgh', self.buffer.push(b'defgh').tobytes())
+        self.assertEqual(b'ab', view.tobytes())
+        self.assertEqual(2, self.buffer.stats['allocations'])
+        self.assertEqual(2, self.buffer.stats['copies'])
+        self.assertEqual(8, self.buffer.stats['bytes_copied'])
+
+    def test_flush(self):
+        self.assertEqual(b'', self.buffer.flush().tobytes())
+        self.buffer.push(b'abc')
+        self.assertEqual(b'c\0', self.buffer.flush().tobytes())
+        self.assertEqual(0, self.buffer.pending)
+        self.assertEqual(b'de', self.buffer.push(b'de').tobytes())
+
+    def test_reset(self):
+        self.buffer.push(b'abc')
+        self.buffer.reset()
+        self.assertEqual(b'de', self.buffer.push(b'de').tobytes())
+
+
+class AudioRingBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.ring = audio_helpers.AudioRingBuffer(4)
+
+    def test_latest(self):
+        self.assertEqual(b'', self.ring.latest())
+        self.ring.write(b'abc')
+        self.assertEqual(b'abc', self.ring.latest())
+        self.assertEqual(b'bc', self.ring.latest(2))
+        self.assertEqual(3, len(self.ring))
+
+    def test_wrap(self):
+        self.ring.write(b'abc')
+        self.ring.write(b'de')
+        self.assertEqual(b'bcde', self.ring.latest())
+        self.assertEqual(4, len(self.ring))
+
+    def test_write_larger(self):
+        self.assertEqual(6, self.ring.write(b'abcdef'))
+        self.assertEqual(b'cdef', self.ring.latest())
+
+    def test_clear(self):
+        self.ring.write(b'abc')
+        self.ring.clear()
+        self.assertEqual(b'', self.ring.latest())
+        self.ring.write(b'd')
+        self.assertEqual(b'd', self.ring.latest())
+
+
+class SpscRingBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.ring = audio_helpers.SpscRingBuffer(4)
+
+    def test_read_write(self):
+        self.assertEqual(3, self.ring.write(b'abc'))
+        self.assertEqual(3, self.ring.available)
+        self.assertEqual(1, self.ring.free)
+        self.assertEqual(b'ab', self.ring.read(2))
+        self.assertEqual(b'c', self.ring.read(4))
+        self.assertEqual(b'', self.ring.read(4))
+
+    def test_full(self):
+        self.assertEqual(4, self.ring.write(b'abcdef'))
+        self.assertEqual(0, self.ring.write(b'g'))
+        self.assertEqual(b'abcd', self.ring.read(8))
+
+    def test_wrap(self):
+        self.ring.write(b'abc')
+        self.ring.read(2)
+        self.assertEqual(3, self.ring.write(b'def'))
+        out = bytearray(4)
+        self.assertEqual(4, self.ring.read_into(out))
+        self.assertEqual(b'cdef', bytes(out))
+
+    def test_clear(self):
+        self.ring.write(b'abc')
+        self.ring.clear()
+        self.assertEqual(0, self.ring.available)
+        self.assertEqual(4, self.ring.write(b'defg'))
+
+
+@unittest.skipIf(audio_helpers.np is None, 'requires NumPy')
+class ResamplerTest(unittest.TestCase):
+    def tone(self, rate, seconds, delay=0):
+        np = audio_helpers.np
+        t = np.arange(int(rate * seconds)) / float(rate) - delay
+        return 10000 * np.sin(2 * np.pi * 1000 * t)
+
+    def resample(self, in_rate, out_rate, chunk_size):
+        resampler = audio_helpers.Resampler(in_rate, out_rate)
+        data = self.tone(in_rate, 1).astype('<i2').tobytes()
+        out = b''.join(resampler.process(data[i:i + chunk_size])
+                       for i in range(0, len(data), chunk_size))
+        return resampler, audio_helpers.np.frombuffer(out, dtype='<i2')
+
+    def test_rates(self):
+        for in_rate, out_rate in ((48000, 16000), (16000, 48000),
+                                  (44100, 16000), (16000, 44100)):
+            resampler, out = self.resample(in_rate, out_rate, 3200)
+            self.assertEqual(out_rate, len(out))
+            # Compare to the delayed tone, past the filter warm up.
+            expected = self.tone(out_rate, 1, resampler.delay / in_rate)
+            error = (out - expected)[out_rate // 10:]
+            self.assertLess(abs(error).max(), 20)
+
+    def test_chunk_size(self):
+        _, whole = self.resample(44100, 16000, 88200)
+        _, chunked = self.resample(44100, 16000, 202)
+        self.assertEqual(whole.tobytes(), chunked.tobytes())
+
+    def test_memoryview(self):
+        # Playback resamples the memoryviews of the playback buffer.
+        data = self.tone(16000, 0.1).astype('<i2').tobytes()
+        expected = audio_helpers.Resampler(16000, 44100).process(data)
+        resampler = audio_helpers.Resampler(16000, 44100)
+        self.assertEqual(expected,
+                         resampler.process(memoryview(bytearray(data))))
+
+    def test_small_chunks(self):
+        resampler = audio_helpers.Resampler(16000, 48000)
+        self.assertEqual(6, len(resampler.process(b'\0\0')))
+        resampler = audio_helpers.Resampler(48000, 16000)
+        self.assertEqual([2, 0, 0, 2], [len(resampler.process(b'\1\0'))
+                                        for _ in range(4)])
+
+
 class WaveSourceTest(unittest.TestCase):
     def setUp(self):
         stream = BytesIO()
@@ -55,13 +204,15 @@ class WaveSourceTest(unittest.TestCase):
         self.assertGreater(time.time(), previous_time + self.sleep_time_1024)
 
     def test_next_sleep(self):
+        previous_time = time.time()
         self.source.read(1024)
         self.source.read(512)
-        previous_time = time.time()
         self.source.read(0)
-        # sleep was called with sleep_time_512
-        self.assertGreater(time.time(), previous_time + self.sleep_time_512)
-        self.assertLess(time.time(), previous_time + self.sleep_time_1024)
+        # sleeps add up to sleep_time_1024 + sleep_time_512, without drift
+        self.assertGreater(time.time(), previous_time +
+                           self.sleep_time_1024 + self.sleep_time_512)
+        self.assertLess(time.time(), previous_time +
+                        self.sleep_time_1024 + 2 * self.sleep_time_512)
 
     def test_read_header(self):
         self.assertEqual(b'audiodata', self.source.read(9))
@@ -75,6 +226,761 @@ class WaveSourceTest(unittest.TestCase):
         self.assertEqual(b'audiodata', self.source.read(9))
         self.assertEqual(b'\x00'*9, self.source.read(9))
 
+    def test_end_at_eof(self):
+        self.stream.seek(0)
+        self.source = audio_helpers.WaveSource(
+            self.stream, 16000, 2, pacing=audio_helpers.BURST,
+            trailing_silence_ms=0)
+        self.assertEqual(b'audiodata', self.source.read(16))
+        self.assertEqual(b'', self.source.read(16))
+
+    def test_read_bytes(self):
+        # Reads are in bytes, not in frames.
+        self.assertEqual(b'audi', self.source.read(4))
+        self.assertEqual(b'od', self.source.read(2))
+        self.assertEqual(b'ata', self.source.read(4))
+        self.assertEqual({'chunks': 3, 'bytes': 9, 'frames': 4,
+                          'seconds': 9 / 32000.0}, self.source.stats)
+
+    def test_burst(self):
+        self.source = audio_helpers.WaveSource(
+            self.stream, 16000, 2, pacing=audio_helpers.BURST)
+        previous_time = time.time()
+        for _ in range(10):
+            self.source.read(1024)
+        self.assertLess(time.time(), previous_time + self.sleep_time_1024)
+
+
+class AudioChunkerTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = BytesIO(b'abcdefghij')
+        self.requests = []
+        self.chunker = audio_helpers.AudioChunker(16000, 2, self.read_frames)
+
+    def read_frames(self, frames):
+        self.requests.append(frames)
+        return self.stream.read(frames * 2)
+
+    def test_read_carry(self):
+        self.assertEqual(b'abc', self.chunker.read(3))
+        self.assertEqual(b'de', self.chunker.read(2))
+        self.assertEqual(b'f', self.chunker.read(1))
+        self.assertEqual(b'ghij', self.chunker.read(8))
+        self.assertEqual(b'', self.chunker.read(2))
+        # The third read is served from the carried partial frame.
+        self.assertEqual([2, 1, 4, 1], self.requests)
+
+    def test_stats(self):
+        self.chunker.count(b'\0' * 3200)
+        self.chunker.count(b'\0' * 3)
+        self.assertEqual({'chunks': 2, 'bytes': 3203, 'frames': 1601,
+                          'seconds': 3203 / 32000.0}, self.chunker.stats)
+
+    def test_duration(self):
+        self.assertEqual(0.1, self.chunker.duration(3200))
+
+    def test_silence(self):
+        silence = self.chunker.silence(4)
+        self.assertEqual(b'\0' * 4, silence)
+        self.assertIs(silence, self.chunker.silence(4))
+        self.assertEqual(b'\0' * 2, self.chunker.silence(2))
+
+    def test_trailing_silence(self):
+        self.assertEqual(b'\0' * 8, self.chunker.trailing_silence(8))
+        chunker = audio_helpers.AudioChunker(16000, 2,
+                                             trailing_silence_ms=1)
+        self.assertEqual(b'\0' * 20, chunker.trailing_silence(20))
+        self.assertEqual(b'\0' * 12, chunker.trailing_silence(20))
+        self.assertEqual(b'', chunker.trailing_silence(20))
+
+
+class PacerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.pacer = audio_helpers.Pacer(2.0, clock=lambda: self.now)
+
+    def test_speed(self):
+        self.assertEqual(self.pacer.schedule(1.0), 0)
+        self.assertEqual(self.pacer.schedule(1.0), 0.5)
+
+    def test_no_drift(self):
+        self.pacer.schedule(1.0)
+        self.pacer.schedule(1.0)
+        # Woke up late from the last wait: the next one makes up for it.
+        self.now = 0.6
+        self.assertAlmostEqual(self.pacer.schedule(1.0), 0.4)
+
+    def test_no_catch_up(self):
+        self.pacer.schedule(1.0)
+        self.now = 5.0
+        self.assertEqual(self.pacer.schedule(1.0), 0)
+        self.assertEqual(self.pacer.schedule(1.0), 0.5)
+
+    def test_burst(self):
+        pacer = audio_helpers.Pacer(audio_helpers.BURST,
+                                    clock=lambda: self.now)
+        self.assertEqual(pacer.schedule(1.0), 0)
+        self.assertEqual(pacer.schedule(1.0), 0)
+
+    def test_parse_pacing(self):
+        self.assertEqual(audio_helpers.parse_pacing('realtime'),
+                         audio_helpers.REALTIME)
+        self.assertEqual(audio_helpers.parse_pacing('burst'),
+                         audio_helpers.BURST)
+        self.assertEqual(audio_helpers.parse_pacing('4x'), 4.0)
+        self.assertEqual(audio_helpers.parse_pacing('0.5'), 0.5)
+        for value in ('fast', '-2x', 'x'):
+            with self.assertRaises(ValueError):
+                audio_helpers.parse_pacing(value)
+
+
+class MappedWaveSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        path = os.path.join(self.tmpdir, 'audio')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def wav(self, data, sample_rate=16000):
+        stream = BytesIO()
+        w = wave.open(stream, 'wb')
+        w.setframerate(sample_rate)
+        w.setsampwidth(2)
+        w.setnchannels(1)
+        w.writeframes(data)
+        w.close()
+        return stream.getvalue()
+
+    def source(self, data):
+        return audio_helpers.MappedWaveSource(self.write(data), 16000, 2,
+                                              pacing=audio_helpers.BURST)
+
+    def test_read(self):
+        source = self.source(self.wav(b'audiodata!'))
+        self.assertEqual(len(source), 10)
+        chunk = source.read(4)
+        self.assertIsInstance(chunk, memoryview)
+        self.assertEqual(b'audi', chunk.tobytes())
+        self.assertEqual(b'odata!', source.read(8).tobytes())
+        self.assertEqual(10, source.tell())
+        self.assertEqual(b'\x00' * 4, source.read(4))
+        source.close()
+
+    def test_raw(self):
+        source = self.source(b'audiodata')
+        self.assertEqual(b'audiodata', source.read(9).tobytes())
+        source.close()
+
+    def test_empty(self):
+        source = self.source(b'')
+        self.assertEqual(b'\x00' * 4, source.read(4))
+        source.close()
+
+    def test_close_with_slices(self):
+        source = self.source(self.wav(b'audiodata!'))
+        chunk = source.read(4)
+        source.close()
+        self.assertEqual(b'audi', chunk.tobytes())
+
+    def test_parse_wave_header(self):
+        data = self.wav(b'abcd')
+        # Insert an odd sized chunk before the data chunk.
+        data = (data[:36] + b'LIST' + struct.pack('<I', 3) + b'xyz\0' +
+                data[36:])
+        offset, size, params = audio_helpers.parse_wave_header(data)
+        self.assertEqual(b'abcd', data[offset:offset + size])
+        self.assertEqual((1, 16000, 2), params)
+
+    def test_parse_wave_header_truncated(self):
+        data = self.wav(b'abcdef')[:-2]
+        offset, size, params = audio_helpers.parse_wave_header(data)
+        self.assertEqual(b'abcd', data[offset:offset + size])
+
+    def test_parse_wave_header_invalid(self):
+        for data in (b'audiodata', self.wav(b'')[:36]):
+            with self.assertRaises(ValueError):
+                audio_helpers.parse_wave_header(data)
+
+    def test_format_mismatch(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger().addHandler(handler)
+        try:
+            source = audio_helpers.MappedWaveSource(
+                self.write(self.wav(b'abcd', sample_rate=8000)), 16000, 2)
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual([logging.WARNING], [r.levelno for r in records])
+        self.assertEqual(b'abcd', source.read(4).tobytes())
+        source.close()
+
+
+class CountingSource(object):
+    """Source returning chunks of increasing byte values."""
+    def __init__(self, chunk_delay=0.001):
+        self.chunk_delay = chunk_delay
+        self.count = 0
+        self.started = threading.Event()
+        self.closed = False
+
+    def start(self):
+        self.started.set()
+
+    def read(self, size):
+        time.sleep(self.chunk_delay)
+        self.count += 1
+        return struct.pack('B', self.count % 256) * size
+
+    def close(self):
+        self.closed = True
+
+
+class AlwaysOpenSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.source = CountingSource()
+        # 2ms of pre-roll at 1kHz, 4 bytes.
+        self.stream = audio_helpers.AlwaysOpenSource(
+            self.source, 1000, 2, pre_roll_ms=2, chunk_size=2)
+
+    def tearDown(self):
+        self.stream.close()
+
+    def test_pre_roll(self):
+        self.assertTrue(self.source.started.wait(1))
+        while self.source.count < 5:
+            time.sleep(0.001)
+        self.stream.start()
+        data = bytearray(self.stream.read(6))
+        # Two chunks captured before start, then a live chunk.
+        self.assertEqual(data[2:4], bytearray([data[0] + 1]) * 2)
+        self.assertEqual(data[4:], bytearray([data[0] + 2]) * 2)
+        self.assertEqual(4, self.stream.stats['pre_roll_bytes'])
+
+    def test_stop(self):
+        self.stream.start()
+        self.stream.read(2)
+        self.stream.stop()
+        self.stream.start()
+        self.assertEqual(2, self.stream.stats['recordings'])
+
+    def test_close(self):
+        self.stream.start()
+        self.stream.close()
+        self.assertTrue(self.source.closed)
+        # Reads return the remaining audio instead of blocking.
+        self.assertLess(len(self.stream.read(1 << 20)), 1 << 20)
+
+
+class RecordingSink(object):
+    def __init__(self):
+        self.writes = []
+        self.events = []
+
+    def write(self, buf):
+        self.writes.append(bytes(buf))
+        return len(buf)
+
+    def start(self):
+        self.events.append('start')
+
+    def flush(self):
+        self.events.append('flush')
+
+    def stop(self):
+        self.events.append('stop')
+
+    def close(self):
+        self.events.append('close')
+
+
+class JitterBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.sink = RecordingSink()
+        self.tracer = trace_helpers.TurnTracer()
+        self.now = 0
+        # 2 bytes per millisecond, 20ms periods of 40 bytes.
+        self.buffer = audio_helpers.JitterBuffer(
+            self.sink, 1000, 2, target_ms=50, min_ms=20, max_ms=200,
+            tracer=self.tracer, clock=lambda: self.now)
+        self.buffer.start()
+
+    def tearDown(self):
+        self.buffer.close()
+
+    def wait_for_writes(self, count):
+        for _ in range(1000):
+            if len(self.sink.writes) >= count:
+                return
+            time.sleep(0.001)
+
+    def test_prefill(self):
+        self.buffer.write(b'a' * 60)
+        time.sleep(0.01)
+        self.assertEqual([], self.sink.writes)
+        self.buffer.write(b'b' * 60)
+        self.wait_for_writes(3)
+        self.assertEqual(b'a' * 40, self.sink.writes[0])
+
+    def test_stop(self):
+        self.buffer.write(b'ab' * 25)
+        self.buffer.stop()
+        self.assertEqual(b'ab' * 25, b''.join(self.sink.writes))
+        self.assertEqual([40, 10], [len(w) for w in self.sink.writes])
+        self.assertEqual(['start', 'stop'], self.sink.events)
+
+    def test_underflow(self):
+        # 50ms, then the buffer runs empty with 10ms left.
+        self.buffer.write(b'a' * 100)
+        self.wait_for_writes(2)
+        time.sleep(0.01)
+        # The sink is still playing the 40ms written to it.
+        self.assertEqual(0, self.buffer.stats['underflows'])
+        self.now = 0.05
+        for _ in range(1000):
+            if self.buffer.stats['underflows']:
+                break
+            time.sleep(0.001)
+        self.assertEqual(1, self.buffer.stats['underflows'])
+        # The target grew by half, from 49.7ms after the write.
+        self.assertAlmostEqual(74.55, self.buffer.target_ms)
+        self.assertEqual({(trace_helpers.PLAYBACK_UNDERFLOWS_METRIC, ()): 1},
+                         self.tracer.counters)
+
+    def test_bursts(self):
+        # 60ms bursts, each arriving before the sink played the previous.
+        for i in range(5):
+            self.now = i * 0.06
+            self.buffer.write(b'a' * 120)
+            self.wait_for_writes(3 * (i + 1))
+            time.sleep(0.005)
+        self.assertEqual(15, len(self.sink.writes))
+        self.assertEqual(0, self.buffer.stats['underflows'])
+
+    def test_jitter(self):
+        # 10ms chunks, the third one 80ms late.
+        for now in (0, 0.01, 0.1):
+            self.now = now
+            self.buffer.write(b'a' * 20)
+        self.assertAlmostEqual(80, self.buffer.target_ms)
+
+    def test_abort(self):
+        self.buffer.write(b'a' * 60)
+        self.buffer.abort()
+        self.buffer.flush()
+        self.assertEqual([], self.sink.writes)
+        self.assertEqual(['start', 'stop', 'flush'], self.sink.events)
+        self.assertIn((trace_helpers.PLAYBACK_TARGET_DEPTH_METRIC, ()),
+                      self.tracer.gauges)
+
+
+class FakeRawStream(object):
+    """Raw stream playing the written audio in real time.
+
+    Its buffer holds the output latency: writes block while it is full
+    and stop plays the rest of it.
+    """
+    latency = (0.01, 0.02)
+
+    def __init__(self, sample_rate=1000):
+        self.sample_rate = sample_rate
+        self.active = False
+        self.written = bytearray()
+        self._end = 0
+
+    def _queued(self):
+        return max(0.0, self._end - time.time())
+
+    @property
+    def write_available(self):
+        return max(0, int((self.latency[1] - self._queued()) *
+                          self.sample_rate))
+
+    def write(self, buf):
+        duration = len(buf) / 2.0 / self.sample_rate
+        self._end = max(self._end, time.time()) + duration
+        # Wait for room in the buffer.
+        wait = self._queued() - self.latency[1]
+        if wait > 0:
+            time.sleep(wait)
+        self.written.extend(buf)
+        return False
+
+    def start(self):
+        self.active = True
+
+    def stop(self):
+        time.sleep(self._queued())
+        self.active = False
+
+    def abort(self):
+        self._end = 0
+        self.active = False
+
+    def close(self):
+        self.active = False
+
+
+class FakeBlockingStream(audio_helpers.SoundDeviceStream):
+    def _open_stream(self, sample_rate, dtype, blocksize):
+        return FakeRawStream(sample_rate)
+
+
+class SoundDeviceStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = FakeBlockingStream(1000, 2, 4, 0, always_open=True)
+        self.stream.start()
+
+    def test_flush_drains(self):
+        # 50ms of audio and 20ms of output latency: the write returns
+        # once the last 20ms are in the device buffer.
+        self.stream.write(b'\0' * 100)
+        start = time.time()
+        self.stream.flush()
+        self.assertGreaterEqual(time.time() - start, 0.015)
+        self.assertLess(time.time() - start, 0.035)
+        self.assertEqual(100, len(self.stream._audio_stream.written))
+
+    def test_stop_drains(self):
+        stream = FakeBlockingStream(1000, 2, 4, 0)
+        stream.start()
+        stream.write(b'\0' * 100)
+        start = time.time()
+        # The stopped device plays its buffer once, flush does not wait.
+        stream.flush()
+        self.assertLess(time.time() - start, 0.005)
+        stream.stop()
+        self.assertLess(time.time() - start, 0.035)
+
+    def test_flush_played(self):
+        self.stream.write(b'\0' * 20)
+        time.sleep(0.04)
+        start = time.time()
+        self.stream.flush()
+        self.assertLess(time.time() - start, 0.01)
+
+    def test_latency(self):
+        self.assertEqual(0.01, self.stream.input_latency)
+        self.assertEqual(0.02, self.stream.output_latency)
+
+    def test_abort_keeps_capture(self):
+        self.stream.write(b'\0' * 100)
+        self.stream.abort()
+        self.assertTrue(self.stream._audio_stream.active)
+        start = time.time()
+        self.stream.flush()
+        self.assertLess(time.time() - start, 0.01)
+
+    def test_flush_size_ignored(self):
+        stream = FakeBlockingStream(1000, 2, 4, 8)
+        stream.start()
+        stream.flush()
+        self.assertEqual(b'', stream._audio_stream.written)
+
+
+class FakeCallbackFlags(object):
+    input_overflow = False
+
+
+class FakeCallbackStream(audio_helpers.CallbackSoundDeviceStream):
+    def _open_stream(self, sample_rate, dtype, blocksize):
+        return FakeRawStream(sample_rate)
+
+
+class CallbackSoundDeviceStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.tracer = trace_helpers.TurnTracer()
+        # 2 bytes per millisecond, rings of 8 bytes.
+        self.stream = FakeCallbackStream(1000, 2, 4, 4, ring_ms=4,
+                                         tracer=self.tracer)
+        self.stream.start()
+
+    def callback(self, indata, frames=2):
+        outdata = bytearray(b'x' * frames * 2)
+        self.stream._callback(indata, outdata, frames, None,
+                              FakeCallbackFlags())
+        return bytes(outdata)
+
+    def test_capture(self):
+        self.callback(b'abcd')
+        self.callback(b'efgh')
+        self.assertEqual(b'abcdefgh', self.stream.read(8))
+
+    def test_read_woken_by_callback(self):
+        self.stream._wait_timeout = 10
+        device = threading.Timer(0.01, lambda: self.callback(b'abcd'))
+        device.start()
+        start = time.time()
+        self.assertEqual(b'abcd', self.stream.read(4))
+        self.assertLess(time.time() - start, 1)
+        device.join()
+
+    def test_capture_overflow(self):
+        for _ in range(3):
+            self.callback(b'abcd')
+        self.assertEqual(b'abcdabcd', self.stream.read(8))
+        self.assertEqual(1, self.stream.stats['overflows'])
+        self.assertEqual(
+            {(trace_helpers.AUDIO_OVERFLOWS_METRIC, ()): 1},
+            self.tracer.counters)
+
+    def test_playback(self):
+        self.stream.write(b'abcdef')
+        self.assertEqual(b'abcd', self.callback(b'\0' * 4))
+        self.assertEqual(b'ef\0\0', self.callback(b'\0' * 4))
+        self.assertEqual(1, self.stream.stats['underflows'])
+        self.stream.flush()
+        # Silence after flush is not an underflow.
+        self.assertEqual(b'\0' * 4, self.callback(b'\0' * 4))
+        self.assertEqual(1, self.stream.stats['underflows'])
+        self.assertEqual(
+            {(trace_helpers.AUDIO_UNDERFLOWS_METRIC, ()): 1},
+            self.tracer.counters)
+
+    def test_abort(self):
+        self.stream.write(b'abcdef')
+        self.stream._audio_stream.stop()
+        self.stream.abort()
+        self.stream.start()
+        self.assertEqual(b'\0' * 4, self.callback(b'\0' * 4))
+        self.assertEqual(0, self.stream.stats['underflows'])
+
+    def test_interrupt_keeps_capture(self):
+        conversation = audio_helpers.ConversationStream(
+            source=self.stream, sink=self.stream, iter_size=4,
+            sample_width=2)
+        conversation.start_recording()
+        self.callback(b'abcd')
+        conversation.start_playback()
+        conversation.write(b'wxyz')
+        # The callback drops the playback while the device keeps running.
+        played = []
+        device = threading.Timer(
+            0.01, lambda: played.append(self.callback(b'efgh')))
+        device.start()
+        conversation.interrupt_playback()
+        device.join()
+        self.assertTrue(self.stream._audio_stream.active)
+        self.assertEqual([b'\0' * 4], played)
+        self.assertEqual(0, self.stream.stats['underflows'])
+        self.assertEqual(b'abcdefgh', conversation.read(8))
+
+
+@unittest.skipIf(audio_helpers.np is None, 'requires NumPy')
+class CallbackResamplingStreamTest(unittest.TestCase):
+    def setUp(self):
+        # 16kHz audio through a 44.1kHz device, rings of 441 bytes.
+        self.stream = FakeCallbackStream(16000, 2, 0, 0, ring_ms=5,
+                                         device_sample_rate=44100)
+        self.stream.start()
+
+    def run_stopped(self, fn):
+        thread = threading.Thread(target=fn)
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.02)
+        self.stream._audio_stream.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_stop_while_reading(self):
+        self.stream._callback(b'\0' * 100, bytearray(100), 50, None,
+                              FakeCallbackFlags())
+        self.run_stopped(lambda: self.stream.read(3200))
+
+    def test_stop_while_writing(self):
+        self.run_stopped(lambda: self.stream.write(b'\0' * 3200))
+
+
+class LoopbackDevice(object):
+    """Real time sound device recording its output after a delay."""
+    def __init__(self, sample_rate, delay):
+        self.sample_rate = sample_rate
+        self.delay = delay
+        self.stats = {'overflows': 0, 'underflows': 0}
+        self.closed = False
+
+    def _position(self):
+        return int((time.time() - self._start) * self.sample_rate) * 2
+
+    def _wait(self, position):
+        remaining = (self._start + position / 2.0 / self.sample_rate -
+                     time.time())
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def start(self):
+        self._start = time.time()
+        self._timeline = bytearray()
+        self._read_pos = 0
+        self._write_pos = None
+
+    def read(self, size):
+        self._wait(self._read_pos + size)
+        data = bytes(self._timeline[self._read_pos:self._read_pos + size])
+        self._read_pos += size
+        return data + b'\0' * (size - len(data))
+
+    def write(self, buf):
+        position = self._position()
+        if self._write_pos is None or self._write_pos < position:
+            if self._write_pos is not None:
+                self.stats['underflows'] += 1
+            self._write_pos = position
+        start = self._write_pos + self.delay * 2
+        end = start + len(buf)
+        if len(self._timeline) < end:
+            self._timeline.extend(b'\0' * (end - len(self._timeline)))
+        self._timeline[start:end] = buf
+        self._write_pos += len(buf)
+        # Writes block when 20ms ahead of the device.
+        self._wait(self._write_pos - self.sample_rate // 25)
+
+    def flush(self):
+        self._wait(self._write_pos)
+
+    def stop(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTimeInfo(object):
+    def __init__(self, current, input_latency, output_latency):
+        self.currentTime = current
+        self.inputBufferAdcTime = current - input_latency
+        self.outputBufferDacTime = current + output_latency
+
+
+class LoopbackCallbackDevice(FakeCallbackStream):
+    """Callback stream recording its output after the stream latencies
+    and a loopback delay, in real time."""
+    def __init__(self, sample_rate, input_latency, output_latency, delay):
+        super(LoopbackCallbackDevice, self).__init__(sample_rate, 2, 0, 0)
+        self._latencies = (input_latency, output_latency)
+        # Output played at a DAC time is captured at that ADC time plus
+        # the loopback delay.
+        self._line = bytearray(int(
+            (input_latency + output_latency + delay) * sample_rate) * 2)
+        self._frames = sample_rate // 100
+        self._thread = None
+
+    def _run(self):
+        frames = self._frames
+        period = frames / float(self.sample_rate)
+        t = 0
+        while self._audio_stream.active:
+            outdata = bytearray(frames * 2)
+            self._callback(bytes(self._line[:frames * 2]), outdata, frames,
+                           FakeTimeInfo(t, *self._latencies),
+                           FakeCallbackFlags())
+            del self._line[:frames * 2]
+            self._line.extend(outdata)
+            t += period
+            time.sleep(period)
+
+    def start(self):
+        super(LoopbackCallbackDevice, self).start()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def stop(self):
+        super(LoopbackCallbackDevice, self).stop()
+        self._thread.join()
+
+
+class CalibrationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_measure(self):
+        # 50ms round trip.
+        device = LoopbackDevice(8000, 400)
+        result = audio_helpers.measure_audio_device(
+            device, 8000, 160, seconds=0.3, tail_seconds=0.1)
+        self.assertAlmostEqual(0.05, result['round_trip_latency'],
+                               delta=0.015)
+        self.assertFalse(result['truncated'])
+        self.assertEqual(0, result['underflows_per_second'])
+        # The first frame, not a first read of 20ms.
+        self.assertLess(result['capture_start_latency'], 0.015)
+
+    def test_measure_stream_times(self):
+        # 20ms input and 30ms output latencies, 5ms loopback.
+        device = LoopbackCallbackDevice(8000, 0.02, 0.03, 0.005)
+        result = audio_helpers.measure_audio_device(
+            device, 8000, 160, seconds=0.3, tail_seconds=0.1)
+        self.assertAlmostEqual(0.055, result['round_trip_latency'],
+                               delta=0.001)
+        self.assertAlmostEqual(0.005, result['loopback_latency'],
+                               delta=0.001)
+        self.assertFalse(result['truncated'])
+
+    def test_not_looped_back(self):
+        device = LoopbackDevice(8000, 8000)
+        result = audio_helpers.measure_audio_device(
+            device, 8000, 160, seconds=0.2, tail_seconds=0)
+        self.assertIsNone(result['round_trip_latency'])
+
+    def test_calibrate(self):
+        devices = []
+
+        def open_device(block_size):
+            # Larger blocks buffer more audio: 10ms and 110ms round trips.
+            devices.append(LoopbackDevice(8000, 80 + block_size // 2))
+            return devices[-1]
+        results = audio_helpers.calibrate_audio_device(
+            open_device, 8000, block_sizes=(1600, 0), iter_sizes=(800, 160),
+            seconds=0.3, tail_seconds=0.15)
+        self.assertEqual(4, len(results))
+        self.assertTrue(all(d.closed for d in devices))
+        profile = audio_helpers.select_audio_profile(results)
+        self.assertEqual(0, profile['audio_block_size'])
+        self.assertAlmostEqual(0.01, profile['round_trip_latency'],
+                               delta=0.015)
+
+    def test_select(self):
+        results = [
+            {'underflows_per_second': 1, 'truncated': False,
+             'overflows_per_second': 0, 'round_trip_latency': 0.01,
+             'capture_start_latency': 0.01, 'audio_block_size': 0},
+            {'underflows_per_second': 0, 'truncated': False,
+             'overflows_per_second': 0, 'round_trip_latency': None,
+             'capture_start_latency': 0.01, 'audio_block_size': 1600},
+            {'underflows_per_second': 0, 'truncated': False,
+             'overflows_per_second': 0, 'round_trip_latency': 0.2,
+             'capture_start_latency': 0.001, 'audio_block_size': 6400},
+            {'underflows_per_second': 0, 'truncated': False,
+             'overflows_per_second': 0, 'round_trip_latency': 0.1,
+             'capture_start_latency': 0.1, 'audio_block_size': 3200},
+        ]
+        self.assertEqual(
+            3200, audio_helpers.select_audio_profile(results)[
+                'audio_block_size'])
+
+    def test_save_load(self):
+        path = os.path.join(self.tmpdir, 'app', 'audio_profile.json')
+        self.assertEqual({}, audio_helpers.load_audio_profile(path))
+        audio_helpers.save_audio_profile({
+            'audio_block_size': 3200,
+            'audio_iter_size': 1600,
+            'round_trip_latency': 0.05,
+        }, path)
+        self.assertEqual({
+            'audio_block_size': 3200,
+            'audio_iter_size': 1600,
+        }, audio_helpers.load_audio_profile(path))
+
 
 class WaveSinkTest(unittest.TestCase):
     def setUp(self):
@@ -86,7 +992,8 @@ class WaveSinkTest(unittest.TestCase):
         self.assertEqual(b'RIFF', self.stream.getvalue()[:4])
 
 
-class DummyStream(BytesIO, object):
+# io.BytesIO also accepts the memoryviews written to sinks on Python 2.
+class DummyStream(io.BytesIO):
     started = False
     stopped = False
     flushed = False
@@ -111,6 +1018,33 @@ class DummyStream(BytesIO, object):
         self.flushed = True
 
 
+class GrowingChunkPolicyTest(unittest.TestCase):
+    def sizes(self, policy, count):
+        sizes = []
+        for _ in range(count):
+            sizes.append(policy.next_size())
+            policy.update(b'\0' * sizes[-1])
+        return sizes
+
+    def test_growth(self):
+        policy = audio_helpers.GrowingChunkPolicy(640, 3200)
+        self.assertEqual([640, 1280, 2560, 3200, 3200],
+                         self.sizes(policy, 5))
+        policy.reset()
+        self.assertEqual(640, policy.next_size())
+
+    def test_sample_aligned(self):
+        policy = audio_helpers.GrowingChunkPolicy(641, 3201, growth=1.5)
+        self.assertEqual([640, 960, 1440, 2160, 3200],
+                         self.sizes(policy, 5))
+
+    def test_empty_chunk(self):
+        policy = audio_helpers.GrowingChunkPolicy(640, 3200)
+        self.assertEqual(640, policy.next_size())
+        policy.update(b'')
+        self.assertEqual(640, policy.next_size())
+
+
 class ConversationStreamTest(unittest.TestCase):
     def setUp(self):
         self.source = DummyStream(b'audio data')
@@ -122,6 +1056,14 @@ class ConversationStreamTest(unittest.TestCase):
             sample_width=2)
         self.stream.volume_percentage = 100
 
+    def test_chunk_policy(self):
+        stream = audio_helpers.ConversationStream(
+            source=DummyStream(b'x' * 20), sink=self.sink, iter_size=8,
+            sample_width=2,
+            chunk_policy=audio_helpers.GrowingChunkPolicy(2, 8))
+        stream.start_recording()
+        self.assertEqual([2, 4, 8, 6], [len(c) for c in stream])
+
     def test_stop_recording(self):
         self.stream.start_recording()
         self.assertEqual(b'audio', self.stream.read(5))
@@ -134,7 +1076,24 @@ class ConversationStreamTest(unittest.TestCase):
         self.assertEqual(b'', self.sink.getvalue())
         self.stream.start_playback()
         self.stream.write(b'foo')
-        self.assertEqual(b'foo\0', self.sink.getvalue())
+        self.assertEqual(b'fo', self.sink.getvalue())
+
+    def test_write_carry(self):
+        self.stream.start_playback()
+        self.stream.write(b'abc')
+        self.stream.write(b'def')
+        self.assertEqual(b'abcdef', self.sink.getvalue())
+        self.assertEqual(1, self.stream.playback_stats['allocations'])
+        self.assertEqual(2, self.stream.playback_stats['copies'])
+
+    def test_split_sample_phase(self):
+        self.stream.start_playback()
+        for c in (b'a', b'bc', b'd', b'efg'):
+            self.stream.write(c)
+        self.assertEqual(b'abcdef', self.sink.getvalue())
+        self.stream.stop_playback()
+        self.assertEqual(b'abcdefg\0', self.sink.getvalue())
+        self.assertTrue(self.sink.flushed)
 
     def test_sink_source_state(self):
         self.assertEquals(False, self.source.started)
@@ -156,6 +1115,11 @@ class ConversationStreamTest(unittest.TestCase):
         self.stream.write(b'foo')
         self.stream.stop_playback()
 
+    def test_iter_end_of_source(self):
+        self.stream._iter_size = 4
+        self.stream.start_recording()
+        self.assertEqual([b'audi', b'o da', b'ta'], list(self.stream))
+
     def test_normalize_audio_buffer(self):
         self.assertEqual(b'',
                          audio_helpers.normalize_audio_buffer(b'', 100))
@@ -165,6 +1129,48 @@ class ConversationStreamTest(unittest.TestCase):
                          audio_helpers.normalize_audio_buffer(
                              b'\x01\x02\x03\x04', 50))
 
+    def test_normalize_audio_buffer_python(self):
+        scale = audio_helpers.volume_scale(50)
+        self.assertEqual(b'\xd4\x00\xa9\x01',
+                         audio_helpers._scale_samples_python(
+                             b'\x01\x02\x03\x04', scale, 2, False))
+
+    def test_normalize_audio_buffer_python_in_place(self):
+        scale = audio_helpers.volume_scale(50)
+        buf = bytearray(b'\x00\x00\x01\x02\x03\x04')
+        view = memoryview(buf)[2:]
+        self.assertIs(view, audio_helpers._scale_samples_python(
+            view, scale, 2, True))
+        self.assertEqual(b'\x00\x00\xd4\x00\xa9\x01', bytes(buf))
+
+    def test_normalize_audio_buffer_in_place(self):
+        buf = bytearray(b'\x01\x02\x03\x04')
+        result = audio_helpers.normalize_audio_buffer(memoryview(buf), 50,
+                                                      in_place=True)
+        self.assertIsInstance(result, memoryview)
+        self.assertEqual(b'\xd4\x00\xa9\x01', bytes(buf))
+
+    def test_normalize_audio_buffer_sample_width_4(self):
+        self.assertEqual(b'\x99y\x82\x1a\xcd\x0c\xfb\xca',
+                         audio_helpers.normalize_audio_buffer(
+                             b'\x00\x00\x00\x40\x00\x00\x00\x80', 50,
+                             sample_width=4))
+
+    def test_normalize_audio_buffer_saturation(self):
+        scale = audio_helpers.volume_scale(200)
+        for scale_samples in (audio_helpers._scale_samples_python,
+                              audio_helpers._scale_samples_numpy):
+            if (scale_samples is audio_helpers._scale_samples_numpy and
+                    audio_helpers.np is None):
+                continue
+            self.assertEqual(b'\xff\x7f\x00\x80',
+                             scale_samples(b'\x00\x40\x00\xc0',
+                                           scale, 2, False))
+
+    def test_normalize_audio_buffer_unsupported_width(self):
+        with self.assertRaises(Exception):
+            audio_helpers.normalize_audio_buffer(b'abc', 50, sample_width=3)
+
     def test_align_buf(self):
         self.assertEqual(b'foo\0', audio_helpers.align_buf(b'foo', 2))
         self.assertEqual(b'foobar', audio_helpers.align_buf(b'foobar', 2))
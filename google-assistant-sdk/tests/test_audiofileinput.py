@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import grpc
+import pytest
+
+from googlesamples.assistant.grpc import audiofileinput
+from googlesamples.assistant.grpc import fakeassistant
+
+
+DEVICE_REQUEST = {'requestId': 'request-id'}
+
+
+@pytest.fixture
+def assistant():
+    servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+        end_of_utterance_size=2048,
+        audio_out_size=100, audio_out_count=3,
+        device_request_json=json.dumps(DEVICE_REQUEST),
+    )
+    server, port = fakeassistant.serve(servicer)
+    channel = grpc.insecure_channel('localhost:%d' % port)
+    yield audiofileinput.FileAssistant('en-US', 'model-id', 'device-id',
+                                       channel, 10, 1024)
+    channel.close()
+    server.stop(0)
+
+
+def write_inputs(root, names):
+    for name in names:
+        path = root.join(name)
+        path.dirpath().ensure(dir=True)
+        path.write_binary(b'\0' * 2048)
+
+
+def read_results(path):
+    results = []
+    with open(str(path)) as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                results.append(None)
+    return results
+
+
+def test_list_batch_inputs(tmpdir):
+    write_inputs(tmpdir, ['b.wav', 'a/c.raw', 'd.txt'])
+    tmpdir.join('manifest.txt').write('# comment\nb.wav\n\na/c.raw\n')
+    assert audiofileinput.list_batch_inputs(str(tmpdir)) == [
+        str(tmpdir.join('a/c.raw')), str(tmpdir.join('b.wav'))]
+    assert audiofileinput.list_batch_inputs(str(tmpdir.join('*.wav'))) == [
+        str(tmpdir.join('b.wav'))]
+    assert audiofileinput.list_batch_inputs(
+        str(tmpdir.join('manifest.txt'))) == [
+            str(tmpdir.join('b.wav')), str(tmpdir.join('a/c.raw'))]
+
+
+def test_list_batch_inputs_single_file(tmpdir):
+    write_inputs(tmpdir, ['b.WAV'])
+    assert audiofileinput.list_batch_inputs(str(tmpdir.join('b.WAV'))) == [
+        str(tmpdir.join('b.WAV'))]
+
+
+def test_run_batch(assistant, tmpdir):
+    write_inputs(tmpdir.join('in'), ['a.wav', 'b.wav', 'sub/c.wav'])
+    paths = audiofileinput.list_batch_inputs(str(tmpdir.join('in')))
+    results_file = tmpdir.join('results.jsonl')
+    errors = audiofileinput.run_batch(assistant, paths,
+                                      str(tmpdir.join('out')),
+                                      str(results_file), 2)
+    assert errors == 0
+    results = sorted(read_results(results_file), key=lambda r: r['input'])
+    assert [r['input'] for r in results] == paths
+    for r in results:
+        assert r['error'] is None
+        assert r['transcript'] == 'what time is it'
+        assert r['display_text'] == 'It is time.'
+        assert r['device_requests'] == [DEVICE_REQUEST]
+    assert results[2]['output'] == str(tmpdir.join('out/sub/c.raw'))
+    assert os.path.getsize(results[2]['output']) == 300
+
+
+def test_run_batch_resume(assistant, tmpdir):
+    write_inputs(tmpdir, ['a.wav', 'b.wav', 'c.wav'])
+    paths = audiofileinput.list_batch_inputs(str(tmpdir.join('*.wav')))
+    results_file = tmpdir.join('results.jsonl')
+    # Interrupted run: a done, b failed, c truncated.
+    results_file.write(
+        json.dumps({'input': paths[0], 'error': None}) + '\n' +
+        json.dumps({'input': paths[1], 'error': 'UNAVAILABLE'}) + '\n' +
+        '{"input": "%s", "err' % paths[2])
+    assert audiofileinput.load_results(str(results_file)) == {paths[0]}
+    audiofileinput.run_batch(assistant, paths, str(tmpdir.join('out')),
+                             str(results_file), 2)
+    results = read_results(results_file)
+    assert results[2] is None
+    assert sorted(r['input'] for r in results[3:]) == paths[1:]
+    assert audiofileinput.load_results(str(results_file)) == set(paths)
+    assert audiofileinput.run_batch(assistant, paths, str(tmpdir),
+                                    str(results_file), 2) == 0
+    assert len(read_results(results_file)) == len(results)
+
+
+def test_run_batch_errors(assistant, tmpdir):
+    paths = [str(tmpdir.join('missing.wav'))]
+    results_file = tmpdir.join('results.jsonl')
+    assert audiofileinput.run_batch(assistant, paths, str(tmpdir),
+                                    str(results_file), 1) == 1
+    assert read_results(results_file)[0]['error']
+    assert audiofileinput.load_results(str(results_file)) == set()
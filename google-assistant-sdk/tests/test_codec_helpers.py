@@ -0,0 +1,287 @@
+#!/usr/bin/python
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import itertools
+import math
+import struct
+import unittest
+
+import grpc
+
+from google.assistant.embedded.v1alpha2 import embedded_assistant_pb2
+from googlesamples.assistant.grpc import audio_helpers
+from googlesamples.assistant.grpc import benchmark
+from googlesamples.assistant.grpc import codec_helpers
+from googlesamples.assistant.grpc import pushtotalk
+from six import BytesIO
+
+
+class BitReader(object):
+    def __init__(self, data):
+        self.bits = ''.join(format(b, '08b') for b in bytearray(data))
+        self.pos = 0
+
+    def read(self, n):
+        value = int(self.bits[self.pos:self.pos + n] or '0', 2)
+        self.pos += n
+        return value
+
+    def signed(self, n):
+        value = self.read(n)
+        return value - (1 << n) if value >> (n - 1) else value
+
+    def unary(self):
+        end = self.bits.index('1', self.pos)
+        q = end - self.pos
+        self.pos = end + 1
+        return q
+
+    def align(self):
+        self.pos = (self.pos + 7) // 8 * 8
+
+
+def decode_flac(data):
+    """Minimal decoder for the subset of FLAC produced by FlacEncoder."""
+    assert data[:4] == b'fLaC'
+    r = BitReader(data[4:])
+    assert r.read(1) == 1  # last metadata block
+    assert r.read(7) == 0  # STREAMINFO
+    assert r.read(24) == 34
+    r.read(80)  # block and frame sizes
+    sample_rate = r.read(20)
+    r.read(3)
+    bps = r.read(5) + 1
+    r.read(36 + 128)  # total samples and MD5 signature
+    samples = []
+    while r.pos < len(r.bits):
+        start = r.pos // 8
+        assert r.read(14) == 0x3ffe
+        r.read(2)
+        assert r.read(4) == 0b0111
+        r.read(12)
+        first = r.read(8)
+        while first & 0x40 and first & 0x80:
+            r.read(8)
+            first <<= 1
+        n = r.read(16) + 1
+        crc = codec_helpers.crc8(data[4:][start:r.pos // 8])
+        assert r.read(8) == crc
+        r.read(1)
+        kind = r.read(6)
+        r.read(1)
+        if kind == 0:
+            samples.extend([r.signed(bps)] * n)
+        elif kind == 1:
+            samples.extend(r.signed(bps) for _ in range(n))
+        else:
+            order = kind & 0x7
+            x = [r.signed(bps) for _ in range(order)]
+            assert r.read(2) == 0 and r.read(4) == 0
+            k = r.read(4)
+            coefs = [(-1) ** (j + 1) * binomial(order, j)
+                     for j in range(1, order + 1)]
+            for _ in range(n - order):
+                u = (r.unary() << k) | r.read(k)
+                x.append(((u >> 1) ^ -(u & 1)) +
+                         sum(c * x[-j] for j, c in enumerate(coefs, 1)))
+            samples.extend(x)
+        r.align()
+        crc = codec_helpers.crc16(data[4:][start:r.pos // 8])
+        assert r.read(16) == crc
+    return sample_rate, samples
+
+
+def binomial(n, k):
+    return math.factorial(n) // (math.factorial(k) * math.factorial(n - k))
+
+
+def pcm(samples):
+    samples = list(samples)
+    return struct.pack('<%dh' % len(samples), *samples)
+
+
+@unittest.skipIf(codec_helpers.np is None, 'requires NumPy')
+class FlacEncoderTest(unittest.TestCase):
+    def setUp(self):
+        self.encoder = codec_helpers.FlacEncoder(16000, 2)
+
+    def test_crc(self):
+        self.assertEqual(codec_helpers.crc8(b'123456789'), 0xf4)
+        self.assertEqual(codec_helpers.crc16(b'123456789'), 0xfee8)
+
+    def test_utf8_coded(self):
+        self.assertEqual(codec_helpers._utf8_coded(0x7f), b'\x7f')
+        self.assertEqual(codec_helpers._utf8_coded(0x80), b'\xc2\x80')
+        self.assertEqual(codec_helpers._utf8_coded(0x10000),
+                         b'\xf0\x90\x80\x80')
+
+    def test_stream_header(self):
+        header = self.encoder.stream_header()
+        self.assertEqual(header[:8], b'fLaC\x80\x00\x00\x22')
+        self.assertEqual(len(header), 42)
+
+    def test_round_trip(self):
+        sine = [int(8000 * math.sin(i / 5.0)) for i in range(1600)]
+        chunks = [pcm(sine[:800]), pcm(sine[800:]),
+                  pcm([7] * 100),
+                  pcm([-32768, 32767] * 50),
+                  pcm(range(10))]
+        data = b''.join(codec_helpers.encode_chunks(self.encoder, chunks))
+        sample_rate, samples = decode_flac(data)
+        self.assertEqual(sample_rate, 16000)
+        self.assertEqual(pcm(samples), b''.join(chunks))
+        self.assertLess(len(data), len(b''.join(chunks)))
+
+    def test_short_chunks_are_buffered(self):
+        self.assertEqual(self.encoder.encode(pcm(range(10))),
+                         self.encoder.stream_header())
+        self.assertEqual(self.encoder.encode(pcm(range(5))), b'')
+        frame = self.encoder.encode(pcm(range(1)))
+        self.assertEqual(struct.unpack('>H', frame[5:7])[0], 15)
+        self.assertEqual(self.encoder.flush(), b'')
+
+    def test_unsupported_sample_width(self):
+        self.assertEqual(codec_helpers.create_audio_in_encoder(
+            codec_helpers.FLAC, 16000, 4), (codec_helpers.LINEAR16, None))
+
+
+def ogg_page(serial, sequence, lacing, data):
+    return (b'OggS' + struct.pack('<BBqIII', 0, 0, 0, serial, sequence, 0) +
+            bytearray([len(lacing)]) + bytearray(lacing) + data)
+
+
+class OggDemuxerTest(unittest.TestCase):
+    def test_feed(self):
+        demuxer = codec_helpers.OggDemuxer()
+        stream = (ogg_page(1, 0, [3, 255], b'abc' + b'x' * 255) +
+                  ogg_page(2, 0, [2], b'zz') +
+                  ogg_page(1, 1, [10, 0], b'y' * 10))
+        packets = []
+        for i in range(0, len(stream), 7):
+            packets.extend(demuxer.feed(stream[i:i + 7]))
+        self.assertEqual(packets, [b'abc', b'x' * 255 + b'y' * 10, b''])
+
+    def test_packets_before_end_of_page(self):
+        demuxer = codec_helpers.OggDemuxer()
+        page = ogg_page(1, 0, [3, 4], b'abcdefg')
+        self.assertEqual(demuxer.feed(page[:-4]), [b'abc'])
+        self.assertEqual(demuxer.feed(page[-4:]), [b'defg'])
+
+    def test_invalid_page(self):
+        with self.assertRaises(ValueError):
+            codec_helpers.OggDemuxer().feed(b'RIFF' + b'\0' * 32)
+
+
+def sine(seconds, sample_rate=16000):
+    return pcm(int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate))
+               for i in range(int(seconds * sample_rate)))
+
+
+@unittest.skipIf(codec_helpers.av is None or codec_helpers.np is None,
+                 'requires PyAV and NumPy')
+class AudioDecoderTest(unittest.TestCase):
+    def decode(self, encoding, data, chunk_size=100):
+        decoder = codec_helpers.create_audio_out_decoder(encoding, 16000, 2)
+        chunks = [decoder.decode(data[i:i + chunk_size])
+                  for i in range(0, len(data), chunk_size)]
+        return chunks, decoder.flush()
+
+    def assert_decodes(self, encoding):
+        data = benchmark.encode_audio(sine(1), encoding, 16000, 32000)
+        chunks, tail = self.decode(encoding, data)
+        # Playback starts before the whole response is received.
+        self.assertTrue(any(chunks[:len(chunks) // 4]))
+        samples = array.array('h', b''.join(chunks) + tail)
+        self.assertAlmostEqual(len(samples), 16000, delta=2000)
+        self.assertGreater(max(samples), 4000)
+
+    def test_mp3(self):
+        self.assert_decodes(codec_helpers.MP3)
+
+    def test_opus_in_ogg(self):
+        self.assert_decodes(codec_helpers.OPUS_IN_OGG)
+
+    def test_mp3_id3_tag(self):
+        data = benchmark.encode_audio(sine(0.5), codec_helpers.MP3,
+                                      16000, 32000)
+        self.assertEqual(data[:3], b'ID3')
+        self.assertEqual(b''.join(self.decode(codec_helpers.MP3, data,
+                                              chunk_size=3)[0]),
+                         b''.join(self.decode(codec_helpers.MP3, data)[0]))
+
+    def test_conversation_stream(self):
+        data = benchmark.encode_audio(sine(0.5), codec_helpers.MP3,
+                                      16000, 32000)
+        sink = benchmark.TimingSink()
+        stream = audio_helpers.ConversationStream(
+            source=audio_helpers.WaveSource(
+                BytesIO(benchmark.wav_bytes(0, 16000, 2)), 16000, 2),
+            sink=sink, iter_size=0, sample_width=2)
+        stream.audio_out_encoding = codec_helpers.MP3
+        stream.start_playback()
+        self.assertEqual(stream.write(data), len(data))
+        stream.stop_playback()
+        # Half a second of audio, plus the encoder delay and padding.
+        self.assertGreaterEqual(sink.written, 16000)
+        self.assertEqual(sink.written % 2, 0)
+
+
+class SelectAudioOutEncodingTest(unittest.TestCase):
+    def test_linear16(self):
+        self.assertEqual(codec_helpers.select_audio_out_encoding(
+            codec_helpers.LINEAR16, 16000, 2), codec_helpers.LINEAR16)
+
+    def test_fallback(self):
+        av = codec_helpers.av
+        codec_helpers.av = None
+        try:
+            self.assertEqual(codec_helpers.select_audio_out_encoding(
+                codec_helpers.MP3, 16000, 2), codec_helpers.LINEAR16)
+        finally:
+            codec_helpers.av = av
+
+
+class SampleAssistantEncodingTest(unittest.TestCase):
+    def setUp(self):
+        self.channel = grpc.insecure_channel('localhost:0')
+
+    def tearDown(self):
+        self.channel.close()
+
+    def gen_assist_requests(self, encoding):
+        stream = audio_helpers.ConversationStream(
+            source=audio_helpers.WaveSource(BytesIO(pcm(range(1600))),
+                                            16000, 2),
+            sink=None, iter_size=1600, sample_width=2)
+        assistant = pushtotalk.SampleAssistant(
+            'en-US', 'model-id', 'device-id', stream, False,
+            self.channel, 10, None, audio_in_encoding=encoding)
+        return list(itertools.islice(assistant.gen_assist_requests(), 3))
+
+    def test_linear16(self):
+        requests = self.gen_assist_requests(codec_helpers.LINEAR16)
+        self.assertEqual(requests[0].config.audio_in_config.encoding,
+                         embedded_assistant_pb2.AudioInConfig.LINEAR16)
+        self.assertEqual(requests[1].audio_in + requests[2].audio_in,
+                         pcm(range(1600)))
+
+    @unittest.skipIf(codec_helpers.np is None, 'requires NumPy')
+    def test_flac(self):
+        requests = self.gen_assist_requests(codec_helpers.FLAC)
+        self.assertEqual(requests[0].config.audio_in_config.encoding,
+                         embedded_assistant_pb2.AudioInConfig.FLAC)
+        data = requests[1].audio_in + requests[2].audio_in
+        self.assertEqual(pcm(decode_flac(data)[1]), pcm(range(1600)))
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import time
+
+import grpc
+import pytest
+
+from google.assistant.embedded.v1alpha1 import (
+    embedded_assistant_pb2 as v1alpha1_pb2,
+    embedded_assistant_pb2_grpc as v1alpha1_pb2_grpc
+)
+from googlesamples.assistant.grpc import audio_helpers
+from googlesamples.assistant.grpc import device_helpers
+from googlesamples.assistant.grpc import fakeassistant
+from googlesamples.assistant.grpc import pushtotalk
+from googlesamples.assistant.grpc import trace_helpers
+from six import BytesIO
+
+
+DEVICE_REQUEST = {
+    'inputs': [{
+        'intent': 'action.devices.EXECUTE',
+        'payload': {
+            'commands': [{
+                'devices': [{'id': 'device-id'}],
+                'execution': [{
+                    'command': 'action.devices.commands.OnOff',
+                    'params': {'on': True},
+                }]
+            }]
+        }
+    }]
+}
+
+
+@pytest.fixture
+def channel_for():
+    servers = []
+    channels = []
+
+    def channel_for(servicer):
+        server, port = fakeassistant.serve(servicer)
+        servers.append(server)
+        channels.append(grpc.insecure_channel('localhost:%d' % port))
+        return channels[-1]
+    yield channel_for
+    for c in channels:
+        c.close()
+    for s in servers:
+        s.stop(0)
+
+
+# io.BytesIO also accepts the memoryviews written to sinks on Python 2.
+class BytesSink(io.BytesIO):
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def flush(self):
+        pass
+
+
+class FakeRawStream(object):
+    """Raw stream playing the written audio in real time.
+
+    Its buffer holds the output latency: writes block while it is full
+    and stop plays the rest of it.
+    """
+    latency = (0.01, 0.1)
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.active = False
+        self._end = 0
+
+    def _queued(self):
+        return max(0.0, self._end - time.time())
+
+    @property
+    def write_available(self):
+        return max(0, int((self.latency[1] - self._queued()) *
+                          self.sample_rate))
+
+    def write(self, buf):
+        self._end = (max(self._end, time.time()) +
+                     len(buf) / 2.0 / self.sample_rate)
+        wait = self._queued() - self.latency[1]
+        if wait > 0:
+            time.sleep(wait)
+        return False
+
+    def start(self):
+        self.active = True
+
+    def stop(self):
+        time.sleep(self._queued())
+        self.active = False
+
+    def close(self):
+        self.active = False
+
+
+class FakeDeviceStream(audio_helpers.SoundDeviceStream):
+    def _open_stream(self, sample_rate, dtype, blocksize):
+        return FakeRawStream(sample_rate)
+
+
+def test_assist(channel_for):
+    servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+        end_of_utterance_size=3200,
+        audio_out_size=100, audio_out_count=4,
+        microphone_mode='DIALOG_FOLLOW_ON',
+        volume_percentage=100,
+        device_request_json=json.dumps(DEVICE_REQUEST),
+    )
+    device_handler = device_helpers.DeviceRequestHandler('device-id')
+    calls = []
+
+    @device_handler.command('action.devices.commands.OnOff')
+    def onoff(on):
+        calls.append(on)
+
+    sink = BytesSink()
+    stream = audio_helpers.ConversationStream(
+        source=audio_helpers.WaveSource(BytesIO(b'\0' * 3200), 16000, 2),
+        sink=sink, iter_size=1600, sample_width=2)
+    tracer = trace_helpers.TurnTracer()
+    assistant = pushtotalk.SampleAssistant(
+        'en-US', 'model-id', 'device-id', stream, False,
+        channel_for(servicer), 10, device_handler, tracer=tracer)
+    assert assistant.assist()
+    assert calls == [True]
+    span = tracer.last_span
+    # Without local endpointing and barge-in.
+    assert set(span.events) == (set(trace_helpers.TURN_EVENTS) -
+                                {trace_helpers.LOCAL_END_OF_UTTERANCE,
+                                 trace_helpers.BARGE_IN,
+                                 trace_helpers.PLAYBACK_INTERRUPTED})
+    assert (span.elapsed(trace_helpers.FIRST_AUDIO_IN) <=
+            span.elapsed(trace_helpers.END_OF_UTTERANCE) <=
+            span.elapsed(trace_helpers.FIRST_AUDIO_OUT) <=
+            span.elapsed(trace_helpers.FIRST_PLAYBACK_WRITE) <=
+            span.elapsed(trace_helpers.PLAYBACK_STOPPED))
+    assert (trace_helpers.PLAYBACK_TAIL_METRIC, ()) in tracer.histograms
+    assert stream.volume_percentage == 100
+    assert len(sink.getvalue()) == 400
+    assert assistant.conversation_state == b'fake-conversation-state'
+
+
+def test_playback_tail(channel_for):
+    # 400ms of response audio through 100ms of device output latency.
+    servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+        end_of_utterance_size=3200, audio_out_size=3200, audio_out_count=4)
+    stream = audio_helpers.ConversationStream(
+        source=audio_helpers.WaveSource(BytesIO(b'\0' * 3200), 16000, 2),
+        sink=FakeDeviceStream(16000, 2, 3200, 0),
+        iter_size=1600, sample_width=2)
+    tracer = trace_helpers.TurnTracer()
+    assistant = pushtotalk.SampleAssistant(
+        'en-US', 'model-id', 'device-id', stream, False,
+        channel_for(servicer), 10, None, tracer=tracer)
+    assistant.assist()
+    tail = tracer.histograms[(trace_helpers.PLAYBACK_TAIL_METRIC, ())]
+    # The device buffer is played once after the last write.
+    assert 0.05 <= tail.sum < 0.15
+
+
+def test_first_playback_write(channel_for):
+    class SlowSink(BytesSink):
+        def write(self, buf):
+            time.sleep(0.05)
+            return super(SlowSink, self).write(buf)
+
+    servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+        end_of_utterance_size=3200, audio_out_size=100, audio_out_count=1)
+    stream = audio_helpers.ConversationStream(
+        source=audio_helpers.WaveSource(BytesIO(b'\0' * 3200), 16000, 2),
+        sink=SlowSink(), iter_size=1600, sample_width=2)
+    tracer = trace_helpers.TurnTracer()
+    assistant = pushtotalk.SampleAssistant(
+        'en-US', 'model-id', 'device-id', stream, False,
+        channel_for(servicer), 10, None, tracer=tracer)
+    assistant.assist()
+    span = tracer.last_span
+    # Marked when the write returns, not when it starts.
+    assert 0.05 <= span.interval(trace_helpers.FIRST_AUDIO_OUT,
+                                 trace_helpers.FIRST_PLAYBACK_WRITE)
+
+
+def test_converse(channel_for):
+    servicer = fakeassistant.FakeConverseServicer(
+        end_of_utterance_size=3, audio_out_size=10, audio_out_count=2,
+        device_request_json='{}',
+    )
+    stub = v1alpha1_pb2_grpc.EmbeddedAssistantStub(channel_for(servicer))
+    requests = [
+        v1alpha1_pb2.ConverseRequest(config=v1alpha1_pb2.ConverseConfig()),
+        v1alpha1_pb2.ConverseRequest(audio_in=b'abcd'),
+    ]
+    responses = list(stub.Converse(iter(requests)))
+    assert [r.WhichOneof('converse_response') for r in responses] == [
+        'event_type', 'result', 'device_action', 'audio_out', 'audio_out'
+    ]
+    assert responses[1].result.spoken_request_text == 'what time is it'
+
+
+def test_injected_delays():
+    servicer = fakeassistant.FakeAssistant(jitter=0.01, seed=1)
+    start = time.time()
+    servicer.delay(0.02)
+    assert 0.02 <= time.time() - start
+    servicer = fakeassistant.FakeAssistant(audio_out_size=160,
+                                           audio_out_count=3,
+                                           audio_out_rate=16000)
+    start = time.time()
+    assert len(list(servicer.audio_out_chunks())) == 3
+    assert 0.02 <= time.time() - start
+
+
+def test_audio_out_data():
+    servicer = fakeassistant.FakeAssistant(audio_out_size=4,
+                                           audio_out_data=b'abcdefghij')
+    assert list(servicer.audio_out_chunks()) == [b'abcd', b'efgh', b'ij']
+
+
+def test_create_servicer():
+    assert isinstance(fakeassistant.create_servicer('v1alpha1'),
+                      fakeassistant.FakeConverseServicer)
+    assert isinstance(fakeassistant.create_servicer(),
+                      fakeassistant.FakeEmbeddedAssistantServicer)
+
+
+def test_serve_in_subprocess():
+    with fakeassistant.serve_in_subprocess(
+            api_version='v1alpha1', end_of_utterance_size=3) as address:
+        channel = grpc.insecure_channel(address)
+        stub = v1alpha1_pb2_grpc.EmbeddedAssistantStub(channel)
+        requests = [
+            v1alpha1_pb2.ConverseRequest(
+                config=v1alpha1_pb2.ConverseConfig()),
+            v1alpha1_pb2.ConverseRequest(audio_in=b'abcd'),
+        ]
+        responses = list(stub.Converse(iter(requests)))
+        channel.close()
+    assert responses[1].result.spoken_request_text == 'what time is it'
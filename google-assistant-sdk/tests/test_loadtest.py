@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+from googlesamples.assistant.grpc import fakeassistant
+from googlesamples.assistant.grpc import loadtest
+
+
+def test_run_load_paths(tmpdir):
+    path = tmpdir.join('audio.raw')
+    path.write_binary(b'\0' * 3200)
+    servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+        end_of_utterance_size=3200, audio_out_count=2
+    )
+    server, port = fakeassistant.serve(servicer)
+    try:
+        timings, errors = asyncio.run(loadtest.run_load(
+            'localhost:%d' % port, [str(path)], streams=4, turns=2,
+            iter_size=1600,
+        ))
+    finally:
+        server.stop(0)
+    assert errors == 0
+    assert len(timings) == 8
+
+
+def test_run_load():
+    servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+        end_of_utterance_size=3200, audio_out_count=2
+    )
+    server, port = fakeassistant.serve(servicer)
+    try:
+        timings, errors = asyncio.run(loadtest.run_load(
+            'localhost:%d' % port, [b'\0' * 3200], streams=4, turns=2,
+            iter_size=1600,
+        ))
+    finally:
+        server.stop(0)
+    assert errors == 0
+    assert len(timings) == 8
+    for t in timings:
+        assert (t['end_of_utterance'] <= t['first_audio_out'] <= t['turn'])
+
+
+def test_run_load_end_at_eof():
+    servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+        end_of_utterance_size=32000, audio_out_count=2
+    )
+    server, port = fakeassistant.serve(servicer)
+    try:
+        timings, errors = asyncio.run(loadtest.run_load(
+            'localhost:%d' % port, [b'\0' * 3200], streams=2, turns=1,
+            iter_size=1600, trailing_silence_ms=0,
+        ))
+    finally:
+        server.stop(0)
+    assert errors == 0
+    # The request ends with the file, well before a second of audio.
+    for t in timings:
+        assert t['end_of_utterance'] < 0.5
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+import tempfile
+
+from googlesamples.assistant.grpc import trace_helpers
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_span():
+    clock = FakeClock()
+    span = trace_helpers.TurnSpan(clock=clock)
+    clock.now = 0.5
+    span.mark(trace_helpers.END_OF_UTTERANCE)
+    clock.now = 0.7
+    span.mark(trace_helpers.END_OF_UTTERANCE)
+    span.update(trace_helpers.DEVICE_ACTION_COMPLETED)
+    clock.now = 1.0
+    span.update(trace_helpers.DEVICE_ACTION_COMPLETED)
+    span.finish()
+    assert span.elapsed(trace_helpers.END_OF_UTTERANCE) == 0.5
+    assert span.elapsed(trace_helpers.FIRST_AUDIO_OUT) is None
+    assert span.interval(trace_helpers.END_OF_UTTERANCE,
+                         trace_helpers.DEVICE_ACTION_COMPLETED) == 0.5
+    assert span.duration == 1.0
+
+
+def test_histogram():
+    h = trace_helpers.Histogram(buckets=(0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 2.0):
+        h.observe(v)
+    assert h.counts == [2, 1, 1]
+    assert h.count == 4
+    assert h.sum == 2.65
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert trace_helpers.percentile(values, 50) == 50
+    assert trace_helpers.percentile(values, 95) == 95
+    assert trace_helpers.percentile(values, 99) == 99
+    assert trace_helpers.percentile([3, 1, 2], 50) == 2
+    assert trace_helpers.percentile([7], 99) == 7
+    assert math.isnan(trace_helpers.percentile([], 50))
+
+
+def test_openmetrics():
+    clock = FakeClock()
+    tracer = trace_helpers.TurnTracer(buckets=(0.1, 1.0), clock=clock)
+    span = tracer.start_turn()
+    clock.now = 0.05
+    span.mark(trace_helpers.FIRST_AUDIO_IN)
+    clock.now = 0.5
+    tracer.end_turn(span)
+    tracer.set_gauge('assistant_buffer_depth', 3)
+    text = trace_helpers.openmetrics(tracer)
+    lines = text.splitlines()
+    assert '# TYPE assistant_turn_event_seconds histogram' in lines
+    assert ('assistant_turn_event_seconds_bucket'
+            '{event="first_audio_in",le="0.1"} 1') in lines
+    assert ('assistant_turn_event_seconds_bucket'
+            '{event="first_audio_in",le="+Inf"} 1') in lines
+    assert 'assistant_turn_duration_seconds_sum 0.5' in lines
+    assert 'assistant_turns_total 1.0' in lines
+    assert 'assistant_buffer_depth 3.0' in lines
+    assert lines[-1] == '# EOF'
+    assert tracer.last_span is span
+
+
+def test_write_metrics():
+    tracer = trace_helpers.TurnTracer()
+    tracer.increment('assistant_underflows')
+    path = os.path.join(tempfile.mkdtemp(), 'assistant.prom')
+    trace_helpers.write_metrics(tracer, path)
+    with open(path) as f:
+        assert 'assistant_underflows_total 1.0' in f.read()
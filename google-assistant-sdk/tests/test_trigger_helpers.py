@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+
+import grpc
+
+from googlesamples.assistant.grpc import audio_helpers
+from googlesamples.assistant.grpc import benchmark
+from googlesamples.assistant.grpc import fakeassistant
+from googlesamples.assistant.grpc import pushtotalk
+from googlesamples.assistant.grpc import trace_helpers
+from googlesamples.assistant.grpc import trigger_helpers
+from six import BytesIO
+
+
+np = trigger_helpers.np
+
+
+def chunks(samples, size=1600):
+    return [samples[i:i + size].tobytes()
+            for i in range(0, len(samples), size)]
+
+
+def first_trigger(detector, samples):
+    for i, chunk in enumerate(chunks(samples)):
+        if detector(chunk):
+            return i
+    return None
+
+
+def chirp(seconds, sample_rate=16000):
+    t = np.arange(int(seconds * sample_rate)) / float(sample_rate)
+    samples = 3000 * np.sin(2 * np.pi * (300 + 1500 * t) * t)
+    return samples.astype('<i2')
+
+
+def always(sample_rate, sample_width):
+    return lambda buf: True
+
+
+class FakeSource(BytesIO, object):
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PacedSource(FakeSource):
+    """Source returning audio 5 times faster than real time."""
+    _sample_rate = 16000
+
+    def read(self, size):
+        time.sleep(size / 160000.0)
+        return super(PacedSource, self).read(size)
+
+
+class PacedSink(benchmark.NullSink):
+    """Sink playing audio 2 times faster than real time."""
+    def __init__(self):
+        self.written = 0
+
+    def write(self, buf):
+        time.sleep(len(buf) / 64000.0)
+        self.written += len(buf)
+        return len(buf)
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class VoiceTriggerTest(unittest.TestCase):
+    def test_speech_onset(self):
+        trigger = trigger_helpers.VoiceTrigger(16000, 2, min_speech_ms=150)
+        samples = np.concatenate((np.zeros(8000, dtype='<i2'),
+                                  benchmark.speech_like(0.5, 0, 16000)))
+        # 0.5s of silence, then 0.15s of speech in chunks of 0.1s.
+        self.assertEqual(first_trigger(trigger, samples), 6)
+
+    def test_silence(self):
+        trigger = trigger_helpers.VoiceTrigger(16000, 2)
+        self.assertIsNone(first_trigger(trigger,
+                                        np.zeros(16000, dtype='<i2')))
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class TemplateTriggerTest(unittest.TestCase):
+    def setUp(self):
+        self.template = chirp(0.5)
+        self.trigger = trigger_helpers.TemplateTrigger(self.template,
+                                                       16000, 2)
+
+    def test_match(self):
+        samples = np.concatenate((np.zeros(8000, dtype='<i2'),
+                                  self.template,
+                                  np.zeros(8000, dtype='<i2')))
+        self.assertIsNotNone(first_trigger(self.trigger, samples))
+
+    def test_memoryview(self):
+        # Mapped sources return memoryviews.
+        samples = np.concatenate((np.zeros(8000, dtype='<i2'),
+                                  self.template,
+                                  np.zeros(8000, dtype='<i2')))
+        triggered = [self.trigger(memoryview(c)) for c in chunks(samples)]
+        self.assertTrue(any(triggered))
+
+    def test_no_match(self):
+        samples = benchmark.speech_like(1.0, 0.5, 16000)
+        self.assertIsNone(first_trigger(self.trigger, samples))
+        self.assertLess(self.trigger.score, self.trigger.threshold)
+
+    def test_empty_template(self):
+        with self.assertRaises(ValueError):
+            trigger_helpers.TemplateTrigger(np.zeros(0, dtype='<i2'),
+                                            16000, 2)
+
+
+class CreateDetectorTest(unittest.TestCase):
+    def test_enter(self):
+        self.assertIsNone(trigger_helpers.create_detector(
+            trigger_helpers.ENTER, 16000, 2))
+
+    def test_model(self):
+        detector = trigger_helpers.create_detector(
+            trigger_helpers.ENTER, 16000, 2, model=__name__ + ':always')
+        self.assertTrue(detector(b''))
+
+    def test_invalid_model(self):
+        with self.assertRaises(ValueError):
+            trigger_helpers.load_model(__name__, 16000, 2)
+
+    def test_template_required(self):
+        with self.assertRaises(ValueError):
+            trigger_helpers.create_detector(trigger_helpers.TEMPLATE,
+                                            16000, 2)
+
+
+class TriggerStageTest(unittest.TestCase):
+    def setUp(self):
+        data = bytearray(i for i in range(8) for _ in range(4))
+        self.source = FakeSource(bytes(data))
+        self.triggers = [False, False, True]
+        self.stage = trigger_helpers.TriggerStage(
+            self.source, lambda buf: self.triggers.pop(0), 1000, 2,
+            chunk_size=4, pre_roll_ms=4)
+
+    def test_pre_roll(self):
+        self.stage.wait()
+        self.assertIsNotNone(self.stage.triggered_at)
+        # The pre-roll holds the last 4ms of audio, 8 bytes.
+        self.assertEqual(b'\1' * 4, bytes(self.stage.read(4)))
+        self.assertEqual(b'\2' * 4, bytes(self.stage.read(4)))
+        self.assertEqual(b'\3' * 4, bytes(self.stage.read(4)))
+
+    def test_cancel_before_wait(self):
+        # Only a wait in progress is cancelled.
+        self.stage.cancel()
+        self.assertTrue(self.stage.wait())
+
+    def test_end_of_source(self):
+        self.triggers = [False] * 8
+        self.assertFalse(self.stage.wait())
+        self.assertIsNone(self.stage.triggered_at)
+
+    def test_stop_drops_pre_roll(self):
+        self.stage.wait()
+        self.stage.stop()
+        self.assertEqual(b'\3' * 4, bytes(self.stage.read(4)))
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class SampleAssistantBargeInTest(unittest.TestCase):
+    def setUp(self):
+        # 2s of response audio.
+        servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+            end_of_utterance_size=3200, audio_out_size=1600,
+            audio_out_count=40)
+        self.server, port = fakeassistant.serve(servicer)
+        self.channel = grpc.insecure_channel('localhost:%d' % port)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+
+    def assist(self, samples):
+        self.barge_in = trigger_helpers.TriggerStage(
+            PacedSource(samples.tobytes()),
+            trigger_helpers.VoiceTrigger(16000, 2, min_speech_ms=200),
+            16000, 2, chunk_size=1600, pre_roll_ms=500)
+        self.sink = PacedSink()
+        stream = audio_helpers.ConversationStream(
+            source=self.barge_in, sink=self.sink, iter_size=1600,
+            sample_width=2)
+        self.tracer = trace_helpers.TurnTracer()
+        assistant = pushtotalk.SampleAssistant(
+            'en-US', 'model-id', 'device-id', stream, False,
+            self.channel, 10, None, tracer=self.tracer,
+            barge_in=self.barge_in)
+        continue_conversation = assistant.assist()
+        return assistant, continue_conversation
+
+    def test_interrupt(self):
+        # The user speaks during the response.
+        samples = np.concatenate((np.zeros(8000, dtype='<i2'),
+                                  benchmark.speech_like(1.0, 0, 16000)))
+        assistant, continue_conversation = self.assist(samples)
+        self.assertTrue(assistant.interrupted)
+        self.assertTrue(continue_conversation)
+        self.assertLess(self.sink.written, 40 * 1600)
+        span = self.tracer.last_span
+        self.assertLessEqual(span.elapsed(trace_helpers.BARGE_IN),
+                             span.elapsed(trace_helpers.PLAYBACK_INTERRUPTED))
+        self.assertIn((trace_helpers.INTERRUPT_LATENCY_METRIC, ()),
+                      self.tracer.histograms)
+        # The next turn starts with the 500ms pre-roll, ending with the
+        # interrupting speech.
+        self.assertTrue(any(self.barge_in.read(16000)[-3200:]))
+
+    def test_no_interrupt(self):
+        assistant, continue_conversation = self.assist(
+            np.zeros(16000 * 3, dtype='<i2'))
+        self.assertFalse(assistant.interrupted)
+        self.assertEqual(self.sink.written, 40 * 1600)
+        self.assertNotIn(trace_helpers.BARGE_IN, self.tracer.last_span.events)
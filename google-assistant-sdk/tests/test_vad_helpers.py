@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# Copyright (C) 2018 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import grpc
+
+from googlesamples.assistant.grpc import audio_helpers
+from googlesamples.assistant.grpc import benchmark
+from googlesamples.assistant.grpc import fakeassistant
+from googlesamples.assistant.grpc import pushtotalk
+from googlesamples.assistant.grpc import trace_helpers
+from googlesamples.assistant.grpc import vad_helpers
+from six import BytesIO
+
+
+np = vad_helpers.np
+
+
+def chunks(samples, size=1600):
+    return [samples[i:i + size].tobytes()
+            for i in range(0, len(samples), size)]
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class VoiceActivityDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.vad = vad_helpers.VoiceActivityDetector(16000, 2)
+        self.samples = benchmark.speech_like(0.5, 0.5, 16000)
+
+    def test_frames(self):
+        frames = np.concatenate([self.vad.frames(c)
+                                 for c in chunks(self.samples)])
+        self.assertEqual(len(frames), 100)
+        self.assertTrue(frames[:50].all())
+        self.assertFalse(frames[50:].any())
+
+    def test_carry(self):
+        frames = np.concatenate([self.vad.frames(c)
+                                 for c in chunks(self.samples, 150)])
+        self.assertEqual(len(frames), 100)
+        self.assertEqual(frames.sum(), 50)
+
+    def test_memoryview(self):
+        # Mapped sources return memoryviews.
+        frames = np.concatenate([self.vad.frames(memoryview(c))
+                                 for c in chunks(self.samples)])
+        self.assertEqual(frames.sum(), 50)
+
+    def test_unvoiced(self):
+        rng = np.random.RandomState(0)
+        hiss = rng.normal(0, 200, 1600).astype('<i2').tobytes()
+        self.assertTrue(self.vad.frames(hiss).all())
+
+    def test_noise_floor(self):
+        noise = np.random.RandomState(0).normal(0, 300, 10 * 16000)
+        frames = np.concatenate([self.vad.frames(c)
+                                 for c in chunks(noise.astype('<i2'))])
+        # The noise floor slowly rises to steady noise, which is then
+        # not speech anymore.
+        self.assertTrue(frames[:10].all())
+        self.assertFalse(frames[-100:].any())
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class EndpointerTest(unittest.TestCase):
+    def setUp(self):
+        self.chunks = chunks(benchmark.speech_like(0.5, 1.0, 16000))
+
+    def endpointer(self, close):
+        return vad_helpers.Endpointer(
+            vad_helpers.VoiceActivityDetector(16000, 2),
+            trailing_silence_ms=300, close=close)
+
+    def test_close(self):
+        endpointer = self.endpointer(True)
+        # 0.5s of speech followed by 0.3s of silence.
+        self.assertEqual(len(list(endpointer.process(self.chunks))), 8)
+        self.assertTrue(endpointer.endpointed)
+
+    def test_observe(self):
+        endpointer = self.endpointer(False)
+        self.assertEqual(list(endpointer.process(self.chunks)), self.chunks)
+        self.assertTrue(endpointer.endpointed)
+
+    def test_silence_only(self):
+        endpointer = self.endpointer(True)
+        silence = [b'\0' * 3200] * 10
+        self.assertEqual(list(endpointer.process(silence)), silence)
+        self.assertFalse(endpointer.endpointed)
+
+    def test_reset(self):
+        endpointer = self.endpointer(True)
+        list(endpointer.process(self.chunks))
+        self.assertEqual(len(list(endpointer.process(self.chunks))), 8)
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class VadChunkPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.samples = benchmark.speech_like(0.5, 0.5, 16000)
+        self.policy = vad_helpers.VadChunkPolicy(
+            audio_helpers.GrowingChunkPolicy(640, 3200),
+            vad_helpers.VoiceActivityDetector(16000, 2))
+
+    def sizes(self):
+        sizes = []
+        position = 0
+        while position < len(self.samples):
+            size = self.policy.next_size()
+            sizes.append(size)
+            self.policy.update(
+                self.samples[position:position + size // 2].tobytes())
+            position += size // 2
+        return sizes
+
+    def test_pause(self):
+        sizes = self.sizes()
+        # Growing during speech, small again in the trailing silence.
+        self.assertEqual([640, 1280, 2560, 3200], sizes[:4])
+        self.assertEqual([640, 640], sizes[-2:])
+
+    def test_reset(self):
+        self.sizes()
+        self.policy.reset()
+        self.assertEqual(640, self.policy.next_size())
+        self.assertFalse(self.policy.endpointer.speech_started)
+
+    def test_fallback(self):
+        policy = audio_helpers.GrowingChunkPolicy(640, 3200)
+        self.assertIs(policy, vad_helpers.create_vad_chunk_policy(
+            policy, 16000, 4))
+
+
+class CreateEndpointerTest(unittest.TestCase):
+    def test_off(self):
+        self.assertIsNone(vad_helpers.create_endpointer(
+            vad_helpers.OFF, 16000, 2))
+
+    def test_fallback(self):
+        self.assertIsNone(vad_helpers.create_endpointer(
+            vad_helpers.ON, 16000, 4))
+
+    @unittest.skipIf(np is None, 'requires NumPy')
+    def test_modes(self):
+        self.assertTrue(vad_helpers.create_endpointer(
+            vad_helpers.ON, 16000, 2).close)
+        self.assertFalse(vad_helpers.create_endpointer(
+            vad_helpers.OBSERVE, 16000, 2).close)
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class SampleAssistantEndpointingTest(unittest.TestCase):
+    def setUp(self):
+        # The server endpoints after 1s of trailing silence.
+        servicer = fakeassistant.FakeEmbeddedAssistantServicer(
+            end_of_utterance_size=48000)
+        self.server, port = fakeassistant.serve(servicer)
+        self.channel = grpc.insecure_channel('localhost:%d' % port)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+
+    def assist(self, mode):
+        samples = benchmark.speech_like(0.5, 1.5, 16000)
+        source = audio_helpers.WaveSource(BytesIO(samples.tobytes()),
+                                          16000, 2,
+                                          pacing=audio_helpers.BURST)
+        stream = audio_helpers.ConversationStream(
+            source=source, sink=benchmark.NullSink(), iter_size=1600,
+            sample_width=2)
+        tracer = trace_helpers.TurnTracer()
+        assistant = pushtotalk.SampleAssistant(
+            'en-US', 'model-id', 'device-id', stream, False,
+            self.channel, 10, None, tracer=tracer,
+            endpointer=vad_helpers.create_endpointer(
+                mode, 16000, 2, trailing_silence_ms=300))
+        assistant.assist()
+        return tracer, source.stats['bytes']
+
+    def test_on(self):
+        tracer, sent = self.assist(vad_helpers.ON)
+        span = tracer.last_span
+        self.assertIn(trace_helpers.LOCAL_END_OF_UTTERANCE, span.events)
+        # The request ends after 0.5s of speech and 0.3s of silence.
+        self.assertLess(sent, 48000)
+        self.assertIn((trace_helpers.ENDPOINT_LEAD_METRIC, ()),
+                      tracer.histograms)
+
+    def test_observe(self):
+        tracer, sent = self.assist(vad_helpers.OBSERVE)
+        span = tracer.last_span
+        self.assertLessEqual(
+            span.elapsed(trace_helpers.LOCAL_END_OF_UTTERANCE),
+            span.elapsed(trace_helpers.END_OF_UTTERANCE))
+        self.assertGreaterEqual(sent, 48000)